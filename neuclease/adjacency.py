@@ -102,9 +102,13 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
     if orig_num_cc == 1:
         return np.zeros((0,2), np.uint64), orig_num_cc, final_num_cc, pd.DataFrame(columns=BLOCK_TABLE_COLS)
 
-    labelindex = fetch_labelindex(server, uuid, instance, body, format='protobuf')
-    encoded_block_coords = np.fromiter(labelindex.blocks.keys(), np.uint64, len(labelindex.blocks))
-    coords_zyx = decode_labelindex_blocks(encoded_block_coords)
+    labelindex = fetch_labelindex(server, uuid, instance, body, format='arrays')
+
+    # The entries for each block are contiguous in the labelindex arrays.
+    block_ids = labelindex.block_ids
+    block_starts = np.flatnonzero(np.r_[len(block_ids) > 0, block_ids[1:] != block_ids[:-1]])
+    block_stops = np.r_[block_starts[1:], len(block_ids)]
+    coords_zyx = decode_labelindex_blocks(block_ids[block_starts])
 
     cc_mapper = LabelMapper(svs, cc)
     svs_set = set(svs)
@@ -115,10 +119,10 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
     
     searched_block_svs = {}
     
-    for coord_zyx, sv_counts in zip(coords_zyx, labelindex.blocks.values()):
+    for coord_zyx, start, stop in zip(coords_zyx, block_starts, block_stops):
         # Given the supervoxels in this block, what CC adjacencies
         # MIGHT we find if we were to inspect the segmentation?
-        block_svs = np.fromiter(sv_counts.counts.keys(), np.uint64)
+        block_svs = labelindex.svs[start:stop]
         block_ccs = cc_mapper.apply(block_svs)
         possible_cc_adjacencies = set(combinations( set(block_ccs), 2 ))
         
@@ -0,0 +1,142 @@
+"""
+Compare the throughput of libdvid's labelarray block codec against
+neuclease's native (numba) implementation, and verify that both
+produce identical results.
+
+Throughput is reported in MB/s of uncompressed (uint64) voxel data,
+for a single thread and for the requested number of threads.
+
+By default, a synthetic test volume is used, but you can also
+benchmark real data from a DVID labelmap instance.
+
+Examples:
+
+    # Synthetic data
+    python -m neuclease.bin.benchmark_labelarray_codec --threads=8
+
+    # Real data (a 512px cube starting at the given Z,Y,X offset)
+    python -m neuclease.bin.benchmark_labelarray_codec --threads=8 emdata4:8900 abc9 segmentation 20480 20480 20480
+"""
+import gzip
+import zlib
+import logging
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+from neuclease import configure_default_logging
+from neuclease.util import Timer, ndrange, box_to_slicing
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    configure_default_logging()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', '-t', type=int, default=8, help='Number of threads for the parallel benchmarks')
+    parser.add_argument('--width', '-w', type=int, default=512, help='Width of the test volume (in voxels)')
+    parser.add_argument('server', nargs='?', help='dvid server, e.g. emdata3:8900')
+    parser.add_argument('uuid', nargs='?')
+    parser.add_argument('instance', nargs='?', help='A labelmap instance')
+    parser.add_argument('offset_zyx', nargs='*', type=int, help='Block-aligned corner of the volume to fetch')
+    args = parser.parse_args()
+
+    box = np.array([(0,0,0), 3*(args.width,)])
+    if args.server:
+        from neuclease.dvid import fetch_labelmap_voxels
+        box += args.offset_zyx or 0
+        with Timer(f"Fetching {box.tolist()}", logger):
+            volume = fetch_labelmap_voxels(args.server, args.uuid, args.instance, box, supervoxels=True)
+    else:
+        volume = synthetic_volume(args.width)
+
+    results = benchmark_labelarray_codec(volume, args.threads)
+    print(results.to_string())
+
+
+def synthetic_volume(width, seed=0):
+    """
+    Generate a test volume of box-shaped segments with some noisy voxels.
+    """
+    rng = np.random.default_rng(seed)
+    coarse_labels = rng.integers(1, 1_000_000, 3*(width//16,)).astype(np.uint64)
+    volume = coarse_labels.repeat(16, 0).repeat(16, 1).repeat(16, 2)
+
+    # Noise: replace a few percent of voxels with random labels from a small set.
+    noise = rng.random(volume.shape) < 0.02
+    volume[noise] = rng.integers(1, 1000, noise.sum()).astype(np.uint64)
+    return volume
+
+
+def benchmark_labelarray_codec(volume, threads):
+    """
+    Encode and decode every block of the given volume with
+    both libdvid and the native codec, and return a DataFrame
+    of throughput results (MB/s of uncompressed voxels).
+    """
+    from libdvid import encode_label_block, DVIDNodeService
+    from neuclease.dvid.labelmap import encode_labelarray_block, decode_labelarray_block
+
+    assert (np.array(volume.shape) % 64 == 0).all()
+    corners = [np.array(c) for c in ndrange((0,0,0), volume.shape, (64,64,64))]
+    blocks = [volume[box_to_slicing(c, c+64)].copy('C') for c in corners]
+    nbytes = sum(b.nbytes for b in blocks)
+
+    def libdvid_decode(item):
+        corner, data = item
+        raw = np.array([*(corner[::-1] // 64), len(data)], np.int32).tobytes() + data
+        return DVIDNodeService.inflate_labelarray_blocks3D_from_raw(raw, (64,64,64), corner)
+
+    def native_decode(item):
+        _corner, data = item
+        return decode_labelarray_block(zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+    # Neither encoder applies gzip compression.
+    # We benchmark the codec alone, not gzip.
+    libdvid_encoded = [bytes(encode_label_block(b)) for b in blocks]
+    native_encoded = [bytes(encode_labelarray_block(b)) for b in blocks]
+    identical = (libdvid_encoded == native_encoded)
+    if not identical:
+        logger.warning("Encoded blocks are not identical to libdvid's!")
+
+    # Both decoders are given gzipped data (as returned by DVID).
+    gzipped = [gzip.compress(d, 1) for d in native_encoded]
+
+    # Warm up the jit
+    decode_labelarray_block(native_encoded[0])
+    encode_labelarray_block(blocks[0])
+
+    cases = [
+        ('encode', 'libdvid', lambda b: encode_label_block(b), blocks),
+        ('encode', 'native', encode_labelarray_block, blocks),
+        ('decode', 'libdvid', libdvid_decode, list(zip(corners, gzipped))),
+        ('decode', 'native', native_decode, list(zip(corners, gzipped))),
+    ]
+
+    rows = []
+    for op, impl, f, items in cases:
+        for t in sorted({1, threads}):
+            with Timer() as timer:
+                if t == 1:
+                    results = list(map(f, items))
+                else:
+                    with ThreadPool(t) as pool:
+                        results = pool.map(f, items, chunksize=max(1, len(items) // (4*t)))
+
+            if op == 'decode':
+                assert all((r == b).all() for r, b in zip(results, blocks)), \
+                    f"{impl} decode produced incorrect results"
+
+            mb_per_sec = nbytes / 1e6 / timer.seconds
+            rows.append((op, impl, t, timer.seconds, mb_per_sec, mb_per_sec / t))
+
+    df = pd.DataFrame(rows, columns=['operation', 'implementation', 'threads', 'seconds', 'MB/s', 'MB/s/thread'])
+    df['identical_encoding'] = identical
+    return df
+
+
+if __name__ == "__main__":
+    main()
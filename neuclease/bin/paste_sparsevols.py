@@ -6,14 +6,15 @@ import os
 import json
 import logging
 import argparse
+from itertools import tee
 
-import numpy as np
 import pandas as pd
 
 from neuclease.logging_setup import PrefixedLogger
 from neuclease import configure_default_logging
-from neuclease.util import Timer, lexsort_columns, groupby_presorted, SparseBlockMask, NumpyConvertingEncoder
-from neuclease.dvid import fetch_labelarray_voxels, post_labelarray_blocks, fetch_roi, parse_rle_response, fetch_instance_info
+from neuclease.util import Timer, SparseBlockMask, NumpyConvertingEncoder
+from neuclease.dvid import fetch_labelarray_voxels, post_labelmap_blocks_pipelined, fetch_roi, fetch_instance_info
+from neuclease.dvid.rle import parse_rle_response, iter_rle_block_masks
 
 logger = logging.getLogger(__name__)
 
@@ -76,40 +77,28 @@ def overwrite_sparsevol(server, uuid, instance, new_label, sparsevol_filepath, r
     
     Pseudo-code:
         
-        1. Parse the sparsevol RLE data into a complete list of coordinates.
-           (Note: For large bodies, this requires a lot of RAM.)
+        1. Parse the sparsevol RLE data into a table of runs:
            
-           Results in a large array:
-           
-               [[z,y,x],
-                [z,y,x],
+               [[z,y,x1,x2],
+                [z,y,x1,x2],
                 ...
                ]
 
-        2. Append columns to the coordinate array for the block index:
-        
-               [[z,y,x,bz,by,bx],
-                [z,y,x,bz,by,bx],
-                ...
-               ]
+           (The runs are never decoded into a list of voxel coordinates,
+           so even very large bodies require little RAM.)
 
-        3. Sort the coordinate array by BLOCK index (bz,by,bx).
-        
-        4. Divide the coordinates into groups, by block index.
-           Now each group of coordinates corresponds to a single
-           block that needs to be patched.
+        2. Split the runs at block boundaries and generate a dense
+           mask for each block that the runs touch.
+           (See neuclease.dvid.rle.iter_rle_block_masks())
            
-        5. For each group:
-             a. Construct a 3D mask from the coordinates in this group
-                AND the intersection of the given ROI mask (if provided).
+        3. For each block mask:
+             a. Intersect it with the given ROI mask (if provided).
              b. Download the corresponding labelmap block.
              c. Overwrite the masked voxels with new_label.
              d. Do not post the patched block data immediately.
-                Instead, save it to a temporary queue.
-             e. If the queue has 400 blocks in it, post them all,
-                and then clear the queue.
-
-        6. After the above loop runs, clear the queue one last time.
+                Instead, send it to an upload pipeline, which encodes
+                the blocks in batches of 400 and posts each batch
+                while the next one is being prepared.
 
 
     Args:
@@ -149,57 +138,40 @@ def overwrite_sparsevol(server, uuid, instance, new_label, sparsevol_filepath, r
     Returns:
         The set of supervoxels that were at least partially overwritten by the new label.
     """
-    sorted_path = sparsevol_filepath + '.sorted_blocktable.npy'
-    if os.path.exists(sorted_path):
-        logger.info("Loading presorted sparse coordinates")
-        sorted_table = np.load(sorted_path)
-    else:
-        with open(sparsevol_filepath, 'rb') as f:
-            with Timer("Parsing sparsevol coordinates", logger):
-                coords = parse_rle_response(f.read(), np.int16)
-            with Timer("Sorting sparsevol coordiantes", logger):
-                table = np.concatenate( (coords // 64, coords), axis=1 )
-                sorted_table = lexsort_columns(table)
-                del table
-
-            with Timer("Saving sparsevol sorted blocktable"):           
-                np.save(sorted_path, sorted_table)
+    with open(sparsevol_filepath, 'rb') as f:
+        with Timer("Parsing sparsevol runs", logger):
+            rle_ranges = parse_rle_response(f.read(), format='ranges')
 
     overwritten_labels = set()
-    
-    BLOCK_GROUP_SIZE = 400
-    next_block_set = []
-    for coord_group in groupby_presorted(sorted_table[:,3:], sorted_table[:, :3]):
-        block_corner = coord_group[0] // 64 * 64
-        block_box = (block_corner, 64 + block_corner)
-        block_voxels = fetch_labelarray_voxels(server, uuid, instance, block_box, supervoxels=True)
-        
-        block_mask = np.zeros_like(block_voxels, dtype=bool)
-        mask_coords = coord_group - block_corner
-        block_mask[tuple(mask_coords.transpose())] = True
-
-        if roi_sbm is not None:
-            roi_mask = roi_sbm.get_fullres_mask(block_box)
-            if invert_roi:
-                roi_mask = ~roi_mask
-            block_mask[:] &= roi_mask
 
-        if not block_mask.any():
-            continue
-
-        overwritten_labels |= set(pd.unique(block_voxels[block_mask]))
-        block_voxels[block_mask] = new_label
-        
-        next_block_set.append((block_corner, block_voxels))
-        
-        # Flush the blocks periodically
-        if len(next_block_set) == BLOCK_GROUP_SIZE:
-            with Timer(f"Sending block set (N={len(next_block_set)})", logger):
-                post_labelarray_blocks(server, uuid, instance, *zip(*next_block_set), downres=not no_downres)
-            next_block_set = []
-
-    with Timer(f"Sending last block set (N={len(next_block_set)})", logger):
-        post_labelarray_blocks(server, uuid, instance, *zip(*next_block_set), downres=not no_downres)
+    def gen_patched_blocks():
+        for block_corner, block_mask in iter_rle_block_masks(rle_ranges, 64):
+            block_box = (block_corner, 64 + block_corner)
+
+            if roi_sbm is not None:
+                roi_mask = roi_sbm.get_fullres_mask(block_box)
+                if invert_roi:
+                    roi_mask = ~roi_mask
+                block_mask[:] &= roi_mask
+
+            if not block_mask.any():
+                continue
+
+            block_voxels = fetch_labelarray_voxels(server, uuid, instance, block_box, supervoxels=True)
+            overwritten_labels.update(pd.unique(block_voxels[block_mask]))
+            block_voxels[block_mask] = new_label
+            yield (block_corner, block_voxels)
+
+    # The corners and blocks are consumed in lockstep,
+    # so tee() only needs to buffer one item at a time.
+    corners, blocks = tee(gen_patched_blocks())
+    corners = (corner for (corner, _) in corners)
+    blocks = (block for (_, block) in blocks)
+
+    with Timer("Sending patched blocks", logger):
+        stats = post_labelmap_blocks_pipelined( server, uuid, instance, corners, blocks, downres=not no_downres,
+                                                batch_size=400, progress=False )
+    logger.info(f"Upload stats:\n{stats.to_string()}")
 
     return overwritten_labels
         
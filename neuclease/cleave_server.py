@@ -21,6 +21,9 @@ from .cleave import cleave, InvalidCleaveMethodError
 from .dvid import DvidInstanceInfo
 from .util import Timer
 from neuclease.dvid._dvid import default_dvid_session
+from neuclease.dvid.metrics import DVID_METRICS, enable_dvid_metrics
+from neuclease.dvid.coalesce import DVID_SINGLE_FLIGHT
+from neuclease.dvid.labelmap import DVID_LABELINDEX_CACHE, enable_labelindex_cache
 
 # Globals
 MERGE_GRAPH = None
@@ -45,6 +48,9 @@ def main(debug_mode=False):
     parser.add_argument('--log-dir', required=False)
     parser.add_argument('--debug-export-dir', required=False, help="For debugging only. Enables export of certain intermediate results.")
     parser.add_argument('--mapping-file', required=False)
+    parser.add_argument('--mapping-snapshot', required=False,
+                        help="Path to a mapping snapshot (.npz). If it exists, the mapping is loaded from it and updated from the kafka log "
+                             "(much faster than fetching the complete mapping from DVID). Either way, the snapshot is then (re)written.")
     parser.add_argument('--primary-uuid', required=False,
                         help="Do not update the internal cached merge table mapping except for the given UUID. "
                              "(Prioritizes speed of the primary UUID over all others.)  Also, the merge graph is updated with split supervoxels for the given UUID.")
@@ -52,9 +58,20 @@ def main(debug_mode=False):
     parser.add_argument('--suspend-before-launch', action='store_true',
                         help="After loading the merge graph, suspend the process before launching the server, and await a SIGCONT. "
                              "Allows you to ALMOST hot-swap a running cleave server. (You can load the new merge graph before killing the old server).")
+    parser.add_argument('--record-dvid-metrics', action='store_true',
+                        help="Record per-endpoint timing statistics for all DVID requests, viewable via the /metrics endpoint.")
+    parser.add_argument('--labelindex-cache-gb', type=float, default=0.0,
+                        help="Keep up to this many GB of recently used labelindexes in memory (revalidated via each body's mutation ID), "
+                             "so repeated requests for the same body don't need to download its labelindex again.")
     parser.add_argument('--testing', action='store_true')
     args = parser.parse_args()
 
+    if args.record_dvid_metrics:
+        enable_dvid_metrics()
+
+    if args.labelindex_cache_gb:
+        enable_labelindex_cache(args.labelindex_cache_gb * 1e9)
+
     # This check is to ensure that this initialization is only run once,
     # even in the presence of the flask debug 'reloader'.
     if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
@@ -101,7 +118,7 @@ def main(debug_mode=False):
         if args.mapping_file:
             MERGE_GRAPH.apply_mapping(args.mapping_file)
         elif all(primary_instance_info):
-            MERGE_GRAPH.fetch_and_apply_mapping(*primary_instance_info)
+            MERGE_GRAPH.fetch_and_apply_mapping(*primary_instance_info, snapshot_path=args.mapping_snapshot)
 
         if args.suspend_before_launch:
             pid = os.getpid()
@@ -300,6 +317,29 @@ def _run_cleave(data):
     return ( cleave_response, HTTPStatus.OK )
 
 
+@app.route('/metrics')
+def get_metrics():
+    """
+    Return per-endpoint timing statistics for the requests
+    this server has sent to DVID (if --record-dvid-metrics was given),
+    the number of requests that were avoided via coalescing,
+    and the labelindex cache statistics (if --labelindex-cache-gb was given).
+    See ``neuclease.dvid.metrics``, ``neuclease.dvid.coalesce``,
+    and ``neuclease.dvid.labelmap._labelindexcache``.
+    
+    Query args:
+        reset:
+            If 'true', clear the statistics after returning them.
+    """
+    metrics = DVID_METRICS.to_dict()
+    metrics['coalesced'] = DVID_SINGLE_FLIGHT.stats()
+    metrics['labelindex_cache'] = DVID_LABELINDEX_CACHE.stats()
+    if request.args.get('reset', 'false').lower() == 'true':
+        DVID_METRICS.reset()
+        DVID_SINGLE_FLIGHT.reset()
+    return jsonify(metrics), HTTPStatus.OK
+
+
 @app.route('/primary-uuid')
 def get_primary_uuid():
     global MERGE_GRAPH
@@ -1,9 +1,14 @@
 from ._dvid import *
+from .metrics import *
+from .cache import *
+from .coalesce import *
+from .admission import *
 
 from .server import *
 from .repo import *
 from .node import *
 from .kafka import *
+from .kafkacache import *
 
 from .keyvalue import *
 from .annotation import *
@@ -1,43 +1,274 @@
 import os
 import copy
+import time
 import getpass
 import inspect
 import functools
 import threading
 from collections import namedtuple
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 from libdvid import DVIDNodeService
 
+from .cache import DVID_RESPONSE_CACHE
+from .admission import DVID_ADMISSION_CONTROL, is_throttled_request
+from .metrics import DVID_METRICS
+
 DEFAULT_DVID_SESSIONS = {}
+DEFAULT_DVID_SESSIONS_LOCK = threading.Lock()
 DEFAULT_DVID_NODE_SERVICES = {}
 DEFAULT_APPNAME = "neuclease"
 
+# One shared connection pool per process (keyed by pid).
+# See default_dvid_pool() and configure_default_dvid_pool()
+DEFAULT_DVID_POOLS = {}
+DEFAULT_DVID_POOL_SETTINGS = {
+    'max_connections': 32,  # per DVID server
+    'max_servers': 10,      # number of per-server pools to keep
+    'keepalive': True,
+    'idle_timeout': 300.0,  # seconds
+}
+
 # FIXME: This should be eliminated or at least renamed
 DvidInstanceInfo = namedtuple("DvidInstanceInfo", "server uuid instance")
 
+
+class DvidConnectionPool(HTTPAdapter):
+    """
+    A requests transport adapter that is shared by all of the default
+    DVID sessions in a process, so that every thread draws its connections
+    from the same pool instead of opening its own.
+
+    Internally, urllib3 keeps one connection pool per server.
+    Each per-server pool holds at most ``max_connections`` connections,
+    and requests will block (rather than open more connections) when all
+    of them are in use, which caps the number of concurrent requests
+    we send to any one DVID server.
+
+    Connections to a server which hasn't been used in ``idle_timeout``
+    seconds are closed (the next request to that server will reconnect).
+    """
+    __attrs__ = HTTPAdapter.__attrs__ + ['max_connections', 'max_servers', 'idle_timeout']
+
+    def __init__(self, max_connections=32, max_servers=10, idle_timeout=300.0):
+        self.max_connections = max_connections
+        self.max_servers = max_servers
+        self.idle_timeout = idle_timeout
+        self._last_used = {}
+        self._lock = threading.Lock()
+        super().__init__(pool_connections=max_servers, pool_maxsize=max_connections, pool_block=True)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._last_used = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, *args, **kwargs):
+        url = urlparse(request.url)
+        self._touch(url.scheme, url.hostname, url.port)
+        return super().send(request, *args, **kwargs)
+
+    def _touch(self, scheme, host, port):
+        """
+        Record the time of the most recent request to the given server,
+        and evict the pools of any servers which have been idle for too long.
+        """
+        if port is None:
+            port = {'https': 443}.get(scheme, 80)
+
+        now = time.time()
+        with self._lock:
+            self._last_used[(scheme, host, port)] = now
+            if self.idle_timeout is None:
+                return
+
+            for key, last_used in list(self._last_used.items()):
+                if now - last_used > self.idle_timeout:
+                    del self._last_used[key]
+                    self._evict(*key)
+
+    def _evict(self, scheme, host, port):
+        """
+        Close all connections to the given server.
+        """
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            if (key.key_scheme, key.key_host, key.key_port) == (scheme, host, port):
+                # The container closes the pool upon deletion.
+                del pools[key]
+
+
+class DvidSession(requests.Session):
+    """
+    A requests.Session which records each request it sends in
+    the global ``DVID_METRICS`` registry (if metrics are enabled),
+    answers GET requests for locked nodes from the global
+    ``DVID_RESPONSE_CACHE`` (if the cache is enabled),
+    and passes throttled requests through ``DVID_ADMISSION_CONTROL``.
+    See ``neuclease.dvid.metrics``, ``neuclease.dvid.cache``,
+    and ``neuclease.dvid.admission``.
+    """
+    def send(self, request, **kwargs):
+        cache_key = None
+        if DVID_RESPONSE_CACHE.enabled and not kwargs.get('stream', False):
+            cache_key = DVID_RESPONSE_CACHE.request_key(request)
+            if cache_key is not None:
+                r = DVID_RESPONSE_CACHE.get(cache_key, request)
+                if r is not None:
+                    return r
+
+        if DVID_ADMISSION_CONTROL.enabled and is_throttled_request(request):
+            server = urlparse(request.url).netloc
+            r = DVID_ADMISSION_CONTROL.send(server, lambda: self._send_and_record(request, **kwargs))
+        else:
+            r = self._send_and_record(request, **kwargs)
+
+        if cache_key is not None:
+            DVID_RESPONSE_CACHE.put(cache_key, r)
+        return r
+
+    def _send_and_record(self, request, **kwargs):
+        if not DVID_METRICS.enabled:
+            return super().send(request, **kwargs)
+
+        start = time.time()
+        try:
+            r = super().send(request, **kwargs)
+        except requests.RequestException:
+            DVID_METRICS.record(request.method, request.url, time.time() - start)
+            raise
+
+        if kwargs.get('stream', False):
+            # Don't consume the body on the caller's behalf.
+            nbytes = int(r.headers.get('Content-Length', 0))
+        else:
+            nbytes = len(r.content)
+
+        DVID_METRICS.record(request.method, request.url, time.time() - start, nbytes, r.status_code)
+        return r
+
+
+def default_dvid_pool():
+    """
+    Return the DvidConnectionPool which is shared by all
+    default DVID sessions in the current process.
+    """
+    pid = os.getpid()
+    with DEFAULT_DVID_SESSIONS_LOCK:
+        try:
+            pool = DEFAULT_DVID_POOLS[pid]
+        except KeyError:
+            settings = DEFAULT_DVID_POOL_SETTINGS
+            pool = DvidConnectionPool(settings['max_connections'], settings['max_servers'], settings['idle_timeout'])
+
+            # Never share sockets with a parent process
+            DEFAULT_DVID_POOLS.clear()
+            DEFAULT_DVID_POOLS[pid] = pool
+
+    return pool
+
+
+def configure_default_dvid_pool(max_connections=None, max_servers=None, keepalive=None, idle_timeout=None):
+    """
+    Change the settings of the connection pool that is used
+    by default for all DVID requests in this process.
+    Any argument left as None retains its current setting.
+
+    Note:
+        Sessions which were previously obtained via default_dvid_session()
+        will continue to use the old pool. Sessions obtained after this call
+        (including those used implicitly by ``@dvid_api_wrapper`` functions)
+        will use the new settings.
+
+    Args:
+        max_connections:
+            The maximum number of simultaneous connections to any single DVID server.
+            Additional requests will wait until a connection is available.
+
+        max_servers:
+            How many per-server connection pools to keep alive at once.
+
+        keepalive:
+            If False, ask the server to close each connection after each request.
+
+        idle_timeout:
+            Close all connections to a server after it hasn't been used for
+            this many seconds.  Use ``float('inf')`` to keep them open forever.
+    """
+    new_settings = { 'max_connections': max_connections,
+                     'max_servers': max_servers,
+                     'keepalive': keepalive,
+                     'idle_timeout': idle_timeout }
+
+    with DEFAULT_DVID_SESSIONS_LOCK:
+        for k, v in new_settings.items():
+            if v is not None:
+                DEFAULT_DVID_POOL_SETTINGS[k] = v
+
+        DEFAULT_DVID_POOLS.clear()
+        DEFAULT_DVID_SESSIONS.clear()
+
+
 def default_dvid_session(appname=DEFAULT_APPNAME, user=getpass.getuser()):
     """
     Return a default requests.Session() object that automatically appends the
     'u' and 'app' query string parameters to every request.
     The Session object is cached, so this function will return the same Session
     object if called again from the same thread with the same arguments.
+
+    All default sessions in a process share the same connection pool.
+    See ``configure_default_dvid_pool()``.
+
+    Requests sent via default sessions are recorded in ``DVID_METRICS``,
+    if metrics are enabled.  See ``neuclease.dvid.metrics``.
+    Responses from locked nodes are stored in ``DVID_RESPONSE_CACHE``,
+    if the cache is enabled.  See ``neuclease.dvid.cache``.
+    Throttled requests are subject to ``DVID_ADMISSION_CONTROL``.
+    See ``neuclease.dvid.admission``.
     """
     # Technically, request sessions are not threadsafe,
     # so we keep one for each thread.
+    # (But they all share a single connection pool.)
     thread_id = threading.current_thread().ident
     pid = os.getpid()
 
     try:
         s = DEFAULT_DVID_SESSIONS[(appname, user, thread_id, pid)]
     except KeyError:
-        s = requests.Session()
+        pool = default_dvid_pool()
+
+        s = DvidSession()
         s.params = { 'u': user, 'app': appname }
-        DEFAULT_DVID_SESSIONS[(appname, user, thread_id, pid)] = s
+        s.mount('http://', pool)
+        s.mount('https://', pool)
+        if not DEFAULT_DVID_POOL_SETTINGS['keepalive']:
+            s.headers['Connection'] = 'close'
+
+        with DEFAULT_DVID_SESSIONS_LOCK:
+            _drop_stale_sessions()
+            DEFAULT_DVID_SESSIONS[(appname, user, thread_id, pid)] = s
 
     return s
 
 
+def _drop_stale_sessions():
+    """
+    Helper for default_dvid_session().
+    Forget the sessions that were created for threads which no longer
+    exist (e.g. from a ThreadPool that has since been closed),
+    or which were inherited from a parent process.
+    (The caller must hold DEFAULT_DVID_SESSIONS_LOCK.)
+    """
+    pid = os.getpid()
+    live_threads = { t.ident for t in threading.enumerate() }
+    for key in list(DEFAULT_DVID_SESSIONS.keys()):
+        (_appname, _user, thread_id, session_pid) = key
+        if session_pid != pid or thread_id not in live_threads:
+            del DEFAULT_DVID_SESSIONS[key]
+
+
 def default_node_service(server, uuid, appname=DEFAULT_APPNAME, user=getpass.getuser()):
     """
     Return a DVIDNodeService for the given server and uuid.
@@ -0,0 +1,246 @@
+"""
+Client-side admission control for throttled DVID requests.
+
+When a request is sent with ``throttle=true`` in its query string
+(e.g. via ``fetch_labelmap_voxels(..., throttle=True)``), DVID may refuse
+it with a 503 if the server is too busy.  Rather than making every caller
+implement its own retry loop, all throttled requests sent via a default
+DVID session (i.e. every ``@dvid_api_wrapper`` function which wasn't given
+an explicit ``session``) are passed through a shared per-server limiter:
+
+- The number of throttled requests in flight to each server is limited.
+  The limit grows by one for each "window" of successful requests, and is
+  halved whenever the server reports that it is overloaded (AIMD, as in TCP).
+
+- Requests which fail with 503, 429, or a connection error are retried
+  after a randomized ("full jitter") exponential backoff delay.
+
+Since the limit is shared by all threads in the process, bulk jobs can
+simply use lots of threads (e.g. via ``compute_parallel()`` or
+``fetch_volume_in_chunks()``) and let the limiter find a sustainable
+request rate:
+
+    .. code-block:: python
+
+        from functools import partial
+        from neuclease.util import fetch_volume_in_chunks
+        from neuclease.dvid import fetch_labelmap_voxels, DVID_ADMISSION_CONTROL
+
+        fetch_fn = partial(fetch_labelmap_voxels, server, uuid, 'segmentation', throttle=True)
+        vol = fetch_volume_in_chunks(box, (256, 256, 256), fetch_fn, threads=32)
+        print(DVID_ADMISSION_CONTROL.stats())
+"""
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse, parse_qsl
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Response codes which indicate that the server is too busy.
+OVERLOADED_STATUSES = (429, 503)
+
+
+class AimdLimiter:
+    """
+    Concurrency limiter with an additive-increase/multiplicative-decrease limit.
+    """
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, decrease_factor=0.5):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+        # Incremented each time the limit is decreased.
+        # Failures of requests that were admitted before the most recent
+        # decrease don't decrease the limit again.
+        self._generation = 0
+
+        self.admitted = 0
+        self.overloaded = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """
+        Wait until a slot is available, and take it.
+        Returns a token to pass to ``release()``.
+        """
+        start = time.time()
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+            self.admitted += 1
+            self.wait_seconds += time.time() - start
+            return self._generation
+
+    def release(self, token, overloaded=False):
+        """
+        Release a slot obtained via ``acquire()``, and adjust the limit:
+        increase it (by 1/limit) if the request succeeded,
+        or decrease it if the server was overloaded.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.overloaded += 1
+                if token == self._generation:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._generation += 1
+            elif overloaded is False:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return { 'limit': self.limit,
+                     'in_flight': self.in_flight,
+                     'admitted': self.admitted,
+                     'overloaded': self.overloaded,
+                     'wait_seconds': self.wait_seconds }
+
+
+class AdmissionControl:
+    """
+    Per-server AIMD limiters, plus retry-with-backoff logic.
+    See ``neuclease.dvid.admission``.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.initial_limit = 8
+        self.min_limit = 1
+        self.max_limit = 64
+        self.max_retries = 10
+        self.backoff_base = 0.1
+        self.backoff_max = 30.0
+
+        self._lock = threading.Lock()
+        self._limiters = {}
+        self._retries = {}
+
+    def limiter(self, server):
+        with self._lock:
+            try:
+                return self._limiters[server]
+            except KeyError:
+                lim = AimdLimiter(self.initial_limit, self.min_limit, self.max_limit)
+                self._limiters[server] = lim
+                self._retries[server] = 0
+                return lim
+
+    def send(self, server, send_fn):
+        """
+        Call ``send_fn()`` (which must return a ``requests.Response``)
+        once a slot for the given server is available.
+        If the server reports that it is overloaded (or the connection fails),
+        wait for a randomized backoff period and try again, up to ``max_retries`` times.
+
+        Returns:
+            The final response, which may still be a 503/429 if retries were exhausted.
+        """
+        limiter = self.limiter(server)
+        for attempt in range(self.max_retries + 1):
+            token = limiter.acquire()
+            try:
+                r = send_fn()
+            except requests.ConnectionError:
+                limiter.release(token, True)
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(server, attempt)
+                continue
+            except BaseException:
+                limiter.release(token, None)
+                raise
+
+            overloaded = r.status_code in OVERLOADED_STATUSES
+            limiter.release(token, overloaded)
+            if not overloaded or attempt == self.max_retries:
+                return r
+
+            r.close()
+            self._backoff(server, attempt, r.headers.get('Retry-After'))
+
+    def _backoff(self, server, attempt, retry_after=None):
+        with self._lock:
+            self._retries[server] += 1
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+
+        logger.debug(f"DVID server {server} is busy. Retrying in {delay:.2f}s")
+        time.sleep(delay)
+
+    def stats(self):
+        """
+        Return a dict of per-server statistics, including
+        the current concurrency limit and the number of retries.
+        """
+        with self._lock:
+            limiters = dict(self._limiters)
+            retries = dict(self._retries)
+
+        stats = {}
+        for server, lim in sorted(limiters.items()):
+            stats[server] = lim.stats()
+            stats[server]['retries'] = retries[server]
+        return stats
+
+    def reset(self):
+        """
+        Forget all limiters and statistics.
+        """
+        with self._lock:
+            self._limiters = {}
+            self._retries = {}
+
+
+DVID_ADMISSION_CONTROL = AdmissionControl()
+
+
+def configure_dvid_admission_control(enabled=None, initial_limit=None, min_limit=None, max_limit=None,
+                                     max_retries=None, backoff_base=None, backoff_max=None):
+    """
+    Change the settings of the global ``DVID_ADMISSION_CONTROL``.
+    Any argument left as None retains its current setting.
+    Per-server limiters will be re-created with the new settings.
+
+    Args:
+        enabled:
+            If False, throttled requests are sent as-is, and 503 errors are the caller's problem.
+        initial_limit, min_limit, max_limit:
+            Bounds on the number of throttled requests in flight to any single server.
+        max_retries:
+            How many times to retry a request before giving up.
+        backoff_base, backoff_max:
+            The retry delay is chosen at random from ``[0, min(backoff_max, backoff_base * 2**attempt))``
+    """
+    settings = { 'enabled': enabled,
+                 'initial_limit': initial_limit,
+                 'min_limit': min_limit,
+                 'max_limit': max_limit,
+                 'max_retries': max_retries,
+                 'backoff_base': backoff_base,
+                 'backoff_max': backoff_max }
+
+    for k, v in settings.items():
+        if v is not None:
+            setattr(DVID_ADMISSION_CONTROL, k, v)
+    DVID_ADMISSION_CONTROL.reset()
+
+
+def is_throttled_request(request):
+    """
+    Return True if the given (prepared) request has ``throttle=true`` in its query string.
+    """
+    query = urlparse(request.url).query
+    return ('throttle', 'true') in parse_qsl(query)
@@ -0,0 +1,409 @@
+"""
+asyncio variants of some of our DVID API wrapper functions,
+for workloads that must issue many thousands of small requests
+(e.g. fetching the labelindexes or tarfiles for 100k bodies).
+
+All requests share a single connection pool (one ``AsyncDvidSession``),
+and the number of requests in flight at any time is bounded.
+The responses are parsed with the same functions that the synchronous
+wrappers use, so the results are identical.
+
+Note:
+    This module requires ``aiohttp``, which is an optional dependency of neuclease.
+    It is not imported by ``neuclease.dvid`` automatically.
+    (The function names here deliberately match their synchronous counterparts.)
+
+Example:
+
+    .. code-block:: python
+
+        from functools import partial
+        from neuclease.dvid.aio import compute_async, fetch_labelindex
+
+        f = partial(fetch_labelindex, server, uuid, 'segmentation', format='pandas')
+        labelindexes = compute_async(f, bodies, max_concurrency=64)
+"""
+import time
+import asyncio
+import getpass
+import inspect
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+import aiohttp
+import numpy as np
+
+from ..util import tqdm_proxy
+from ._dvid import DEFAULT_APPNAME
+from .metrics import DVID_METRICS
+from .rle import parse_rle_response
+from .tarsupervoxels import tar_to_dict
+from .labelmap.labelops_pb2 import LabelIndex, LabelIndices
+from .labelmap._labelindex import parse_labelindex, parse_labelindices, labelindex_arrays_to_pandas
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDvidSession:
+    """
+    Wraps an ``aiohttp.ClientSession`` whose connections are shared by all
+    requests sent through it, and limits the number of concurrent requests.
+    Like ``default_dvid_session()``, it appends the 'u' and 'app' query
+    string parameters to every request.
+
+    Must be used as an async context manager:
+
+        .. code-block:: python
+
+            async with AsyncDvidSession(max_concurrency=64) as session:
+                li = await fetch_labelindex(server, uuid, 'segmentation', 123, session=session)
+    """
+    def __init__(self, max_concurrency=32, max_connections=None, appname=DEFAULT_APPNAME, user=getpass.getuser(), timeout=None):
+        """
+        Args:
+            max_concurrency:
+                Maximum number of requests in flight at once.
+
+            max_connections:
+                Maximum number of open connections (across all servers).
+                By default, equal to max_concurrency.
+
+            appname, user:
+                Sent to DVID via the query string, for DVID's logs.
+
+            timeout:
+                Total timeout (in seconds) for each request, or None for no timeout.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections or max_concurrency
+        self.params = { 'u': user, 'app': appname }
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def request(self, method, url, *, params=None, json=None, data=None):
+        """
+        Send a request and return the response body (bytes).
+        If the response has an error status, ``aiohttp.ClientResponseError``
+        is raised, with the (short) error response body appended to its message.
+        """
+        assert self._session is not None, \
+            "AsyncDvidSession must be used within 'async with'"
+
+        all_params = dict(self.params)
+        all_params.update(params or {})
+
+        async with self._semaphore:
+            start = time.time()
+            try:
+                async with self._session.request(method, url, params=all_params, json=json, data=data) as r:
+                    content = await r.read()
+            except aiohttp.ClientError:
+                if DVID_METRICS.enabled:
+                    DVID_METRICS.record(method, url, time.time() - start)
+                raise
+
+            if DVID_METRICS.enabled:
+                DVID_METRICS.record(method, url, time.time() - start, len(content), r.status)
+
+        if r.status >= 400:
+            # Same as dvid_api_wrapper: DVID error messages are often helpful.
+            msg = f"Error accessing {method} {r.url}\n{r.reason}"
+            if content and len(content) <= 200:
+                msg += "\n" + content.decode('utf-8', errors='replace')
+            raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status, message=msg, headers=r.headers)
+
+        return content
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+def async_dvid_api_wrapper(f):
+    """
+    Decorator for coroutine functions whose first arg is a dvid server address,
+    and accepts 'session' as a keyword-only argument.
+    The async counterpart to ``dvid_api_wrapper``:
+
+    - If the server address begins with 'http://', that prefix is stripped from it.
+    - If 'session' was not provided by the caller, a temporary AsyncDvidSession is used.
+      (For many requests, provide your own session or use ``compute_async()``.)
+    """
+    assert inspect.iscoroutinefunction(f), \
+        f"Cannot wrap {f.__name__}: it is not a coroutine function"
+    argspec = inspect.getfullargspec(f)
+    assert 'session' in argspec.kwonlyargs, \
+        f"Cannot wrap {f.__name__}: DVID API wrappers must accept 'session' as a keyword-only argument."
+
+    @functools.wraps(f)
+    async def wrapper(server, *args, session=None, **kwargs):
+        assert isinstance(server, str)
+        if server.startswith('http://'):
+            server = server[len('http://'):]
+
+        if session is not None:
+            return await f(server, *args, **kwargs, session=session)
+
+        async with AsyncDvidSession() as session:
+            return await f(server, *args, **kwargs, session=session)
+
+    return wrapper
+
+
+def compute_async(func, iterable, max_concurrency=32, *, ordered=True, leave_progress=False,
+                  total=None, starmap=False, session_kwargs={}):
+    """
+    The asyncio counterpart to ``neuclease.util.compute_parallel()``.
+
+    Call the given async wrapper function for every item in the given iterable,
+    using a single shared AsyncDvidSession, and return the list of results.
+    This function is synchronous; it runs its own event loop.
+    (If called from within a running event loop, e.g. a jupyter notebook,
+    the event loop is run in a separate thread.)
+
+    Only a bounded number of items are pulled from the iterable at a time,
+    so it may be a generator.
+
+    Args:
+        func:
+            An ``@async_dvid_api_wrapper`` function (or a partial of one),
+            which will be called as ``await func(item, session=session)``.
+
+        iterable:
+            The items to process.
+
+        max_concurrency:
+            Maximum number of requests in flight at once.
+
+        ordered:
+            If True, return results in the same order as the input.
+            Otherwise, return results in the order in which they completed.
+
+        leave_progress:
+            Whether to leave the progress bar on screen after completion.
+
+        total:
+            Optional. Specify the total number of items, for progress reporting.
+            Not necessary if your iterable defines __len__.
+
+        starmap:
+            If True, each item should be a tuple, which will be unpacked into
+            the arguments to the given function.
+
+        session_kwargs:
+            Extra constructor arguments for AsyncDvidSession.
+    """
+    if total is None and hasattr(iterable, '__len__'):
+        total = len(iterable)
+
+    async def _call(i, item, session):
+        if starmap:
+            return i, await func(*item, session=session)
+        return i, await func(item, session=session)
+
+    async def _compute():
+        results = []
+        pending = set()
+        progress_kwargs = {'leave': leave_progress, 'logger': logger}
+        if total is not None:
+            progress_kwargs['total'] = total
+        progress = tqdm_proxy(**progress_kwargs)
+
+        def collect(done):
+            for task in done:
+                results.append(task.result())
+            progress.update(len(done))
+
+        async with AsyncDvidSession(max_concurrency, **session_kwargs) as session:
+            try:
+                for i, item in enumerate(iterable):
+                    # Don't create all tasks at once; keep a bounded window of them.
+                    if len(pending) >= 2*max_concurrency:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(asyncio.ensure_future(_call(i, item, session)))
+
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+            finally:
+                for task in pending:
+                    task.cancel()
+                progress.close()
+
+        if ordered:
+            results.sort(key=lambda i_r: i_r[0])
+        return [r for (_i, r) in results]
+
+    return run_sync(_compute())
+
+
+def run_sync(coro):
+    """
+    Run the given coroutine to completion and return its result,
+    even if the caller is already running inside an event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # We're already inside an event loop (e.g. jupyter),
+    # so run a separate loop in a separate thread.
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+##
+## API wrappers
+## (See the synchronous versions for full documentation.)
+##
+
+@async_dvid_api_wrapper
+async def fetch_generic_json(url, json=None, *, session=None):
+    content = await session.get('http://' + url, json=json)
+    return ujson.loads(content)
+
+
+@async_dvid_api_wrapper
+async def fetch_mutation_id(server, uuid, instance, body_id, *, session=None):
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_mutation_id()``
+    """
+    response = await fetch_generic_json(f'http://{server}/api/node/{uuid}/{instance}/lastmod/{body_id}', session=session)
+    return response["mutation id"]
+
+
+@async_dvid_api_wrapper
+async def fetch_supervoxels(server, uuid, instance, body_id, *, session=None):
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_supervoxels()``
+    """
+    url = f'http://{server}/api/node/{uuid}/{instance}/supervoxels/{body_id}'
+    supervoxels = np.array(await fetch_generic_json(url, session=session), np.uint64)
+    supervoxels.sort()
+    return supervoxels
+
+
+@async_dvid_api_wrapper
+async def fetch_labels(server, uuid, instance, coordinates_zyx, supervoxels=False, scale=0, *, session=None):
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_labels()``
+    """
+    coordinates_zyx = np.asarray(coordinates_zyx, np.int32)
+    assert coordinates_zyx.ndim == 2 and coordinates_zyx.shape[1] == 3
+
+    params = {}
+    if supervoxels:
+        params['supervoxels'] = str(bool(supervoxels)).lower()
+    if scale != 0:
+        params['scale'] = str(scale)
+
+    coords_xyz = coordinates_zyx[:, ::-1].tolist()
+    content = await session.get(f'http://{server}/api/node/{uuid}/{instance}/labels', json=coords_xyz, params=params)
+    return np.array(ujson.loads(content), np.uint64)
+
+
+@async_dvid_api_wrapper
+async def fetch_sparsevol_rles(server, uuid, instance, label, supervoxels=False, scale=0, *, session=None):
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_sparsevol_rles()``
+    """
+    supervoxels = str(bool(supervoxels)).lower()
+    url = f'http://{server}/api/node/{uuid}/{instance}/sparsevol/{label}?supervoxels={supervoxels}&scale={scale}'
+    return await session.get(url)
+
+
+@async_dvid_api_wrapper
+async def fetch_sparsevol(server, uuid, instance, label, supervoxels=False, scale=0, dtype=np.int32, *, format='coords', session=None): # @ReservedAssignment
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_sparsevol()``.
+
+    Args:
+        format:
+            Either 'coords', 'rle', or 'ranges'. See ``parse_rle_response()``.
+    """
+    rles = await fetch_sparsevol_rles(server, uuid, instance, label, supervoxels, scale, session=session)
+    return parse_rle_response(rles, dtype, format)
+
+
+@async_dvid_api_wrapper
+async def fetch_labelindex(server, uuid, instance, label, format='protobuf', *, session=None): # @ReservedAssignment
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_labelindex()``
+    """
+    assert format in ('protobuf', 'arrays', 'pandas', 'raw')
+    content = await session.get(f'http://{server}/api/node/{uuid}/{instance}/index/{label}')
+
+    if format == 'raw':
+        return content
+    if format == 'arrays':
+        return parse_labelindex(content)
+    if format == 'pandas':
+        return labelindex_arrays_to_pandas(parse_labelindex(content))
+
+    labelindex = LabelIndex()
+    labelindex.ParseFromString(content)
+    return labelindex
+
+
+@async_dvid_api_wrapper
+async def fetch_labelindices(server, uuid, instance, labels, *, format='protobuf', session=None): # @ReservedAssignment
+    """
+    Async version of ``neuclease.dvid.labelmap.fetch_labelindices()``
+    """
+    assert format in ('protobuf', 'list-of-protobuf', 'arrays', 'pandas', 'raw')
+    if isinstance(labels, np.ndarray):
+        labels = labels.tolist()
+    elif not isinstance(labels, list):
+        labels = list(labels)
+
+    content = await session.get(f'http://{server}/api/node/{uuid}/{instance}/indices', json=labels)
+
+    if format == 'raw':
+        return content
+    if format == 'arrays':
+        return parse_labelindices(content)
+    if format == 'pandas':
+        return list(map(labelindex_arrays_to_pandas, parse_labelindices(content)))
+
+    labelindices = LabelIndices()
+    labelindices.ParseFromString(content)
+    if format == 'protobuf':
+        return labelindices
+    if format == 'list-of-protobuf':
+        return list(labelindices.indices)
+
+
+@async_dvid_api_wrapper
+async def fetch_tarfile(server, uuid, instance, body_id, *, format='bytes', exts=None, session=None): # @ReservedAssignment
+    """
+    Async version of ``neuclease.dvid.tarsupervoxels.fetch_tarfile()``.
+
+    Args:
+        format:
+            Either 'bytes' (the tarfile contents) or 'dict' (see ``tar_to_dict()``).
+        exts:
+            If format='dict', only files with the given extensions will be returned.
+    """
+    assert format in ('bytes', 'dict')
+    content = await session.get(f'http://{server}/api/node/{uuid}/{instance}/tarfile/{body_id}')
+    if format == 'bytes':
+        return content
+    return tar_to_dict(content, exts)
@@ -0,0 +1,278 @@
+"""
+Opt-in on-disk cache for GET responses from locked (i.e. immutable) DVID nodes.
+
+Data in a committed (locked) node can never change, so there's no reason to
+download it twice.  When the cache is enabled, every successful GET sent via a
+default DVID session (i.e. every ``@dvid_api_wrapper`` function which wasn't
+given an explicit ``session``) to a locked node is stored on disk, and subsequent
+identical requests are answered from disk without contacting the server.
+
+Requests to unlocked nodes are never cached.
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import enable_dvid_response_cache, DVID_RESPONSE_CACHE
+
+        enable_dvid_response_cache('/scratch/dvid-cache', max_bytes=50e9, endpoints=['mappings', 'indices', 'roi'])
+        mapping = fetch_mappings(server, locked_uuid, 'segmentation')  # slow
+        mapping = fetch_mappings(server, locked_uuid, 'segmentation')  # fast
+        print(DVID_RESPONSE_CACHE.stats())
+"""
+import os
+import struct
+import hashlib
+import logging
+import threading
+from urllib.parse import urlparse, parse_qsl
+
+import ujson
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .metrics import endpoint_name
+
+logger = logging.getLogger(__name__)
+
+# Query parameters which are only used for DVID's logs,
+# and therefore don't affect the response.
+_IGNORED_PARAMS = ('u', 'app')
+
+
+class DvidResponseCache:
+    """
+    Size-bounded, least-recently-used cache of DVID responses, stored on disk.
+
+    Each response is stored in its own file, named by a hash of the request
+    (server, uuid, instance, endpoint, query parameters, and body).
+    Files are evicted in order of their last access time once the total size
+    of the cache exceeds ``max_bytes``.  The cache directory may be shared by
+    several processes, but each process only accounts for its own writes when
+    deciding whether to evict, so the bound is approximate in that case.
+    """
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 0
+        self.endpoints = None
+        self.lock_recheck_seconds = 60.0
+
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._locked_nodes = {}
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def configure(self, directory, max_bytes=10e9, endpoints=None):
+        """
+        Args:
+            directory:
+                Where to store the cached responses, or None to disable the cache.
+            max_bytes:
+                Approximate maximum total size of the cache.
+            endpoints:
+                Optional. A list of endpoint names (as determined by
+                ``neuclease.dvid.metrics.endpoint_name()``, e.g. 'mappings' or 'blocks')
+                whose responses may be cached.  If not provided, all endpoints are cached.
+        """
+        with self._lock:
+            self.directory = directory
+            self.max_bytes = int(max_bytes)
+            self.endpoints = None if endpoints is None else set(endpoints)
+            self._locked_nodes = {}
+            self._total_bytes = 0
+
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+                self._total_bytes = sum(size for (_path, size, _atime) in self._files())
+
+    def stats(self):
+        with self._lock:
+            return { 'hits': self._hits,
+                     'misses': self._misses,
+                     'stores': self._stores,
+                     'evictions': self._evictions,
+                     'bytes': self._total_bytes }
+
+    def clear(self):
+        """
+        Delete all cached responses.
+        """
+        with self._lock:
+            for path, _size, _atime in self._files():
+                os.unlink(path)
+            self._total_bytes = 0
+
+    def request_key(self, request):
+        """
+        Return the cache key for the given request,
+        or None if the request is not eligible for caching.
+
+        Only GET requests to /api/node/<uuid>/<instance>/<endpoint>
+        for allowed endpoints in a locked node are eligible.
+        """
+        if request.method != 'GET':
+            return None
+
+        url = urlparse(request.url)
+        parts = url.path.strip('/').split('/')
+        if len(parts) < 5 or parts[:2] != ['api', 'node']:
+            return None
+
+        endpoint = endpoint_name(request.url)
+        if self.endpoints is not None and endpoint not in self.endpoints:
+            return None
+
+        uuid = parts[2]
+        if not self._is_locked(url.netloc, uuid):
+            return None
+
+        params = sorted((k, v) for (k, v) in parse_qsl(url.query, keep_blank_values=True)
+                        if k not in _IGNORED_PARAMS)
+
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        h = hashlib.sha256()
+        h.update(f'{url.netloc}{url.path}?{params}'.encode('utf-8'))
+        h.update(b'\0')
+        h.update(body)
+        return h.hexdigest()
+
+    def get(self, key, request):
+        """
+        Return the cached response for the given key, or None.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header_size, = struct.unpack('<I', f.read(4))
+                header = ujson.loads(f.read(header_size))
+                content = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._misses += 1
+            return None
+
+        # Update the access time, for LRU eviction.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self._hits += 1
+
+        r = requests.Response()
+        r.status_code = header['status']
+        r.reason = header['reason']
+        r.headers = CaseInsensitiveDict(header['headers'])
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.url = request.url
+        r.request = request
+        r._content = content
+        r._content_consumed = True
+        return r
+
+    def put(self, key, response):
+        """
+        Store the given response under the given key (if the response was successful).
+        """
+        if response.status_code != 200:
+            return
+
+        header = ujson.dumps({ 'status': response.status_code,
+                               'reason': response.reason,
+                               'headers': dict(response.headers) }).encode('utf-8')
+
+        content = response.content
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file and then rename it,
+        # so concurrent readers never see a partial file.
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._stores += 1
+            self._total_bytes += 4 + len(header) + len(content)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Delete the least-recently-used files until the cache is
+        below 90% of its maximum size. (The caller must hold self._lock.)
+        """
+        files = sorted(self._files(), key=lambda f: f[2])
+        total = sum(size for (_path, size, _atime) in files)
+        for path, size, _atime in files:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._evictions += 1
+        self._total_bytes = total
+
+    def _files(self):
+        """
+        List (path, size, access time) for all files in the cache.
+        """
+        files = []
+        for parent, _dirs, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((path, st.st_size, max(st.st_atime, st.st_mtime)))
+        return files
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _is_locked(self, server, uuid):
+        # Avoid a circular import
+        from .repo import is_locked_memoized
+        return is_locked_memoized(server, uuid, self._locked_nodes, self._lock, self.lock_recheck_seconds)
+
+
+DVID_RESPONSE_CACHE = DvidResponseCache()
+
+
+def enable_dvid_response_cache(directory, max_bytes=10e9, endpoints=None):
+    """
+    Start caching responses from locked DVID nodes on disk,
+    for all requests sent via default DVID sessions.
+    See ``DvidResponseCache.configure()`` for argument details.
+
+    Returns:
+        The global ``DVID_RESPONSE_CACHE``
+    """
+    DVID_RESPONSE_CACHE.configure(directory, max_bytes, endpoints)
+    return DVID_RESPONSE_CACHE
+
+
+def disable_dvid_response_cache():
+    """
+    Stop caching DVID responses.  (Files already on disk are left as they are.)
+    """
+    DVID_RESPONSE_CACHE.configure(None)
@@ -0,0 +1,174 @@
+"""
+Request coalescing ("single-flight") for DVID reads.
+
+When several threads call the same read-only API wrapper with identical
+arguments at the same time (e.g. several proofreaders clicking the same body
+in the cleave server), only the first call actually sends a request to DVID.
+The other callers wait for it to finish and receive (a copy of) its result.
+
+Coalescing only merges calls which are in flight simultaneously;
+nothing is cached after a call completes.
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import DVID_SINGLE_FLIGHT, fetch_labelindex
+
+        # Opt out for a single call
+        li = fetch_labelindex(server, uuid, 'segmentation', body, coalesce=False)
+
+        # Opt out globally
+        DVID_SINGLE_FLIGHT.enabled = False
+
+        # How many requests have been saved?
+        print(DVID_SINGLE_FLIGHT.stats())
+"""
+import copy
+import functools
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+
+class SingleFlight:
+    """
+    Thread-safe registry of in-flight calls, keyed by function and arguments.
+    """
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._calls = defaultdict(int)
+        self._coalesced = defaultdict(int)
+
+    def call(self, name, key, f, *args, **kwargs):
+        """
+        Call ``f(*args, **kwargs)``, unless a call with the same
+        key is already in flight, in which case wait for that call
+        to complete and return a copy of its result (or raise its exception).
+        """
+        with self._lock:
+            self._calls[name] += 1
+            try:
+                inflight = self._inflight[key]
+            except KeyError:
+                inflight = self._inflight[key] = _InflightCall()
+                is_leader = True
+            else:
+                self._coalesced[name] += 1
+                inflight.followers += 1
+                is_leader = False
+
+        if not is_leader:
+            inflight.done.wait()
+            if inflight.exception is not None:
+                raise inflight.exception
+
+            # Every caller gets its own copy, in case it modifies the result.
+            # (The snapshot is never returned to any caller, so it can't be modified while we copy it.)
+            return copy.deepcopy(inflight.result)
+
+        result = None
+        try:
+            result = f(*args, **kwargs)
+            return result
+        except BaseException as ex:
+            inflight.exception = ex
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                followers = inflight.followers
+
+            # No more followers can join now, so we only need a snapshot if some already have.
+            # It must be taken before our own caller can modify the result.
+            if followers and inflight.exception is None:
+                inflight.result = copy.deepcopy(result)
+            inflight.done.set()
+
+    def stats(self):
+        """
+        Return a dict of ``{function_name: {'calls': N, 'coalesced': M}}``,
+        where 'coalesced' is the number of calls which did not need to send
+        their own request, because an identical request was already in flight.
+        """
+        with self._lock:
+            return { name: { 'calls': self._calls[name], 'coalesced': self._coalesced[name] }
+                     for name in sorted(self._calls.keys()) }
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._coalesced.clear()
+
+
+class _InflightCall:
+    """
+    Helper for SingleFlight. The eventual outcome of a single in-flight call.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.followers = 0
+
+
+DVID_SINGLE_FLIGHT = SingleFlight()
+
+
+def coalesced(f=None, *, unless=None):
+    """
+    Decorator for read-only ``@dvid_api_wrapper`` functions.
+    Concurrent calls with identical arguments share a single request to DVID.
+    See ``neuclease.dvid.coalesce``.
+
+    The decorated function accepts an extra keyword argument ``coalesce``
+    (default True), which can be used to opt out of coalescing for a single call.
+    The ``session`` argument (if any) does not affect the coalescing key.
+    Calls with arguments that can't be hashed (e.g. DataFrames) are never coalesced.
+
+    Args:
+        unless:
+            Optional. A function ``unless(kwargs) -> bool`` for calls which must not
+            be coalesced, e.g. because they return a generator, which can't be shared.
+            Example: ``@coalesced(unless=lambda kwargs: kwargs.get('format') == 'iterator')``
+    """
+    if f is None:
+        return functools.partial(coalesced, unless=unless)
+
+    name = f.__name__
+
+    @functools.wraps(f)
+    def wrapper(*args, coalesce=True, **kwargs):
+        if not (coalesce and DVID_SINGLE_FLIGHT.enabled) or (unless is not None and unless(kwargs)):
+            return f(*args, **kwargs)
+
+        key_kwargs = {k: v for k,v in kwargs.items() if k != 'session'}
+        try:
+            key = (f.__module__, f.__qualname__, _freeze(args), _freeze(key_kwargs))
+            hash(key)
+        except TypeError:
+            return f(*args, **kwargs)
+
+        return DVID_SINGLE_FLIGHT.call(name, key, f, *args, **kwargs)
+
+    return wrapper
+
+
+def _freeze(x):
+    """
+    Convert the given argument into a hashable equivalent.
+    Raises TypeError if that isn't possible.
+    """
+    if isinstance(x, np.ndarray):
+        return ('ndarray', x.dtype.str, x.shape, x.tobytes())
+    if isinstance(x, (list, tuple)):
+        return (type(x).__name__, *map(_freeze, x))
+    if isinstance(x, dict):
+        return ('dict', *sorted((k, _freeze(v)) for k,v in x.items()))
+    if isinstance(x, type):
+        return x
+    hash(x)
+    return x
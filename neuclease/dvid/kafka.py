@@ -11,6 +11,7 @@ from . import dvid_api_wrapper
 from .server import fetch_server_info
 from .repo import fetch_repo_dag
 from .node import fetch_instance_info
+from .kafkacache import DVID_KAFKA_LOG_CACHE
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +63,8 @@ def read_kafka_messages(server, uuid, instance, action_filter=None, dag_filter='
             Note: If you re-use group IDs, then subsequent calls to this function will
                   not yield repeated messages.  The log will resume where it left off
                   from the previous call.
+            Note: If the kafka log cache is enabled (see ``enable_kafka_log_cache()``),
+                  the cache is only used if no group_id is given.
         
         consumer_timeout:
             Seconds to timeout (after which we assume we've read all messages).
@@ -106,7 +109,10 @@ def read_kafka_messages(server, uuid, instance, action_filter=None, dag_filter='
     topic = f'{topic_prefix}dvidrepo-{root_uuid}-data-{data_uuid}'
     logger.info(f"Reading kafka messages for {topic} from {kafka_servers}")
     with Timer() as timer:
-        records = _read_complete_kafka_log(topic, kafka_servers, group_id, consumer_timeout)
+        if DVID_KAFKA_LOG_CACHE.enabled and group_id is None:
+            records = DVID_KAFKA_LOG_CACHE.read(topic, kafka_servers, consumer_timeout)
+        else:
+            records = _read_complete_kafka_log(topic, kafka_servers, group_id, consumer_timeout)
     logger.info(f"Reading {len(records)} kafka messages took {timer.seconds} seconds")
 
     # Extract and parse JSON values for easy filtering.
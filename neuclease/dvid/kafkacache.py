@@ -0,0 +1,379 @@
+"""
+Opt-in local (on-disk) copy of DVID's kafka logs, for ``read_kafka_messages()``.
+
+Without the cache, every call to ``read_kafka_messages()`` downloads the
+entire kafka topic of a DVID instance, starting from offset 0.
+When the cache is enabled, the raw records of each topic are stored in an
+append-only file (one per partition), and each call only downloads the
+records which were appended to the topic since the previous call
+(in this process or any other process which uses the same cache directory).
+
+The on-disk layout is:
+
+    .. code-block:: text
+
+        <directory>/<topic>/<partition>.log    The records, each stored as:
+                                               int64 offset, int64 timestamp, uint32 N, N bytes of value
+        <directory>/<topic>/<partition>.idx    For each record in the log: uint64 offset, start, stop,
+                                               where [start, stop) is the record's position in the log file.
+        <directory>/<topic>/.lock              Lock file, held while a process appends to the topic's files.
+
+Records are always appended to the log before their index entries, so if a process
+is interrupted while appending, any trailing data which isn't listed in the index is ignored
+(and overwritten during the next sync).
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import enable_kafka_log_cache, DVID_KAFKA_LOG_CACHE
+
+        enable_kafka_log_cache('/scratch/kafka-cache')
+        msgs = read_kafka_messages(server, uuid, 'segmentation')  # slow
+        msgs = read_kafka_messages(server, uuid, 'segmentation')  # fast
+        print(DVID_KAFKA_LOG_CACHE.stats())
+"""
+import os
+import time
+import fcntl
+import struct
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#: A record from the kafka log, with the same attributes as
+#: the pykafka ``Message`` fields we use.
+KafkaLogRecord = namedtuple('KafkaLogRecord', 'partition_id offset timestamp value')
+
+_RECORD_HEADER = struct.Struct('<qqI')
+_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('start', '<u8'), ('stop', '<u8')])
+
+
+class KafkaLogCache:
+    """
+    Local, append-only copy of the records in one or more kafka topics.
+    See the module docstring for details.
+    """
+    def __init__(self):
+        self.directory = None
+
+        self._lock = threading.Lock()
+        self._syncs = 0
+        self._records_fetched = 0
+        self._records_read = 0
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def configure(self, directory):
+        """
+        Args:
+            directory:
+                Where to store the cached kafka logs, or None to disable the cache.
+        """
+        with self._lock:
+            self.directory = directory
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        with self._lock:
+            return { 'syncs': self._syncs,
+                     'records_fetched': self._records_fetched,
+                     'records_read': self._records_read }
+
+    def read(self, topic, kafka_servers, timeout_seconds=2.0):
+        """
+        Download any new records of the given topic from the kafka server(s),
+        and then return all records of the topic (from the local copy).
+
+        Returns:
+            list of KafkaLogRecord
+        """
+        self.sync(topic, _PyKafkaSource(topic, kafka_servers, timeout_seconds))
+        return self.records(topic)
+
+    def sync(self, topic, source):
+        """
+        Append the records which aren't yet stored locally to the local copy of the topic.
+
+        Args:
+            topic:
+                Kafka topic name
+            source:
+                An object with two methods, which provides access to the topic:
+
+                - ``latest_offsets()``: Returns ``{partition_id: offset}``,
+                  where offset is the offset of the NEXT record which will
+                  be written to the partition (i.e. the last offset + 1).
+
+                - ``read(start_offsets)``: Given ``{partition_id: offset}``,
+                  return (or yield) all records of the listed partitions from the given
+                  offsets onwards (at least through the latest offsets, as listed above).
+                  Records must have attributes for ``partition_id``, ``offset``,
+                  ``timestamp``, and ``value`` (bytes), and the records of each partition
+                  must be listed in order.  (Records from before the requested offsets
+                  are permitted, but ignored.)
+
+        Returns:
+            The number of new records.
+        """
+        assert self.enabled, "The kafka log cache is not enabled"
+        topic_dir = self._topic_dir(topic)
+        os.makedirs(topic_dir, exist_ok=True)
+
+        with open(f'{topic_dir}/.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                latest_offsets = source.latest_offsets()
+                start_offsets = {}
+                for partition_id, latest_offset in latest_offsets.items():
+                    next_offset = self._next_offset(topic, partition_id)
+                    if next_offset < latest_offset:
+                        start_offsets[partition_id] = next_offset
+
+                num_new = 0
+                if start_offsets:
+                    num_new = self._append(topic, source.read(start_offsets), start_offsets)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        with self._lock:
+            self._syncs += 1
+            self._records_fetched += num_new
+
+        if num_new:
+            logger.info(f"Fetched {num_new} new kafka records for {topic}")
+        return num_new
+
+    def records(self, topic, start_offsets=None):
+        """
+        Return the locally stored records of the given topic
+        (without contacting the kafka server).
+
+        Args:
+            topic:
+                Kafka topic name
+            start_offsets:
+                Optional. ``{partition_id: offset}``.
+                If provided, only records from the given offsets onwards are returned.
+
+        Returns:
+            list of KafkaLogRecord, ordered by partition and offset.
+        """
+        assert self.enabled, "The kafka log cache is not enabled"
+        records = []
+        for partition_id in self.partitions(topic):
+            start_offset = (start_offsets or {}).get(partition_id, 0)
+            records += self._read_partition(topic, partition_id, start_offset)
+
+        with self._lock:
+            self._records_read += len(records)
+        return records
+
+    def partitions(self, topic):
+        """
+        Return the (sorted) list of partition IDs which are stored locally for the given topic.
+        """
+        topic_dir = self._topic_dir(topic)
+        if not os.path.exists(topic_dir):
+            return []
+        return sorted(int(name[:-len('.idx')]) for name in os.listdir(topic_dir) if name.endswith('.idx'))
+
+    def clear(self, topic=None):
+        """
+        Delete the local copy of the given topic, or of all topics.
+        """
+        topics = [topic] if topic is not None else os.listdir(self.directory)
+        for t in topics:
+            for partition_id in self.partitions(t):
+                for path in self._partition_paths(t, partition_id):
+                    os.unlink(path)
+
+    def _next_offset(self, topic, partition_id):
+        """
+        Return the offset after the last locally stored record of the given partition.
+        """
+        index = self._read_index(topic, partition_id)
+        if len(index) == 0:
+            return 0
+        return int(index['offset'][-1]) + 1
+
+    def _read_index(self, topic, partition_id):
+        _log_path, idx_path = self._partition_paths(topic, partition_id)
+        try:
+            with open(idx_path, 'rb') as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return np.zeros(0, _INDEX_DTYPE)
+
+        # Ignore a partially-written trailing entry, if any.
+        buf = buf[:len(buf) - len(buf) % _INDEX_DTYPE.itemsize]
+        return np.frombuffer(buf, _INDEX_DTYPE)
+
+    def _read_partition(self, topic, partition_id, start_offset=0):
+        index = self._read_index(topic, partition_id)
+        index = index[index['offset'] >= start_offset]
+        if len(index) == 0:
+            return []
+
+        log_path, _idx_path = self._partition_paths(topic, partition_id)
+        start = int(index['start'][0])
+        with open(log_path, 'rb') as f:
+            f.seek(start)
+            buf = f.read(int(index['stop'][-1]) - start)
+
+        records = []
+        for record_start, record_stop in zip((index['start'] - start).tolist(), (index['stop'] - start).tolist()):
+            offset, timestamp, size = _RECORD_HEADER.unpack_from(buf, record_start)
+            value_start = record_start + _RECORD_HEADER.size
+            assert value_start + size == record_stop, f"Kafka log cache for {topic} is corrupted"
+            records.append(KafkaLogRecord(partition_id, offset, timestamp, buf[value_start:record_stop]))
+        return records
+
+    def _append(self, topic, records, start_offsets):
+        """
+        Append the given records to the local copy of the topic.
+        (The caller must hold the topic's lock file.)
+        """
+        next_offsets = dict(start_offsets)
+        log_files = {}
+        index_entries = {}
+        try:
+            for record in records:
+                partition_id = record.partition_id
+                if partition_id not in next_offsets or record.offset < next_offsets[partition_id]:
+                    continue
+
+                if partition_id not in log_files:
+                    log_files[partition_id] = self._open_log(topic, partition_id)
+                    index_entries[partition_id] = []
+                log_file = log_files[partition_id]
+
+                value = record.value or b''
+                start = log_file.tell()
+                log_file.write(_RECORD_HEADER.pack(record.offset, record.timestamp or 0, len(value)))
+                log_file.write(value)
+                index_entries[partition_id].append((record.offset, start, log_file.tell()))
+                next_offsets[partition_id] = record.offset + 1
+        finally:
+            # The records must be written to the log before they're listed in the index.
+            for partition_id, log_file in log_files.items():
+                log_file.close()
+                _log_path, idx_path = self._partition_paths(topic, partition_id)
+                with open(idx_path, 'ab') as idx_file:
+                    idx_file.write(np.array(index_entries[partition_id], _INDEX_DTYPE).tobytes())
+
+        return sum(map(len, index_entries.values()))
+
+    def _open_log(self, topic, partition_id):
+        """
+        Open the log file of the given partition for appending, after discarding
+        any data (in either the log or index) beyond the last complete index entry.
+        """
+        log_path, idx_path = self._partition_paths(topic, partition_id)
+        index = self._read_index(topic, partition_id)
+        log_size = int(index['stop'][-1]) if len(index) else 0
+
+        with open(idx_path, 'ab') as idx_file:
+            idx_file.truncate(index.nbytes)
+
+        # (Not opened in 'append' mode, since tell() is unreliable after truncate() in that mode.)
+        open(log_path, 'ab').close()
+        log_file = open(log_path, 'r+b')
+        log_file.truncate(log_size)
+        log_file.seek(log_size)
+        return log_file
+
+    def _topic_dir(self, topic):
+        return os.path.join(self.directory, topic)
+
+    def _partition_paths(self, topic, partition_id):
+        topic_dir = self._topic_dir(topic)
+        return f'{topic_dir}/{partition_id}.log', f'{topic_dir}/{partition_id}.idx'
+
+
+class _PyKafkaSource:
+    """
+    Helper for KafkaLogCache.read().
+    Reads records from a kafka server via pykafka.
+    """
+    MAX_TRIES = 10
+
+    def __init__(self, topic_name, kafka_servers, timeout_seconds=2.0):
+        from pykafka import KafkaClient
+        client = KafkaClient(hosts=','.join(kafka_servers))
+        self.topic = client.topics[topic_name.encode('utf-8')]
+        self.timeout_seconds = timeout_seconds
+        self._latest_offsets = None
+
+    def latest_offsets(self):
+        if self._latest_offsets is None:
+            self._latest_offsets = { partition_id: response.offset[0]
+                                     for partition_id, response in self.topic.latest_available_offsets().items() }
+        return self._latest_offsets
+
+    def read(self, start_offsets):
+        from pykafka.common import OffsetType
+
+        end_offsets = { p: self.latest_offsets()[p] for p in start_offsets }
+        consumer = self.topic.get_simple_consumer( consumer_group=None,
+                                                   partitions=[self.topic.partitions[p] for p in start_offsets],
+                                                   auto_offset_reset=OffsetType.EARLIEST,
+                                                   consumer_timeout_ms=int(1000*self.timeout_seconds) )
+        try:
+            # Note: pykafka expects the offset of the last message that was ALREADY consumed.
+            consumer.reset_offsets([ (self.topic.partitions[p], (offset - 1) if offset > 0 else OffsetType.EARLIEST)
+                                     for p, offset in start_offsets.items() ])
+
+            next_offsets = dict(start_offsets)
+            records = []
+            for tries in range(1, self.MAX_TRIES+1):
+                for record in consumer:
+                    next_offsets[record.partition_id] = max(next_offsets[record.partition_id], record.offset + 1)
+                    records.append(record)
+
+                # Make sure we downloaded the whole log.
+                incomplete = {p: o for p, o in next_offsets.items() if o < end_offsets[p]}
+                if not incomplete:
+                    return records
+
+                if tries < self.MAX_TRIES:
+                    logger.warning(f"Could not fetch entire kafka log after {tries} tries ({next_offsets} / {end_offsets})")
+
+            # If there is an unexpected delay (e.g. a weird network/server hiccup),
+            # The log may be truncated.  Raise an error in that case.
+            raise RuntimeError(f"Kafka log appears incomplete: \n"
+                               f"Expected to read through offsets {end_offsets}, but only read through {next_offsets}")
+        finally:
+            # Avoid ReferenceError in pykafka.
+            # See comment in https://github.com/Parsely/pykafka/pull/827
+            consumer.stop()
+            time.sleep(0.1)
+
+
+DVID_KAFKA_LOG_CACHE = KafkaLogCache()
+
+
+def enable_kafka_log_cache(directory):
+    """
+    Start keeping a local copy of the kafka logs read via ``read_kafka_messages()``,
+    so that subsequent calls only need to download new messages.
+
+    Returns:
+        The global ``DVID_KAFKA_LOG_CACHE``
+    """
+    DVID_KAFKA_LOG_CACHE.configure(directory)
+    return DVID_KAFKA_LOG_CACHE
+
+
+def disable_kafka_log_cache():
+    """
+    Stop using the local copy of the kafka logs.  (Files already on disk are left as they are.)
+    """
+    DVID_KAFKA_LOG_CACHE.configure(None)
@@ -1,4 +1,8 @@
 from ._labelmap import *
 from ._split import *
+from ._kafkacolumns import *
 from ._labelindex import *
-
+from ._labelarray import *
+from ._blockcache import *
+from ._labelindexcache import *
+from ._mapping import *
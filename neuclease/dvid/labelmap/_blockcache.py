@@ -0,0 +1,398 @@
+"""
+In-process cache of labelmap blocks, for callers which repeatedly fetch
+the same 64px blocks (e.g. ``find_missing_adjacencies()``, point labeling, etc.)
+
+When the cache is enabled, every ``fetch_labelmap_voxels()`` request
+(except for ``format='block-iterator'``) stores the compressed blocks from
+DVID's response in memory, and subsequent requests whose blocks are ALL
+present in the cache are served without contacting the server.
+
+Blocks from locked nodes never change, so they remain valid until evicted.
+Blocks from unlocked nodes are validated against the labelmap instance's
+kafka log: The log is re-read (in a background thread, at most once every
+``refresh_seconds``), and blocks containing any label affected by a new
+mutation (merge, cleave, split, etc.) are discarded.  Hence, a cached block
+may be served for a short time after a mutation which affects it.
+If the kafka log can't be read, blocks from unlocked nodes are not cached.
+
+Note:
+    Voxels written directly via ``POST .../blocks`` are not recorded in the
+    kafka log, so they do not invalidate cached blocks.  If you are writing
+    voxels to a node, don't read them via the block cache.
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import enable_labelmap_block_cache, DVID_BLOCK_CACHE
+
+        enable_labelmap_block_cache(max_bytes=2e9)
+        vol = fetch_labelmap_voxels(server, uuid, 'segmentation', box, supervoxels=True)  # slow
+        vol = fetch_labelmap_voxels(server, uuid, 'segmentation', box, supervoxels=True)  # fast
+        print(DVID_BLOCK_CACHE.stats())
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ._labelarray import scan_labelarray_blocks, extract_labelarray_labels
+
+logger = logging.getLogger(__name__)
+
+# Approximate memory overhead of each cache entry,
+# beyond its compressed block data.
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+class LabelmapBlockCache:
+    """
+    Byte-bounded, least-recently-used cache of compressed labelmap blocks,
+    keyed by ``(server, uuid, instance, scale, supervoxels, block_coord_zyx)``.
+
+    Each entry holds the block's encoded data (exactly as returned by
+    ``GET .../blocks``, including its 16-byte header) and its label list,
+    which is used to decide whether or not a mutation affects the block.
+    Blocks that DVID omitted from its response (i.e. empty blocks) are
+    cached as empty entries.
+    """
+    def __init__(self):
+        self.max_bytes = 0
+        self.refresh_seconds = 30.0
+        self.lock_recheck_seconds = 60.0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+        # {(server, uuid): (locked, check_time)}
+        self._locked_nodes = {}
+
+        # {(server, uuid, instance): _KafkaState}
+        self._kafka_states = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def configure(self, max_bytes=1e9, refresh_seconds=30.0):
+        """
+        Args:
+            max_bytes:
+                Approximate maximum total size of the cached block data.
+                If 0, the cache is disabled.
+            refresh_seconds:
+                How often to re-read the kafka log for unlocked nodes.
+                Mutations are not noticed until the next refresh,
+                so cached blocks may be up to this many seconds out-of-date.
+        """
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self.refresh_seconds = refresh_seconds
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return { 'hits': self._hits,
+                     'misses': self._misses,
+                     'stores': self._stores,
+                     'evictions': self._evictions,
+                     'invalidations': self._invalidations,
+                     'blocks': len(self._entries),
+                     'bytes': self._total_bytes }
+
+    def clear(self):
+        """
+        Discard all cached blocks.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self._kafka_states.clear()
+
+    def fetch_box(self, server, uuid, instance, scale, supervoxels, aligned_box_zyx):
+        """
+        Return the encoded block data for the given block-aligned box,
+        in the same format as DVID's ``GET .../blocks`` response,
+        or None if any block in the box is not in the cache.
+        """
+        if not self._check_node(server, uuid, instance):
+            return None
+
+        keys = _block_keys(server, uuid, instance, scale, supervoxels, aligned_box_zyx)
+        with self._lock:
+            try:
+                block_datas = [self._entries[k][0] for k in keys]
+            except KeyError:
+                self._misses += 1
+                return None
+
+            for k in keys:
+                self._entries.move_to_end(k)
+            self._hits += 1
+
+        return b''.join(block_datas)
+
+    def store_box(self, server, uuid, instance, scale, supervoxels, aligned_box_zyx, encoded_data):
+        """
+        Store the blocks from DVID's response to a ``GET .../blocks``
+        request for the given block-aligned box.
+        """
+        if not self._check_node(server, uuid, instance):
+            return
+
+        keys = _block_keys(server, uuid, instance, scale, supervoxels, aligned_box_zyx)
+
+        # Blocks which aren't present in the response are empty
+        empty_labels = np.zeros(0, np.uint64)
+        entries = dict.fromkeys(keys, (b'', empty_labels))
+
+        block_coords, spans = scan_labelarray_blocks(encoded_data)
+        labels, label_offsets = extract_labelarray_labels(encoded_data, spans)
+
+        buf = memoryview(encoded_data)
+        for i, (coord, (start, stop)) in enumerate(zip(block_coords.tolist(), spans.tolist())):
+            key = (server, uuid, instance, scale, bool(supervoxels), tuple(coord))
+            entries[key] = (bytes(buf[start:stop]), labels[label_offsets[i]:label_offsets[i+1]].copy())
+
+        with self._lock:
+            for key, entry in entries.items():
+                self._discard(key)
+                self._entries[key] = entry
+                self._total_bytes += len(entry[0]) + _ENTRY_OVERHEAD_BYTES
+            self._stores += 1
+            self._evict()
+
+    def refresh(self, server, uuid, instance):
+        """
+        Read the kafka log for the given labelmap instance and discard
+        any cached blocks (from the given node) that are affected by
+        mutations which have been logged since the last refresh.
+
+        If another thread refreshed the log less than ``refresh_seconds``
+        ago (e.g. while this thread was waiting for it), the log isn't re-read.
+
+        Returns:
+            True if the kafka log was read successfully, otherwise False.
+        """
+        state = self._kafka_state(server, uuid, instance)
+        with state.lock:
+            if time.time() - state.refresh_time < self.refresh_seconds:
+                return state.valid
+            return self._refresh(server, uuid, instance, state)
+
+    def _refresh(self, server, uuid, instance, state):
+        """
+        Helper for refresh(). (The caller must hold state.lock.)
+        """
+        from ..kafka import read_kafka_messages
+
+        try:
+            msgs = read_kafka_messages(server, uuid, instance, dag_filter='leaf-only')
+        except Exception as ex:
+            logger.warning(f"Can't read kafka log for {uuid}/{instance}; its blocks won't be cached: {ex}")
+            state.refresh_time = time.time()
+            state.valid = False
+            self._invalidate(server, uuid, instance, everything=True)
+            return False
+
+        # The log is append-only, so we only need to inspect new messages.
+        if state.valid:
+            self.apply_kafka_messages(server, uuid, instance, msgs[state.num_msgs:])
+        else:
+            self._invalidate(server, uuid, instance, everything=True)
+
+        state.num_msgs = len(msgs)
+        state.refresh_time = time.time()
+        state.valid = True
+        return True
+
+    def _refresh_in_background(self, server, uuid, instance, state):
+        """
+        Start a thread to refresh the given node's kafka log,
+        unless such a thread is already running.
+        """
+        with self._lock:
+            if state.refreshing:
+                return
+            state.refreshing = True
+
+        def _refresh():
+            try:
+                self.refresh(server, uuid, instance)
+            finally:
+                state.refreshing = False
+
+        threading.Thread(target=_refresh, name=f'block-cache-refresh-{uuid[:6]}', daemon=True).start()
+
+    def _kafka_state(self, server, uuid, instance):
+        with self._lock:
+            return self._kafka_states.setdefault((server, uuid, instance), _KafkaState())
+
+    def apply_kafka_messages(self, server, uuid, instance, msgs):
+        """
+        Discard the cached blocks of the given labelmap instance which
+        might be affected by the mutations in the given kafka messages.
+        (Normally called via ``refresh()``.)
+        """
+        changed_svs, changed_bodies, everything = _labels_affected_by_msgs(msgs)
+        self._invalidate(server, uuid, instance, changed_svs, changed_bodies, everything)
+
+    def _invalidate(self, server, uuid, instance, changed_svs=(), changed_bodies=(), everything=False):
+        changed_svs = np.fromiter(changed_svs, np.uint64)
+        changed_bodies = np.fromiter(changed_bodies, np.uint64)
+        if not (everything or len(changed_svs) or len(changed_bodies)):
+            return
+
+        with self._lock:
+            stale_keys = []
+            for key, (_data, labels) in self._entries.items():
+                if key[:3] != (server, uuid, instance):
+                    continue
+                changed = changed_svs if key[4] else changed_bodies
+                if everything or np.isin(labels, changed).any():
+                    stale_keys.append(key)
+
+            for key in stale_keys:
+                self._discard(key)
+            self._invalidations += len(stale_keys)
+
+    def _discard(self, key):
+        """
+        Remove the given entry (if present). (The caller must hold self._lock.)
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= len(entry[0]) + _ENTRY_OVERHEAD_BYTES
+
+    def _evict(self):
+        """
+        Discard the least-recently-used blocks until the cache is
+        within its maximum size. (The caller must hold self._lock.)
+        """
+        while self._entries and self._total_bytes > self.max_bytes:
+            _key, (data, _labels) = self._entries.popitem(last=False)
+            self._total_bytes -= len(data) + _ENTRY_OVERHEAD_BYTES
+            self._evictions += 1
+
+    def _check_node(self, server, uuid, instance):
+        """
+        Return True if blocks from the given node can be
+        cached (or served from the cache) right now.
+        For unlocked nodes, refresh the kafka log if necessary.
+
+        The first time a node is checked, its kafka log is read synchronously.
+        After that, a stale log is refreshed in a background thread, and
+        callers are answered according to the most recent completed refresh
+        in the meantime, so they don't wait for the log to be re-read.
+        """
+        if self._is_locked(server, uuid):
+            return True
+
+        state = self._kafka_state(server, uuid, instance)
+        if state.refresh_time == -float('inf'):
+            return self.refresh(server, uuid, instance)
+
+        if time.time() - state.refresh_time >= self.refresh_seconds:
+            self._refresh_in_background(server, uuid, instance, state)
+        return state.valid
+
+    def _is_locked(self, server, uuid):
+        # Avoid a circular import
+        from ..repo import is_locked_memoized
+        return is_locked_memoized(server, uuid, self._locked_nodes, self._lock, self.lock_recheck_seconds)
+
+
+class _KafkaState:
+    """
+    Helper for LabelmapBlockCache.
+    How much of a node's kafka log has been inspected, and when.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_msgs = 0
+        self.refresh_time = -float('inf')
+        self.valid = False
+        self.refreshing = False
+
+
+def _block_keys(server, uuid, instance, scale, supervoxels, aligned_box_zyx):
+    """
+    Return the cache keys for the blocks in the given (block-aligned) box,
+    in the order DVID lists them (X fastest).
+    """
+    block_box = np.asarray(aligned_box_zyx) // 64
+    coords = np.mgrid[tuple(slice(a, b) for a, b in zip(*block_box))].reshape(3, -1).T
+    return [(server, uuid, instance, scale, bool(supervoxels), coord) for coord in map(tuple, coords.tolist())]
+
+
+def _labels_affected_by_msgs(msgs):
+    """
+    Determine which supervoxels and bodies are affected by
+    the mutations in the given labelmap kafka messages.
+
+    Returns:
+        (changed_svs, changed_bodies, everything),
+        where 'everything' is True if the messages contain an unrecognized
+        action, in which case all blocks should be considered invalid.
+    """
+    changed_svs = set()
+    changed_bodies = set()
+    if len(msgs) == 0:
+        return changed_svs, changed_bodies, False
+
+    # Avoid a circular import
+    from ._labelmap import labelmap_kafka_msgs_to_df
+
+    msgs_df = labelmap_kafka_msgs_to_df(msgs, drop_completes=True)
+    for action, target_body, target_sv, msg in msgs_df[['action', 'target_body', 'target_sv', 'msg']].itertuples(index=False):
+        if action == 'merge':
+            changed_bodies.add(target_body)
+            changed_bodies.update(msg.get('Labels', []))
+        elif action == 'cleave':
+            changed_bodies.add(target_body)
+        elif action == 'split':
+            changed_bodies.add(target_body)
+            changed_svs.update(map(int, (msg.get('SVSplits') or {}).keys()))
+        elif action == 'split-supervoxel':
+            changed_svs.add(target_sv)
+        elif action == 'renumber':
+            changed_bodies.update(msg.get(k, 0) for k in ('OrigLabel', 'NewLabel'))
+        else:
+            logger.warning(f"Unrecognized labelmap action '{action}'. Invalidating all cached blocks for {msg.get('UUID')}.")
+            return changed_svs, changed_bodies, True
+
+    changed_svs.discard(0)
+    changed_bodies.discard(0)
+    return changed_svs, changed_bodies, False
+
+
+DVID_BLOCK_CACHE = LabelmapBlockCache()
+
+
+def enable_labelmap_block_cache(max_bytes=1e9, refresh_seconds=30.0):
+    """
+    Start caching labelmap blocks fetched via ``fetch_labelmap_voxels()``.
+    See ``LabelmapBlockCache.configure()`` for argument details.
+
+    Returns:
+        The global ``DVID_BLOCK_CACHE``
+    """
+    DVID_BLOCK_CACHE.configure(max_bytes, refresh_seconds)
+    return DVID_BLOCK_CACHE
+
+
+def disable_labelmap_block_cache():
+    """
+    Stop caching labelmap blocks, and discard the blocks already in the cache.
+    """
+    DVID_BLOCK_CACHE.configure(0)
+    DVID_BLOCK_CACHE.clear()
@@ -0,0 +1,247 @@
+"""
+Columnar representation of a labelmap instance's kafka log.
+
+Parsing millions of kafka messages into a list of dicts (and then iterating
+over those dicts to extract the fields of interest) is slow.  Instead,
+``parse_labelmap_kafka_msgs()`` decodes the messages in batches (optionally
+in parallel, via a process pool) directly into typed arrays, one entry per
+message, plus 'CSR' arrays for the variable-length lists of labels in each message.
+
+For example, the merged labels of message ``i`` are:
+
+    .. code-block:: python
+
+        cols.merged_labels[cols.merged_labels_ptr[i]:cols.merged_labels_ptr[i+1]]
+"""
+from itertools import chain
+
+import ujson
+import numpy as np
+import pandas as pd
+
+from ...util import DEFAULT_TIMESTAMP, compute_parallel
+
+# The scalar (uint64) columns of LabelmapKafkaColumns
+_UINT64_COLUMNS = ['mutid', 'target_body', 'target_sv', 'new_label', 'remain_sv', 'split_sv']
+
+
+class LabelmapKafkaColumns:
+    """
+    The messages of a labelmap kafka log, as columnar arrays.
+    All per-message arrays are listed in log order.
+
+    Attributes:
+        action:
+            pd.Categorical, e.g. 'merge', 'merge-complete', 'cleave', etc.
+        uuid:
+            pd.Categorical
+        timestamp:
+            datetime64[ns] array
+            (messages without a timestamp are assigned a default timestamp)
+        mutid:
+            uint64 array (0 for messages without a 'MutationID')
+        target_body:
+            uint64 array: 'Target' (merge, split) or 'OrigLabel' (cleave), otherwise 0
+        target_sv:
+            uint64 array: 'Supervoxel' (split-supervoxel), otherwise 0
+        new_label:
+            uint64 array: 'CleavedLabel' (cleave) or 'NewLabel' (split), otherwise 0
+        remain_sv, split_sv:
+            uint64 arrays: 'RemainSupervoxel' and 'SplitSupervoxel' (split-supervoxel), otherwise 0
+        merged_labels_ptr, merged_labels:
+            CSR arrays for the 'Labels' of each merge
+        cleaved_svs_ptr, cleaved_svs:
+            CSR arrays for the 'CleavedSupervoxels' of each cleave
+        sv_splits_ptr, sv_splits:
+            CSR arrays for the 'SVSplits' of each split,
+            where sv_splits has shape (S,3), with columns [old, remain, split]
+    """
+    def __init__(self, columns):
+        self.__dict__.update(columns)
+
+    def __len__(self):
+        return len(self.mutid)
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            # Truncate to milliseconds, as in kafka_msgs_to_df()
+            timestamps = pd.Series(self._timestamp_strings, dtype=object)
+            timestamps = timestamps.str[:len('2018-01-01 00:00:00.000')]
+            timestamps = pd.to_datetime(timestamps).fillna(pd.Timestamp(self._default_timestamp))
+            self._timestamp = timestamps.values
+        return self._timestamp
+
+    @property
+    def is_complete(self):
+        """
+        Boolean array, True for the '...-complete' messages.
+        """
+        return _per_category(self.action, lambda a: a.endswith('-complete'))
+
+    def has_action(self, *actions):
+        """
+        Return a boolean array, True for messages whose action is one of the given actions.
+        """
+        return np.asarray(self.action.isin(actions))
+
+    def csr_rows(self, name):
+        """
+        Return an array which lists the message index of each item in the given CSR column,
+        e.g. ``csr_rows('merged_labels')`` has the same length as ``merged_labels``.
+        """
+        ptr = getattr(self, f'{name}_ptr')
+        return np.repeat(np.arange(len(self)), np.diff(ptr))
+
+    def __repr__(self):
+        return f"LabelmapKafkaColumns({len(self)} messages)"
+
+
+def parse_labelmap_kafka_msgs(kafka_msgs, default_timestamp=DEFAULT_TIMESTAMP, *, batch_size=100_000, processes=0):
+    """
+    Parse the kafka messages of a labelmap instance into a LabelmapKafkaColumns object.
+
+    Args:
+        kafka_msgs:
+            The messages, as returned by ``read_kafka_messages()``, either as
+            parsed JSON dicts ('json-values') or kafka records ('records').
+            Raw JSON strings (or bytes) are also accepted.
+            If a LabelmapKafkaColumns object is given, it is returned as-is.
+
+        default_timestamp:
+            Old versions of DVID did not emit a timestamp with each message.
+            For such messages, we'll assign a default timestamp, specified by this argument.
+
+        batch_size:
+            How many messages to parse in each batch.
+
+        processes:
+            If nonzero, decode the batches in parallel, using a process pool.
+            (Only useful for raw JSON messages, which haven't been decoded yet.)
+
+    Returns:
+        LabelmapKafkaColumns
+    """
+    if isinstance(kafka_msgs, LabelmapKafkaColumns):
+        return kafka_msgs
+
+    kafka_msgs = list(kafka_msgs)
+    if kafka_msgs and hasattr(kafka_msgs[0], 'value'):
+        kafka_msgs = [rec.value for rec in kafka_msgs]
+
+    batches = [kafka_msgs[start:start+batch_size] for start in range(0, len(kafka_msgs), batch_size)]
+    if processes and len(batches) > 1 and not isinstance(kafka_msgs[0], dict):
+        batch_columns = compute_parallel(_parse_batch, batches, processes=processes, ordered=True)
+    else:
+        batch_columns = [*map(_parse_batch, batches)]
+
+    return _concatenate_batches(batch_columns, default_timestamp)
+
+
+def _parse_batch(msgs):
+    """
+    Helper for parse_labelmap_kafka_msgs().
+    Extract the columns from the given batch of messages.
+
+    Returns:
+        dict of arrays (and lists, for the string columns)
+    """
+    if msgs and not isinstance(msgs[0], dict):
+        msgs = [*map(ujson.loads, msgs)]
+
+    n = len(msgs)
+    actions = [msg['Action'] for msg in msgs]
+    cols = { 'action': actions,
+             'uuid': [msg['UUID'] for msg in msgs],
+             'timestamp': [msg.get('Timestamp') for msg in msgs],
+             'mutid': np.array([msg.get('MutationID', 0) for msg in msgs], np.uint64).reshape(-1) }
+
+    for name in _UINT64_COLUMNS[1:]:
+        cols[name] = np.zeros(n, np.uint64)
+
+    for name in ['merged_labels', 'cleaved_svs', 'sv_splits']:
+        cols[f'{name}_counts'] = np.zeros(n, np.int64)
+
+    # Extract each action's fields from only the messages with that action.
+    actions = np.array(actions, object)
+    def select(action):
+        rows = np.flatnonzero(actions == action)
+        return rows, [msgs[i] for i in rows]
+
+    rows, selected = select('merge')
+    cols['target_body'][rows] = [msg['Target'] for msg in selected]
+    labels = [msg.get('Labels') or [] for msg in selected]
+    cols['merged_labels_counts'][rows] = [*map(len, labels)]
+    cols['merged_labels'] = np.fromiter(chain.from_iterable(labels), np.uint64)
+
+    rows, selected = select('cleave')
+    cols['target_body'][rows] = [msg['OrigLabel'] for msg in selected]
+    cols['new_label'][rows] = [msg.get('CleavedLabel', 0) for msg in selected]
+    svs = [msg.get('CleavedSupervoxels') or [] for msg in selected]
+    cols['cleaved_svs_counts'][rows] = [*map(len, svs)]
+    cols['cleaved_svs'] = np.fromiter(chain.from_iterable(svs), np.uint64)
+
+    rows, selected = select('split')
+    cols['target_body'][rows] = [msg['Target'] for msg in selected]
+    cols['new_label'][rows] = [msg.get('NewLabel', 0) for msg in selected]
+    splits = [msg.get('SVSplits') or {} for msg in selected]
+    cols['sv_splits_counts'][rows] = [*map(len, splits)]
+    cols['sv_splits'] = np.array([ (int(old_sv), split_info['Remain'], split_info['Split'])
+                                   for svsplits in splits
+                                   for old_sv, split_info in svsplits.items() ], np.uint64).reshape(-1, 3)
+
+    rows, selected = select('split-supervoxel')
+    cols['target_sv'][rows] = [msg['Supervoxel'] for msg in selected]
+    cols['remain_sv'][rows] = [msg.get('RemainSupervoxel', 0) for msg in selected]
+    cols['split_sv'][rows] = [msg.get('SplitSupervoxel', 0) for msg in selected]
+
+    return cols
+
+
+def _concatenate_batches(batch_columns, default_timestamp):
+    """
+    Helper for parse_labelmap_kafka_msgs().
+    Combine the columns from each batch into a single LabelmapKafkaColumns object.
+    """
+    def concat(name, dtype):
+        parts = [b[name] for b in batch_columns]
+        if not parts:
+            return np.zeros(0, dtype)
+        if isinstance(parts[0], list):
+            return np.array([*chain(*parts)], dtype)
+        return np.concatenate(parts).astype(dtype, copy=False)
+
+    columns = {}
+    columns['action'] = pd.Categorical(concat('action', object))
+    columns['uuid'] = pd.Categorical(concat('uuid', object))
+
+    # Timestamps are converted on demand (see LabelmapKafkaColumns.timestamp)
+    columns['_timestamp_strings'] = concat('timestamp', object)
+    columns['_default_timestamp'] = default_timestamp
+    columns['_timestamp'] = None
+
+    for name in _UINT64_COLUMNS:
+        columns[name] = concat(name, np.uint64)
+
+    for name in ['merged_labels', 'cleaved_svs', 'sv_splits']:
+        counts = concat(f'{name}_counts', np.int64)
+        ptr = np.zeros(len(counts) + 1, np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        columns[f'{name}_ptr'] = ptr
+
+        if name == 'sv_splits':
+            parts = [b[name] for b in batch_columns] or [np.zeros((0, 3), np.uint64)]
+            columns[name] = np.concatenate(parts)
+        else:
+            columns[name] = concat(name, np.uint64)
+
+    return LabelmapKafkaColumns(columns)
+
+
+def _per_category(categorical, func):
+    """
+    Evaluate the given (scalar) function once per category of the given pd.Categorical,
+    and return the results for every element.
+    """
+    results = np.array([func(c) for c in categorical.categories] + [False])
+    return results[categorical.codes]
@@ -0,0 +1,514 @@
+"""
+A native (numba) implementation of DVID's labelarray block compression,
+as used by the labelmap ``/blocks`` endpoint.
+
+Unlike libdvid's ``inflate_labelarray_blocks3D_from_raw()`` and ``encode_label_block()``,
+these functions release the GIL, so blocks can be decoded (or encoded) in parallel
+using ordinary threads.
+
+The format of each (uncompressed) block is as follows.
+(See DVID's ``datatype/common/labels/compressed.go`` for the authoritative description.)
+
+    .. code-block:: text
+
+        3 * uint32      gx, gy, gz: the number of sub-blocks in each dimension (8 for 64px blocks)
+        uint32          N: the number of labels in the block
+        N * uint64      the block's labels
+
+        ----- Data below is only included if N > 1, otherwise it is a solid block.
+              Nsb = # sub-blocks = gx * gy * gz
+
+        Nsb * uint16    Ns[i]: the number of labels in sub-block i
+        Ns * uint32     For each sub-block, the Ns[i] indices of its labels within the block label list
+        Nsb * values    For each sub-block, its voxels' indices into the sub-block label list,
+                        bit-packed (most significant bit first) using ceil(log2(Ns[i])) bits per voxel.
+                        (No values are stored for sub-blocks with Ns[i] <= 1.)
+
+Sub-blocks are 8x8x8 voxels, and both sub-blocks and voxels are listed in Z,Y,X order (X fastest).
+Labels are listed in the order of their first appearance in that traversal.
+"""
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numba import jit
+
+SUBBLOCK_WIDTH = 8
+
+
+def encode_labelarray_block(block):
+    """
+    Encode a single label block using DVID's labelarray compression.
+    (Does not apply gzip compression.)
+
+    Equivalent to ``libdvid.encode_label_block()``, but releases the GIL.
+
+    Args:
+        block:
+            uint64 array, shape (64,64,64)
+
+    Returns:
+        The encoded block, as a 1D uint8 array.
+    """
+    block = np.asarray(block, np.uint64, 'C')
+    assert block.ndim == 3
+    assert (np.array(block.shape) % SUBBLOCK_WIDTH == 0).all(), \
+        f"Block shape must be a multiple of {SUBBLOCK_WIDTH}, not {block.shape}"
+    return _encode_labelarray_block(block)
+
+
+def decode_labelarray_block(block_data, out=None):
+    """
+    Decode a single block which was encoded using DVID's labelarray compression.
+    (The data must already be gzip-decompressed, and must not include the 16-byte
+    location/length header used in the ``/blocks`` endpoint.)
+
+    Args:
+        block_data:
+            bytes or uint8 array, as produced by ``encode_labelarray_block()``
+
+        out:
+            Optional. A uint64 array (or view) to write the decoded voxels into.
+
+    Returns:
+        uint64 array, shape (64,64,64)
+    """
+    data = np.frombuffer(block_data, np.uint8)
+    gx, gy, gz = np.frombuffer(data[:12], np.uint32)
+    shape = SUBBLOCK_WIDTH * np.array((gz, gy, gx))
+
+    if out is None:
+        out = np.empty(shape, np.uint64)
+    assert out.shape == tuple(shape), \
+        f"Output array has the wrong shape: {out.shape} != {tuple(shape)}"
+    assert out.dtype == np.uint64
+
+    _decode_labelarray_block(data, out)
+    return out
+
+
+def decode_labelarray_blocks(encoded_data, box_zyx, threads=0):
+    """
+    Decode the payload from the labelmap instance ``GET /blocks`` endpoint
+    (or the output of ``encode_labelarray_blocks()``), and write the blocks
+    into a single volume covering the given box.
+    Equivalent to ``decode_labelarray_volume()``, but the blocks can be
+    decoded in parallel (each block is decompressed and decoded without the GIL).
+
+    Args:
+        encoded_data:
+            Raw gzip-labelarray-compressed block data, e.g. from
+            ``fetch_labelmap_voxels(..., format='raw-response')``
+
+        box_zyx:
+            The block-aligned box of the volume to return.
+            Blocks in the payload which lie outside the box are ignored,
+            and voxels of the box which aren't covered by any block are 0.
+
+        threads:
+            How many threads to use.  If 0, decode in the calling thread.
+
+    Returns:
+        uint64 array, with shape == (box_zyx[1] - box_zyx[0])
+    """
+    box_zyx = np.asarray(box_zyx)
+    assert (box_zyx % 64 == 0).all(), \
+        f"Box must be block-aligned, not {box_zyx.tolist()}"
+
+    volume = np.zeros(box_zyx[1] - box_zyx[0], np.uint64)
+    buf = memoryview(encoded_data).cast('B')
+
+    block_coords, spans = scan_labelarray_blocks(buf)
+    corners = 64 * block_coords - box_zyx[0]
+    keep = (corners >= 0).all(axis=1) & (corners + 64 <= volume.shape).all(axis=1)
+    spans = list(zip(corners[keep], spans[keep, 0] + 16, spans[keep, 1]))
+
+    def decode_span(span):
+        corner, start, stop = span
+        block_data = zlib.decompress(buf[start:stop], 16 + zlib.MAX_WBITS)
+        out = volume[corner[0]:corner[0]+64, corner[1]:corner[1]+64, corner[2]:corner[2]+64]
+        decode_labelarray_block(block_data, out)
+
+    if threads == 0:
+        for span in spans:
+            decode_span(span)
+    else:
+        with ThreadPool(threads) as pool:
+            chunksize = max(1, len(spans) // (4*threads))
+            for _ in pool.imap_unordered(decode_span, spans, chunksize):
+                pass
+
+    return volume
+
+
+def scan_labelarray_blocks(encoded_data):
+    """
+    Scan the block headers of a buffer of encoded labelarray/labelmap data,
+    as returned by ``GET .../blocks?compression=blocks``.
+    The block data itself is not decompressed.
+
+    Args:
+        encoded_data:
+            bytes or memoryview
+
+    Returns:
+        (block_coords_zyx, spans), where block_coords_zyx is an array of shape (N,3)
+        (in block units, not voxel units), and spans is an array of shape (N,2)
+        indicating the (start, stop) position of each block (including its 16-byte header).
+    """
+    data = np.frombuffer(encoded_data, np.uint8)
+    num_blocks, end = _count_labelarray_blocks(data)
+    assert end == len(data), \
+        f"Encoded block data ended unexpectedly ({len(data) - end} bytes left over)"
+
+    block_coords = np.empty((num_blocks, 3), np.int32)
+    spans = np.empty((num_blocks, 2), np.int64)
+    _scan_labelarray_headers(data, block_coords, spans)
+    return block_coords, spans
+
+
+def extract_labelarray_labels(encoded_data, spans, threads=0):
+    """
+    Extract the label list of each block in a buffer of encoded labelarray data.
+    Only the beginning of each block (its label list) is decompressed.
+    Since zlib releases the GIL, this can be done in parallel threads.
+
+    Args:
+        encoded_data:
+            bytes or memoryview, as returned by ``GET .../blocks?compression=blocks``
+        spans:
+            The block spans, as returned by ``scan_labelarray_blocks()``
+        threads:
+            How many threads to use.  If 0, run in the calling thread.
+
+    Returns:
+        (labels, offsets), in "CSR" form: The labels for block i are given by
+        ``labels[offsets[i]:offsets[i+1]]``
+    """
+    buf = memoryview(encoded_data).cast('B')
+
+    def extract(span):
+        start, stop = span
+        return _labelarray_block_labels(buf[start+16:stop])
+
+    if threads == 0:
+        block_labels = [*map(extract, spans)]
+    else:
+        with ThreadPool(threads) as pool:
+            block_labels = pool.map(extract, spans, chunksize=max(1, len(spans) // (4*threads)))
+
+    offsets = np.zeros(len(block_labels) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in block_labels])
+    if block_labels:
+        labels = np.concatenate(block_labels)
+    else:
+        labels = np.zeros(0, np.uint64)
+    return labels, offsets
+
+
+def _labelarray_block_labels(gzipped_block):
+    """
+    Return the label list of a single gzipped labelarray block,
+    without decompressing the rest of the block.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    header = decompressor.decompress(gzipped_block, 16)
+    gx, gy, gz, num_labels = np.frombuffer(header, np.uint32)
+    assert gx == gy == gz == 8, "Invalid block data"
+    if num_labels == 0:
+        return np.zeros(0, np.uint64)
+    labels = decompressor.decompress(decompressor.unconsumed_tail, 8*int(num_labels))
+    return np.frombuffer(labels, np.uint64)
+
+
+@jit(nopython=True, nogil=True)
+def _count_labelarray_blocks(data):
+    """
+    Helper for scan_labelarray_blocks().
+    Returns the number of complete blocks, and the position at which the last one ends.
+    Raises ValueError if a block header lists an invalid size.
+    """
+    num_blocks = 0
+    pos = 0
+    while pos + 16 <= len(data):
+        num_bytes = _read_int32(data, pos+12)
+        if num_bytes <= 0:
+            raise ValueError("Invalid block data: Block header lists a non-positive size")
+        if pos + 16 + num_bytes > len(data):
+            raise ValueError("Invalid block data: Block size exceeds the end of the buffer")
+        pos += 16 + num_bytes
+        num_blocks += 1
+    return num_blocks, pos
+
+
+@jit(nopython=True, nogil=True)
+def _scan_labelarray_headers(data, block_coords, spans):
+    """
+    Helper for scan_labelarray_blocks().
+    """
+    pos = 0
+    for i in range(len(spans)):
+        block_coords[i, 2] = _read_int32(data, pos)
+        block_coords[i, 1] = _read_int32(data, pos+4)
+        block_coords[i, 0] = _read_int32(data, pos+8)
+        num_bytes = _read_int32(data, pos+12)
+        spans[i, 0] = pos
+        spans[i, 1] = pos + 16 + num_bytes
+        pos += 16 + num_bytes
+
+
+@jit(nopython=True, nogil=True)
+def _bits_for(n):
+    """
+    The number of bits needed to store an index into a list of n items.
+    """
+    bits = 0
+    n -= 1
+    while n > 0:
+        bits += 1
+        n >>= 1
+    return bits
+
+
+@jit(nopython=True, nogil=True)
+def _read_uint(data, pos, nbytes):
+    """
+    Read a little-endian unsigned integer from a uint8 array.
+    """
+    v = np.uint64(0)
+    for i in range(nbytes):
+        v |= np.uint64(data[pos+i]) << np.uint64(8*i)
+    return v
+
+
+@jit(nopython=True, nogil=True)
+def _read_int32(data, pos):
+    """
+    Read a little-endian signed 32-bit integer from a uint8 array.
+    """
+    v = np.int64(_read_uint(data, pos, 4))
+    if v >= 2**31:
+        v -= 2**32
+    return v
+
+
+@jit(nopython=True, nogil=True)
+def _write_uint(data, pos, value, nbytes):
+    """
+    Write a little-endian unsigned integer into a uint8 array.
+    """
+    value = np.uint64(value)
+    for i in range(nbytes):
+        data[pos+i] = np.uint8((value >> np.uint64(8*i)) & np.uint64(0xFF))
+
+
+@jit(nopython=True, nogil=True)
+def _decode_labelarray_block(data, out):
+    gx = np.int64(_read_uint(data, 0, 4))
+    gy = np.int64(_read_uint(data, 4, 4))
+    gz = np.int64(_read_uint(data, 8, 4))
+    num_labels = np.int64(_read_uint(data, 12, 4))
+
+    labels = np.empty(num_labels, np.uint64)
+    for i in range(num_labels):
+        labels[i] = _read_uint(data, 16 + 8*i, 8)
+
+    if num_labels == 0:
+        out[:] = 0
+        return
+    if num_labels == 1:
+        out[:] = labels[0]
+        return
+
+    num_sb = gx*gy*gz
+    ns_pos = 16 + 8*num_labels
+    index_pos = ns_pos + 2*num_sb
+
+    total_sb_labels = 0
+    for i in range(num_sb):
+        total_sb_labels += np.int64(_read_uint(data, ns_pos + 2*i, 2))
+    value_pos = index_pos + 4*total_sb_labels
+
+    W = SUBBLOCK_WIDTH
+    lut = np.empty(512, np.uint64)
+    sb = 0
+    for sz in range(gz):
+        for sy in range(gy):
+            for sx in range(gx):
+                n = np.int64(_read_uint(data, ns_pos + 2*sb, 2))
+                sb += 1
+
+                for k in range(n):
+                    lut[k] = labels[np.int64(_read_uint(data, index_pos + 4*k, 4))]
+                index_pos += 4*n
+
+                if n <= 1:
+                    fill = np.uint64(0)
+                    if n == 1:
+                        fill = lut[0]
+                    out[sz*W:(sz+1)*W, sy*W:(sy+1)*W, sx*W:(sx+1)*W] = fill
+                    continue
+
+                bits = _bits_for(n)
+                mask = (1 << bits) - 1
+                bitpos = 0
+                for z in range(W):
+                    for y in range(W):
+                        for x in range(W):
+                            bytepos = value_pos + (bitpos >> 3)
+                            head = bitpos & 7
+                            if head + bits <= 8:
+                                index = (data[bytepos] >> (8 - head - bits)) & mask
+                            else:
+                                window = (np.int64(data[bytepos]) << 8) | np.int64(data[bytepos+1])
+                                index = (window >> (16 - head - bits)) & mask
+                            out[sz*W+z, sy*W+y, sx*W+x] = lut[index]
+                            bitpos += bits
+                value_pos += (W*W*W*bits) // 8
+
+
+@jit(nopython=True, nogil=True)
+def _hash_slot(label, capacity):
+    """
+    Helper for _encode_labelarray_block(). (Fibonacci hashing.)
+    """
+    return np.int64((label * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(40)) & (capacity - 1)
+
+
+@jit(nopython=True, nogil=True)
+def _encode_labelarray_block(block):
+    W = SUBBLOCK_WIDTH
+    gz = block.shape[0] // W
+    gy = block.shape[1] // W
+    gx = block.shape[2] // W
+    num_sb = gx*gy*gz
+    sb_size = W*W*W
+
+    # Pass 1: Assign each voxel (in sub-block order) an index into the
+    # block label list, in order of first appearance.
+    # We use a simple open-addressing hash table, which grows as needed.
+    capacity = 1024
+    keys = np.zeros(capacity, np.uint64)
+    vals = np.full(capacity, -1, np.int32)
+    labels = np.empty(64, np.uint64)
+    num_labels = 0
+
+    voxel_indices = np.empty(num_sb*sb_size, np.int32)
+    prev_label = np.uint64(0)
+    prev_index = -1
+
+    v = 0
+    for sz in range(gz):
+        for sy in range(gy):
+            for sx in range(gx):
+                for z in range(W):
+                    for y in range(W):
+                        for x in range(W):
+                            label = block[sz*W+z, sy*W+y, sx*W+x]
+                            if prev_index >= 0 and label == prev_label:
+                                voxel_indices[v] = prev_index
+                                v += 1
+                                continue
+
+                            slot = _hash_slot(label, capacity)
+                            while vals[slot] != -1 and keys[slot] != label:
+                                slot = (slot + 1) & (capacity - 1)
+
+                            if vals[slot] == -1:
+                                keys[slot] = label
+                                vals[slot] = num_labels
+                                if num_labels == len(labels):
+                                    new_labels = np.empty(2*len(labels), np.uint64)
+                                    new_labels[:num_labels] = labels[:num_labels]
+                                    labels = new_labels
+                                labels[num_labels] = label
+                                num_labels += 1
+
+                                if 2*num_labels > capacity:
+                                    # Grow and rehash.
+                                    # (The new label is rehashed last, so 'slot' still refers to it afterwards.)
+                                    capacity *= 2
+                                    keys = np.zeros(capacity, np.uint64)
+                                    vals = np.full(capacity, -1, np.int32)
+                                    for i in range(num_labels):
+                                        slot = _hash_slot(labels[i], capacity)
+                                        while vals[slot] != -1:
+                                            slot = (slot + 1) & (capacity - 1)
+                                        keys[slot] = labels[i]
+                                        vals[slot] = i
+
+                            prev_label = label
+                            prev_index = vals[slot]
+                            voxel_indices[v] = prev_index
+                            v += 1
+
+    header_size = 16 + 8*num_labels
+    if num_labels == 1:
+        # Solid block: no sub-block data
+        encoded = np.empty(header_size, np.uint8)
+        _write_uint(encoded, 0, gx, 4)
+        _write_uint(encoded, 4, gy, 4)
+        _write_uint(encoded, 8, gz, 4)
+        _write_uint(encoded, 12, num_labels, 4)
+        _write_uint(encoded, 16, labels[0], 8)
+        return encoded
+
+    # Pass 2: For each sub-block, list its labels (in order of first appearance),
+    # and replace each voxel's block label index with its sub-block label index.
+    sb_counts = np.zeros(num_sb, np.int32)
+    sb_label_indices = np.empty(num_sb*sb_size, np.int32)
+    local_of = np.full(num_labels, -1, np.int32)
+    total_sb_labels = 0
+    total_value_bytes = 0
+    for sb in range(num_sb):
+        start = sb*sb_size
+        n = 0
+        for i in range(start, start + sb_size):
+            bi = voxel_indices[i]
+            if local_of[bi] == -1:
+                local_of[bi] = n
+                sb_label_indices[total_sb_labels + n] = bi
+                n += 1
+            voxel_indices[i] = local_of[bi]
+
+        # Reset the lookup table for the next sub-block
+        for k in range(n):
+            local_of[sb_label_indices[total_sb_labels + k]] = -1
+
+        sb_counts[sb] = n
+        total_sb_labels += n
+        total_value_bytes += (sb_size * _bits_for(n)) // 8
+
+    encoded_size = header_size + 2*num_sb + 4*total_sb_labels + total_value_bytes
+    encoded = np.zeros(encoded_size, np.uint8)
+    _write_uint(encoded, 0, gx, 4)
+    _write_uint(encoded, 4, gy, 4)
+    _write_uint(encoded, 8, gz, 4)
+    _write_uint(encoded, 12, num_labels, 4)
+    for i in range(num_labels):
+        _write_uint(encoded, 16 + 8*i, labels[i], 8)
+
+    pos = header_size
+    for sb in range(num_sb):
+        _write_uint(encoded, pos, sb_counts[sb], 2)
+        pos += 2
+
+    for k in range(total_sb_labels):
+        _write_uint(encoded, pos, sb_label_indices[k], 4)
+        pos += 4
+
+    # Bit-pack the voxel values, most significant bit first.
+    for sb in range(num_sb):
+        bits = _bits_for(sb_counts[sb])
+        if bits == 0:
+            continue
+        bitpos = 0
+        for i in range(sb*sb_size, (sb+1)*sb_size):
+            value = voxel_indices[i]
+            for b in range(bits-1, -1, -1):
+                if (value >> b) & 1:
+                    encoded[pos + (bitpos >> 3)] |= np.uint8(1 << (7 - (bitpos & 7)))
+                bitpos += 1
+        pos += (sb_size * bits) // 8
+
+    return encoded
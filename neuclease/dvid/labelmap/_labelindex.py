@@ -1,18 +1,31 @@
 from functools import partial
 from collections import namedtuple
 from collections.abc import Iterable
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
 from numba import jit
+from requests import HTTPError
 
 from ...util import tqdm_proxy, compute_parallel
 from .. import dvid_api_wrapper
+from ..coalesce import coalesced
 
 # $ protoc --python_out=. neuclease/dvid/labelmap/labelops.proto
 from .labelops_pb2 import LabelIndex, LabelIndices
-from . import fetch_mapping
+from . import fetch_mapping, fetch_mutation_id
+from ._labelindexcache import DVID_LABELINDEX_CACHE
+from ._protobuf import _EMPTY_BUF, _read_varint, _varint_bytes, _varint_size, _write_varint
 
+# When fetching a batch of labelindexes via the cache, the cached entries are
+# revalidated (via /lastmod) using this many threads.  If more than
+# _MAX_REVALIDATIONS of the labels are cached, revalidating them would cost
+# more than simply re-fetching the whole batch, so the cache is bypassed.
+_REVALIDATION_THREADS = 8
+_MAX_REVALIDATIONS = 1000
+
+@coalesced
 @dvid_api_wrapper
 def fetch_labelindex(server, uuid, instance, label, format='protobuf', *, session=None): # @ReservedAssignment
     """
@@ -39,29 +52,48 @@ def fetch_labelindex(server, uuid, instance, label, format='protobuf', *, sessio
             How to return the data. Choices are:
               - ``raw`` (raw bytes of the DVID response, i.e. the raw bytes of the protobuf structure)
               - ``protobuf`` (A ``LabelIndex`` protobuf structure.)
+              - ``arrays`` (See description in ``parse_labelindex()``)
               - ``pandas`` (See description in ``convert_labelindex_to_pandas()``)
 
-            The 'pandas' format is slowest, but is most convenient to analyze.
+            The 'arrays' and 'pandas' formats are parsed directly from the raw bytes,
+            without constructing the protobuf structure, so they are much faster
+            than the 'protobuf' format for large labelindexes.
+
+            If the labelindex cache is enabled (see ``enable_labelindex_cache()``),
+            the 'arrays' and 'pandas' formats are served from the cache whenever
+            the cached labelindex is still up-to-date.
+            (The cached arrays are read-only.)
     
     Returns:
         See 'format' description.
     """
-    assert format in ('protobuf', 'pandas', 'raw')
+    assert format in ('protobuf', 'arrays', 'pandas', 'raw')
+
+    if format in ('arrays', 'pandas') and DVID_LABELINDEX_CACHE.enabled:
+        # See neuclease.dvid.labelmap._labelindexcache
+        arrays = _fetch_labelindex_via_cache(server, uuid, instance, label, session)
+        if format == 'pandas':
+            return labelindex_arrays_to_pandas(arrays)
+        return arrays
 
     r = session.get(f'http://{server}/api/node/{uuid}/{instance}/index/{label}')
     r.raise_for_status()
 
     if format == 'raw':
         return r.content
+    if format == 'arrays':
+        return parse_labelindex(r.content)
+    if format == 'pandas':
+        return labelindex_arrays_to_pandas(parse_labelindex(r.content))
 
     labelindex = LabelIndex()
     labelindex.ParseFromString(r.content)
 
-    if format == 'protobuf':
-        return labelindex
-    elif format == 'pandas':
-        return convert_labelindex_to_pandas(labelindex)
+    assert format == 'protobuf'
+    return labelindex
+
 
+@coalesced
 @dvid_api_wrapper
 def fetch_labelindices(server, uuid, instance, labels, *, format='protobuf', session=None): # @ReservedAssignment
     """
@@ -75,39 +107,129 @@ def fetch_labelindices(server, uuid, instance, labels, *, format='protobuf', ses
         If format='protobuf', a LabelIndices (protobuf) object containing all the
         requested LabelIndex (protobuf) objects.
         If format='list-of-protobuf', a list of LabelIndex (protobuf) objects.
+        If format='arrays', a list of LabelIndexArrays (tuple) objects.
         If format='pandas', a list of PandasLabelIndex (tuple) objects,
         which each contain a DataFrame representation of the labelindex.
+        If format='raw', the raw bytes of the LabelIndices protobuf structure.
     """
-    assert format in ('protobuf', 'list-of-protobuf', 'pandas')
+    assert format in ('protobuf', 'list-of-protobuf', 'arrays', 'pandas', 'raw')
     if isinstance(labels, np.ndarray):
         labels = labels.tolist()
     elif not isinstance(labels, list):
         labels = list(labels)
+
+    if format in ('arrays', 'pandas') and DVID_LABELINDEX_CACHE.enabled:
+        # See neuclease.dvid.labelmap._labelindexcache
+        indices = _fetch_labelindices_via_cache(server, uuid, instance, labels, session)
+        if format == 'pandas':
+            return list(map(labelindex_arrays_to_pandas, indices))
+        return indices
     
     endpoint = f'http://{server}/api/node/{uuid}/{instance}/indices'
     r = session.get(endpoint, json=labels)
     r.raise_for_status()
 
+    if format == 'raw':
+        return r.content
+    if format == 'arrays':
+        return parse_labelindices(r.content)
+    if format == 'pandas':
+        return list(map(labelindex_arrays_to_pandas, parse_labelindices(r.content)))
+
     labelindices = LabelIndices()
     labelindices.ParseFromString(r.content)
     if format == 'protobuf':
         return labelindices
     if format == 'list-of-protobuf':
         return list(labelindices.indices)
-    if format == 'pandas':
-        return list(map(convert_labelindex_to_pandas, labelindices.indices))
-    
+
+
+def _fetch_labelindex_via_cache(server, uuid, instance, label, session):
+    """
+    Helper for fetch_labelindex().
+    Return the cached LabelIndexArrays for the given label if it is
+    still up-to-date, otherwise fetch it from DVID and cache it.
+    """
+    mutid = fetch_mutation_id(server, uuid, instance, label, session=session)
+    arrays = DVID_LABELINDEX_CACHE.get(server, uuid, instance, label, mutid)
+    if arrays is None:
+        arrays = fetch_labelindex(server, uuid, instance, label, format='raw', session=session)
+        arrays = parse_labelindex(arrays)
+        DVID_LABELINDEX_CACHE.store(server, uuid, instance, arrays)
+    return arrays
+
+
+def _fetch_labelindices_via_cache(server, uuid, instance, labels, session):
+    """
+    Helper for fetch_labelindices().
+    Revalidate the cached labelindexes (if any) among the given labels,
+    and fetch the rest from DVID in a single request (and cache them).
+
+    Cached labels which no longer exist (e.g. they were merged into another body)
+    are discarded from the cache and omitted from the results, just as DVID omits
+    them from the response to a batched request.
+    """
+    cached = [label for label in labels if DVID_LABELINDEX_CACHE.contains(server, uuid, instance, label)]
+    if len(cached) > _MAX_REVALIDATIONS:
+        cached = []
+
+    def revalidate(label, session=None):
+        try:
+            mutid = fetch_mutation_id(server, uuid, instance, label, session=session)
+        except HTTPError as ex:
+            if ex.response is not None and 400 <= ex.response.status_code < 500:
+                DVID_LABELINDEX_CACHE.discard(server, uuid, instance, label)
+                return (label, None, False)
+            raise
+        return (label, DVID_LABELINDEX_CACHE.get(server, uuid, instance, label, mutid), True)
+
+    if len(cached) <= 1:
+        results = [revalidate(label, session) for label in cached]
+    else:
+        # No session (each thread uses its own default session)
+        with ThreadPool(min(_REVALIDATION_THREADS, len(cached))) as pool:
+            results = pool.map(revalidate, cached)
+
+    indices = {}
+    nonexistent = set()
+    for label, arrays, exists in results:
+        if arrays is not None:
+            indices[label] = arrays
+        elif not exists:
+            nonexistent.add(label)
+
+    missing = [label for label in labels if label not in indices and label not in nonexistent]
+    if missing:
+        raw = fetch_labelindices(server, uuid, instance, missing, format='raw', session=session)
+        missing = set(missing)
+        for arrays in parse_labelindices(raw):
+            if arrays.label in missing:
+                DVID_LABELINDEX_CACHE.store(server, uuid, instance, arrays)
+                indices[arrays.label] = arrays
+
+    # DVID omits labels which have no labelindex.
+    return [indices[label] for label in labels if label in indices]
+
 
 @dvid_api_wrapper
 def post_labelindex(server, uuid, instance, label, proto_index, *, session=None):
     """
     Post a protobuf LabelIndex object for the given
     label to the specified DVID labelmap instance.
+
+    The LabelIndex may also be given as a PandasLabelIndex or LabelIndexArrays tuple,
+    or as pre-encoded bytes (e.g. from ``create_labelindex(..., format='raw')``).
     """
-    assert isinstance(proto_index, LabelIndex)
-    assert proto_index.label == label
-    
-    payload = proto_index.SerializeToString()
+    if isinstance(proto_index, (bytes, memoryview)):
+        payload = proto_index
+    elif isinstance(proto_index, (PandasLabelIndex, LabelIndexArrays)):
+        assert proto_index.label == label
+        payload = encode_labelindex(proto_index)
+    else:
+        assert isinstance(proto_index, LabelIndex)
+        assert proto_index.label == label
+        payload = proto_index.SerializeToString()
+
     r = session.post(f'http://{server}/api/node/{uuid}/{instance}/index/{label}', data=payload)
     r.raise_for_status()
     
@@ -120,20 +242,27 @@ def post_labelindices(server, uuid, instance, indices, *, session=None):
     Args:
         indices:
             A list of LabelIndex (protobuf) objects,
-            or a pre-loaded LabelIndices protobuf object.
+            or a pre-loaded LabelIndices protobuf object,
+            or a list of PandasLabelIndex or LabelIndexArrays tuples
+            (which will be encoded via ``encode_labelindices()``),
+            or the pre-encoded bytes of a LabelIndices protobuf message.
     """
-    if isinstance(indices, LabelIndices):
-        label_indices = indices
+    if isinstance(indices, (bytes, memoryview)):
+        payload = indices
+    elif isinstance(indices, LabelIndices):
+        payload = indices.SerializeToString()
+    elif len(indices) > 0 and isinstance(indices[0], (PandasLabelIndex, LabelIndexArrays)):
+        payload = encode_labelindices(indices)
     else:
         label_indices = LabelIndices()
         label_indices.indices.extend(indices)
+        payload = label_indices.SerializeToString()
 
-    if len(label_indices.indices) == 0:
+    if len(payload) == 0:
         # This can happen when tombstone_mode == 'only'
         # and a label contained only one supervoxel.
         return
 
-    payload = label_indices.SerializeToString()
     endpoint = f'http://{server}/api/node/{uuid}/{instance}/indices'
     r = session.post(endpoint, data=payload)
     r.raise_for_status()
@@ -195,7 +324,8 @@ def _copy_labelindex_batch(src_triple, dest_triple, labels_batch):
     Defined here at the module top-level to allow it to be
     pickled when using multiprocessing.
     """
-    indexes_batch = fetch_labelindices(*src_triple, labels_batch)
+    # No need to parse the indexes; just copy the bytes.
+    indexes_batch = fetch_labelindices(*src_triple, labels_batch, format='raw')
     post_labelindices(*dest_triple, indexes_batch)
 
 
@@ -252,7 +382,249 @@ def convert_labelindex_to_pandas(labelindex):
                              labelindex.last_mod_user )
 
 
-def create_labelindex(pandas_labelindex):
+LabelIndexArrays = namedtuple("LabelIndexArrays", "block_ids svs counts label last_mutid last_mod_time last_mod_user")
+LabelIndexArrays.__doc__ = """
+    Columnar representation of a LabelIndex, as returned by ``parse_labelindex()``.
+    The arrays ``block_ids``, ``svs``, and ``counts`` all have the same length,
+    with one entry per (block, supervoxel) pair.  The block_ids are encoded as
+    DVID encodes them (see ``decode_labelindex_blocks()``), and the entries for each
+    block are contiguous.
+"""
+
+
+def parse_labelindex(raw):
+    """
+    Parse the raw bytes of a LabelIndex protobuf message (e.g. from
+    ``fetch_labelindex(..., format='raw')``) directly into flat arrays,
+    without constructing the protobuf structure.
+
+    Returns:
+        LabelIndexArrays
+    """
+    buf = np.frombuffer(raw, np.uint8)
+    num_rows, _, _ = _parse_labelindex(buf, 0, len(buf), *_empty_labelindex_arrays(0), 0, False)
+
+    arrays = _empty_labelindex_arrays(num_rows)
+    _, label, meta = _parse_labelindex(buf, 0, len(buf), *arrays, 0, True)
+    return _labelindex_arrays(buf, arrays, 0, num_rows, label, meta)
+
+
+def parse_labelindices(raw):
+    """
+    Parse the raw bytes of a LabelIndices protobuf message (e.g. from
+    ``fetch_labelindices(..., format='raw')``) directly into flat arrays,
+    without constructing the protobuf structure.
+
+    Returns:
+        list of LabelIndexArrays
+    """
+    buf = np.frombuffer(raw, np.uint8)
+    num_rows, num_indices = _parse_labelindices(buf, *_empty_labelindex_arrays(0), np.zeros((0, 8), np.uint64), False)
+
+    arrays = _empty_labelindex_arrays(num_rows)
+    meta = np.zeros((num_indices, 8), np.uint64)
+    _parse_labelindices(buf, *arrays, meta, True)
+
+    results = []
+    for start, stop, label, *index_meta in meta.tolist():
+        results.append(_labelindex_arrays(buf, arrays, start, stop, label, index_meta))
+    return results
+
+
+def labelindex_arrays_to_pandas(arrays):
+    """
+    Convert a LabelIndexArrays tuple (from ``parse_labelindex()``)
+    into a PandasLabelIndex tuple.  See ``convert_labelindex_to_pandas()``.
+    """
+    blocks_df = pd.DataFrame( decode_labelindex_blocks(arrays.block_ids), columns=['z', 'y', 'x'] )
+    blocks_df['sv'] = arrays.svs
+    blocks_df['count'] = arrays.counts
+
+    return PandasLabelIndex( blocks_df,
+                             arrays.label,
+                             arrays.last_mutid,
+                             arrays.last_mod_time,
+                             arrays.last_mod_user )
+
+
+def _empty_labelindex_arrays(num_rows):
+    """
+    Helper for parse_labelindex() and parse_labelindices().
+    """
+    return ( np.zeros(num_rows, np.uint64),
+             np.zeros(num_rows, np.uint64),
+             np.zeros(num_rows, np.uint32) )
+
+
+def _labelindex_arrays(buf, arrays, start, stop, label, meta):
+    """
+    Helper for parse_labelindex() and parse_labelindices().
+    Construct a LabelIndexArrays tuple from the parsed data.
+    """
+    block_ids, svs, counts = arrays
+    last_mutid, time_start, time_stop, user_start, user_stop = map(int, meta)
+    return LabelIndexArrays( block_ids[start:stop],
+                             svs[start:stop],
+                             counts[start:stop],
+                             int(label),
+                             last_mutid,
+                             buf[time_start:time_stop].tobytes().decode('utf-8'),
+                             buf[user_start:user_stop].tobytes().decode('utf-8') )
+
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LEN = 2
+_FIXED32 = 5
+
+
+@jit(nopython=True, nogil=True)
+def _skip_field(buf, pos, wire_type):
+    """
+    Skip over a protobuf field value of the given wire type.
+    Returns the position after the field.
+    """
+    if wire_type == _VARINT:
+        _, pos = _read_varint(buf, pos)
+    elif wire_type == _FIXED64:
+        pos += 8
+    elif wire_type == _LEN:
+        n, pos = _read_varint(buf, pos)
+        pos += np.int64(n)
+    elif wire_type == _FIXED32:
+        pos += 4
+    else:
+        raise ValueError("Unsupported protobuf wire type")
+    return pos
+
+
+@jit(nopython=True, nogil=True)
+def _parse_labelindex(buf, pos, end, block_ids, svs, counts, row, fill):
+    """
+    Parse the LabelIndex message in buf[pos:end].
+    The (block_id, sv, count) entries are written to the given arrays, starting at the given row,
+    unless fill is False, in which case the entries are merely counted.
+
+    Returns:
+        (row, label, meta), where row is the row after the last entry written,
+        and meta is (last_mutid, time_start, time_stop, user_start, user_stop),
+        indicating the positions of the last_mod_time and last_mod_user strings in buf.
+    """
+    label = np.uint64(0)
+    last_mutid = np.uint64(0)
+    time_start = time_stop = user_start = user_stop = 0
+
+    while pos < end:
+        tag, pos = _read_varint(buf, pos)
+        field = tag >> np.uint64(3)
+        wire_type = tag & np.uint64(7)
+
+        if field == 1 and wire_type == _LEN:
+            # blocks: map<uint64, SVCount>
+            n, pos = _read_varint(buf, pos)
+            entry_end = pos + np.int64(n)
+            block_id = np.uint64(0)
+            block_start_row = row
+            while pos < entry_end:
+                tag, pos = _read_varint(buf, pos)
+                field = tag >> np.uint64(3)
+                wire_type = tag & np.uint64(7)
+                if field == 1 and wire_type == _VARINT:
+                    block_id, pos = _read_varint(buf, pos)
+                elif field == 2 and wire_type == _LEN:
+                    # SVCount: map<uint64, uint32> counts
+                    n, pos = _read_varint(buf, pos)
+                    svcount_end = pos + np.int64(n)
+                    while pos < svcount_end:
+                        tag, pos = _read_varint(buf, pos)
+                        if tag != ((1 << 3) | _LEN):
+                            pos = _skip_field(buf, pos, tag & np.uint64(7))
+                            continue
+                        n, pos = _read_varint(buf, pos)
+                        counts_entry_end = pos + np.int64(n)
+                        sv = np.uint64(0)
+                        count = np.uint64(0)
+                        while pos < counts_entry_end:
+                            tag, pos = _read_varint(buf, pos)
+                            if tag == ((1 << 3) | _VARINT):
+                                sv, pos = _read_varint(buf, pos)
+                            elif tag == ((2 << 3) | _VARINT):
+                                count, pos = _read_varint(buf, pos)
+                            else:
+                                pos = _skip_field(buf, pos, tag & np.uint64(7))
+                        if fill:
+                            svs[row] = sv
+                            counts[row] = count
+                        row += 1
+                else:
+                    pos = _skip_field(buf, pos, wire_type)
+
+            # The block ID may appear after the counts,
+            # so we fill it in after the entry is complete.
+            if fill:
+                block_ids[block_start_row:row] = block_id
+
+        elif field == 2 and wire_type == _VARINT:
+            label, pos = _read_varint(buf, pos)
+        elif field == 3 and wire_type == _VARINT:
+            last_mutid, pos = _read_varint(buf, pos)
+        elif field == 4 and wire_type == _LEN:
+            n, pos = _read_varint(buf, pos)
+            time_start = pos
+            time_stop = pos = pos + np.int64(n)
+        elif field == 5 and wire_type == _LEN:
+            n, pos = _read_varint(buf, pos)
+            user_start = pos
+            user_stop = pos = pos + np.int64(n)
+        else:
+            pos = _skip_field(buf, pos, wire_type)
+
+    return row, label, (last_mutid, time_start, time_stop, user_start, user_stop)
+
+
+@jit(nopython=True, nogil=True)
+def _parse_labelindices(buf, block_ids, svs, counts, meta, fill):
+    """
+    Parse a LabelIndices message.
+    If fill is True, write the (block_id, sv, count) entries into the given arrays,
+    and for each LabelIndex, write a row of meta:
+    (start_row, stop_row, label, last_mutid, time_start, time_stop, user_start, user_stop)
+
+    Returns:
+        (num_rows, num_indices)
+    """
+    pos = 0
+    row = 0
+    num_indices = 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        if tag != ((1 << 3) | _LEN):
+            pos = _skip_field(buf, pos, tag & np.uint64(7))
+            continue
+
+        n, pos = _read_varint(buf, pos)
+        index_end = pos + np.int64(n)
+        start_row = row
+        row, label, (last_mutid, time_start, time_stop, user_start, user_stop) = \
+            _parse_labelindex(buf, pos, index_end, block_ids, svs, counts, row, fill)
+
+        if fill:
+            meta[num_indices, 0] = start_row
+            meta[num_indices, 1] = row
+            meta[num_indices, 2] = label
+            meta[num_indices, 3] = last_mutid
+            meta[num_indices, 4] = time_start
+            meta[num_indices, 5] = time_stop
+            meta[num_indices, 6] = user_start
+            meta[num_indices, 7] = user_stop
+        pos = index_end
+        num_indices += 1
+
+    return row, num_indices
+
+
+def create_labelindex(pandas_labelindex, format='protobuf'): # @ReservedAssignment
     """
     Create a protobuf LabelIndex structure from a PandasLabelIndex tuple.
     
@@ -267,29 +639,203 @@ def create_labelindex(pandas_labelindex):
     Args:
         pandas_labelindex:
             Instance of PandasLabelIndex (a namedtuple)
+
+        format:
+            Either 'protobuf', 'arrays' (a LabelIndexArrays tuple), or 'raw'
+            (the serialized protobuf bytes, as produced by ``encode_labelindex()``).
+            For bulk ingestion, 'raw' is much faster than 'protobuf', and
+            the result can be passed directly to ``post_labelindex()``.
         
     Returns:
         neuclease.dvid.labelmap.labelops_pb2.LabelIndex
-        (a protobuf structure), suitable for ``post_labelindex()``
+        (a protobuf structure), suitable for ``post_labelindex()``,
+        or an alternative format (see above).
     """
+    assert format in ('protobuf', 'arrays', 'raw')
     pli = pandas_labelindex
     assert isinstance(pli, PandasLabelIndex)
-    labelindex = LabelIndex()
-    labelindex.label = pli.label
-    labelindex.last_mutid = pli.last_mutid
-    labelindex.last_mod_time = pli.last_mod_time
-    labelindex.last_mod_user = pli.last_mod_user
-    
     assert (pli.blocks.columns == ['z', 'y', 'x', 'sv', 'count']).all()
 
+    # Group the rows by block
     block_ids = encode_block_coords(pli.blocks[['z', 'y', 'x']].values)
-    pli.blocks['block_id'] = block_ids
-    
-    for block_id, df in pli.blocks.groupby('block_id'):
-        labelindex.blocks[block_id].counts.update( zip(df['sv'].values, df['count'].values) )
-    
-    del pli.blocks['block_id']
-    return labelindex
+    order = np.argsort(block_ids, kind='stable')
+
+    arrays = LabelIndexArrays( block_ids[order],
+                               pli.blocks['sv'].values.astype(np.uint64)[order],
+                               pli.blocks['count'].values.astype(np.uint32)[order],
+                               pli.label,
+                               pli.last_mutid,
+                               pli.last_mod_time,
+                               pli.last_mod_user )
+    if format == 'arrays':
+        return arrays
+
+    raw = encode_labelindex(arrays)
+    if format == 'raw':
+        return raw
+
+    return LabelIndex.FromString(raw)
+
+
+def encode_labelindex(labelindex):
+    """
+    Serialize the given labelindex as a LabelIndex protobuf message,
+    without constructing the protobuf structure.
+
+    Args:
+        labelindex:
+            LabelIndexArrays or PandasLabelIndex tuple.
+            If the entries for each block are not contiguous (e.g. sorted by block_id),
+            as produced by ``parse_labelindex()`` or ``create_labelindex(..., format='arrays')``,
+            they are grouped by block before encoding.
+
+    Returns:
+        bytes
+    """
+    return encode_labelindices([labelindex], False)
+
+
+def encode_labelindices(labelindices, as_labelindices=True):
+    """
+    Serialize the given labelindexes into a single LabelIndices protobuf message,
+    suitable for ``post_labelindices()``, without constructing the protobuf structures.
+
+    Args:
+        labelindices:
+            A list of LabelIndexArrays or PandasLabelIndex tuples.
+            See ``encode_labelindex()``.
+
+        as_labelindices:
+            If False, the list must contain exactly one labelindex,
+            which is encoded as a LabelIndex message, rather than LabelIndices.
+
+    Returns:
+        bytes
+    """
+    labelindices = [create_labelindex(li, 'arrays') if isinstance(li, PandasLabelIndex) else li
+                    for li in labelindices]
+    labelindices = [*map(_group_labelindex_blocks, labelindices)]
+    assert as_labelindices or len(labelindices) == 1
+
+    # Compute the size of each message, so we can allocate a single buffer.
+    headers = []
+    trailers = []
+    sizes = []
+    for li in labelindices:
+        assert isinstance(li, LabelIndexArrays)
+        blocks_size = _encode_labelindex_blocks(li.block_ids, li.svs, li.counts, _EMPTY_BUF, 0, False)
+        trailer = _encode_labelindex_scalar_fields(li)
+        message_size = blocks_size + len(trailer)
+
+        header = b''
+        if as_labelindices:
+            header = b'\x0a' + _varint_bytes(message_size)
+
+        headers.append(header)
+        trailers.append(trailer)
+        sizes.append(len(header) + message_size)
+
+    out = np.empty(sum(sizes), np.uint8)
+    pos = 0
+    for li, header, trailer in zip(labelindices, headers, trailers):
+        out[pos:pos+len(header)] = np.frombuffer(header, np.uint8)
+        pos += len(header)
+        pos = _encode_labelindex_blocks(li.block_ids, li.svs, li.counts.astype(np.uint64), out, pos, True)
+        out[pos:pos+len(trailer)] = np.frombuffer(trailer, np.uint8)
+        pos += len(trailer)
+
+    assert pos == len(out)
+    return out.tobytes()
+
+
+def _group_labelindex_blocks(li):
+    """
+    Helper for encode_labelindices().
+    Each block must be encoded as a single map entry (protobuf parsers keep
+    only the last of any duplicate keys), so if the entries for any block
+    are not contiguous, return a copy of the labelindex sorted by block_id.
+    """
+    block_ids = li.block_ids
+    if len(block_ids) <= 1 or (block_ids[1:] >= block_ids[:-1]).all():
+        return li
+
+    num_runs = 1 + np.count_nonzero(block_ids[1:] != block_ids[:-1])
+    if num_runs == len(pd.unique(block_ids)):
+        return li
+
+    order = np.argsort(block_ids, kind='stable')
+    return li._replace(block_ids=block_ids[order], svs=li.svs[order], counts=li.counts[order])
+
+
+def _encode_labelindex_scalar_fields(li):
+    """
+    Helper for encode_labelindices().
+    Encode the non-block fields of a LabelIndex message.
+    (Default values are omitted, as in proto3.)
+    """
+    fields = []
+    if li.label:
+        fields += [b'\x10', _varint_bytes(li.label)]
+    if li.last_mutid:
+        fields += [b'\x18', _varint_bytes(li.last_mutid)]
+    for tag, s in ((b'\x22', li.last_mod_time), (b'\x2a', li.last_mod_user)):
+        if s:
+            s = s.encode('utf-8')
+            fields += [tag, _varint_bytes(len(s)), s]
+    return b''.join(fields)
+
+
+@jit(nopython=True, nogil=True)
+def _encode_labelindex_blocks(block_ids, svs, counts, out, pos, write):
+    """
+    Encode the 'blocks' field of a LabelIndex message
+    (map<uint64, SVCount>, where SVCount is map<uint64, uint32>),
+    from arrays in which the entries for each block are contiguous.
+
+    If write is True, the encoded data is written to ``out``, starting at ``pos``.
+    Otherwise, nothing is written.
+
+    Returns:
+        The position after the encoded data.
+    """
+    n = len(block_ids)
+    i = 0
+    while i < n:
+        # Find this block's entries and compute the size of its SVCount message
+        j = i
+        svcount_size = 0
+        while j < n and block_ids[j] == block_ids[i]:
+            entry_size = 2 + _varint_size(svs[j]) + _varint_size(counts[j])
+            svcount_size += 1 + _varint_size(entry_size) + entry_size
+            j += 1
+
+        block_entry_size = 2 + _varint_size(block_ids[i]) + _varint_size(svcount_size) + svcount_size
+
+        if not write:
+            pos += 1 + _varint_size(block_entry_size) + block_entry_size
+            i = j
+            continue
+
+        # blocks entry (field 1) {key: block_id (field 1), value: SVCount (field 2)}
+        out[pos] = 0x0A
+        pos = _write_varint(out, pos+1, block_entry_size)
+        out[pos] = 0x08
+        pos = _write_varint(out, pos+1, block_ids[i])
+        out[pos] = 0x12
+        pos = _write_varint(out, pos+1, svcount_size)
+
+        for k in range(i, j):
+            # counts entry (field 1) {key: sv (field 1), value: count (field 2)}
+            entry_size = 2 + _varint_size(svs[k]) + _varint_size(counts[k])
+            out[pos] = 0x0A
+            pos = _write_varint(out, pos+1, entry_size)
+            out[pos] = 0x08
+            pos = _write_varint(out, pos+1, svs[k])
+            out[pos] = 0x10
+            pos = _write_varint(out, pos+1, counts[k])
+
+        i = j
+    return pos
 
 
 @dvid_api_wrapper
@@ -374,24 +920,17 @@ def _fetch_sizes_via_labelindex(server, uuid, instance, labels, supervoxels=Fals
         sizes.name = 'size'
         return sizes
     else:
-        labelindices = fetch_labelindices(server, uuid, instance, labels, format='protobuf')
-
-        bodies = []
-        sizes = []
-        for index in labelindices.indices:
-            bodies.append(index.label)
-            block_sums = (sum(block_svs.counts.values()) for block_svs in index.blocks.values())
-            total_sum = sum(block_sums)
-            sizes.append(total_sum)
-        
-        bodies = np.fromiter(bodies, np.uint64)
+        labelindices = fetch_labelindices(server, uuid, instance, labels, format='arrays')
+
+        bodies = np.fromiter((index.label for index in labelindices), np.uint64, len(labelindices))
+        sizes = [index.counts.sum(dtype=np.uint64) for index in labelindices]
         sizes = pd.Series(sizes, index=bodies, dtype=np.uint32, name='size')
         sizes.index.name = 'body'
         return sizes
 
 
 @dvid_api_wrapper
-def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, supervoxels=False, *, method='pandas', session=None):
+def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, supervoxels=False, *, method='arrays', batch_size=1000, session=None):
     """
     Equivalent to fetch_sparsevol_coarse, but uses the raw /labelindex endpoint
     to obtain the coordinate list, rather than requesting sparsevol RLEs from dvid.
@@ -408,6 +947,9 @@ def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, superv
     It is well suited for fetching thousands or millions of coarse sparsevols
     in a cluster-computing workflow, in which DVID is a bottleneck,
     and you have more than 5 workers.
+
+    If you want each label's coarse sparsevol separately, see
+    ``fetch_sparsevol_coarse_via_labelindices()``.
     
     Args:
         server:
@@ -427,11 +969,17 @@ def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, superv
             If True, interpret the given labels are supervoxel IDs, otherwise body IDs.
         
         method:
-            This function can extract the block IDs directly from
-            protobuf (using Python set operations), or by converting to pandas first.
+            This function can extract the block IDs from the labelindexes via
+            batched requests for the labelindexes ('arrays'), or
+            by fetching each labelindex separately and extracting the block IDs
+            via Python set operations ('protobuf') or via pandas ('pandas').
             This option is here just for testing and performance analysis.
             It may be removed in the future.
 
+        batch_size:
+            For method='arrays', how many labels to request from DVID in each /indices request.
+            (See ``fetch_sparsevol_coarse_via_labelindices()``.)
+
     Returns:
         An array of coordinates (at scale 6) of the form:
     
@@ -446,7 +994,7 @@ def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, superv
     Note:
         The returned coordinates are not necessarily sorted.
     """
-    assert method in ('pandas', 'protobuf')
+    assert method in ('arrays', 'pandas', 'protobuf')
     if np.issubdtype(type(labels), np.integer):
         labels = np.asarray([labels], np.uint64)
     else:
@@ -454,36 +1002,168 @@ def fetch_sparsevol_coarse_via_labelindex(server, uuid, instance, labels, superv
             "Please provide an iterable of labels, or a single label."
         labels = np.asarray(labels, np.uint64)
 
-    block_ids = set()
+    if method == 'arrays':
+        # Deduplicate each batch's coordinates before combining them,
+        # so memory usage doesn't grow with the number of labels.
+        batch_coords = [np.zeros((0,3), np.int32)]
+        for start in range(0, len(labels), batch_size):
+            batch_df = fetch_sparsevol_coarse_via_labelindices(server, uuid, instance, labels[start:start+batch_size],
+                                                               supervoxels, batch_size=batch_size, session=session)
+            batch_coords.append(batch_df[['z', 'y', 'x']].drop_duplicates().values)
+        return pd.DataFrame(np.concatenate(batch_coords)).drop_duplicates().values
+
     if supervoxels:
-        bodies = fetch_mapping(server, uuid, instance, labels, as_series=True)
-        for body, mapping_df in bodies.reset_index().groupby('body'):
-            if body == 0:
-                continue
-            svs = set(mapping_df['sv'])
-            if method == 'pandas':
-                labelindex_df = fetch_labelindex(server, uuid, instance, body, 'pandas', session=session).blocks
-                coords_zyx = labelindex_df.query('sv in @svs')[['z', 'y', 'x']].drop_duplicates().values
-            else:
-                labelindex = fetch_labelindex(server, uuid, instance, body, session=session)
-                block_ids |= set( block_id for block_id, blockdata in labelindex.blocks.items()
-                               if svs & blockdata.counts.keys() )                
-                block_ids = np.fromiter(block_ids, np.uint64, len(block_ids))
-                coords_zyx = decode_labelindex_blocks(block_ids)
+        mapping = fetch_mapping(server, uuid, instance, labels, as_series=True)
+        groups = [(body, set(df['sv'])) for body, df in mapping.reset_index().groupby('body') if body != 0]
     else:
-        for body in labels:
-            if method == 'pandas':
-                labelindex_df = fetch_labelindex(server, uuid, instance, body, 'pandas', session=session).blocks
-                coords_zyx = labelindex_df[['z', 'y', 'x']].drop_duplicates().values
+        groups = [(body, None) for body in labels]
+
+    block_ids = set()
+    all_coords = [np.zeros((0,3), np.int32)]
+    for body, svs in groups:
+        if method == 'pandas':
+            labelindex_df = fetch_labelindex(server, uuid, instance, body, 'pandas', session=session).blocks
+            if svs is not None:
+                labelindex_df = labelindex_df.query('sv in @svs')
+            all_coords.append(labelindex_df[['z', 'y', 'x']].values)
+        else:
+            labelindex = fetch_labelindex(server, uuid, instance, body, session=session)
+            if svs is None:
+                block_ids.update(labelindex.blocks.keys())
             else:
-                labelindex = fetch_labelindex(server, uuid, instance, body, session=session)
-                block_ids |= labelindex.blocks.keys()
-                block_ids = np.fromiter(block_ids, np.uint64, len(block_ids))
-                coords_zyx = decode_labelindex_blocks(block_ids)
+                block_ids.update( block_id for block_id, blockdata in labelindex.blocks.items()
+                                  if svs & blockdata.counts.keys() )
+
+    if method == 'protobuf':
+        block_ids = np.fromiter(block_ids, np.uint64, len(block_ids))
+        coords_zyx = decode_labelindex_blocks(block_ids)
+    else:
+        coords_zyx = pd.DataFrame(np.concatenate(all_coords)).drop_duplicates().values
 
     return coords_zyx // (2**6)
 
 
+@dvid_api_wrapper
+def fetch_sparsevol_coarse_via_labelindices(server, uuid, instance, labels, supervoxels=False, *,
+                                            format='pandas', batch_size=1000, threads=0, processes=0, session=None): # @ReservedAssignment
+    """
+    Fetch the coarse sparsevol (i.e. the list of scale-6 block coordinates)
+    of each of the given labels, via batched requests to DVID's /indices endpoint.
+
+    Unlike ``fetch_sparsevol_coarse_via_labelindex()``, the results are kept separate
+    for each label, and the labelindexes are fetched in batches (optionally in parallel),
+    so this is suitable for very large lists of labels.
+
+    Args:
+        server:
+            dvid server, e.g. 'emdata3:8900'
+
+        uuid:
+            dvid uuid, e.g. 'abc9'
+
+        instance:
+            dvid labelmap instance name, e.g. 'segmentation'
+
+        labels:
+            A list of body IDs, or supervoxel IDs if ``supervoxels=True``.
+
+        supervoxels:
+            If True, interpret the given labels are supervoxel IDs, otherwise body IDs.
+            Note, if supervoxels=True in conjunction with threads (or processes),
+            there is a chance that some labelindexes will be fetched more than once
+            (if the supervoxels for a particular body happen to span across multiple batches).
+
+        format:
+            Either 'pandas' or 'dict'. See below.
+
+        batch_size:
+            How many labels to request from DVID in each /indices request.
+
+        threads:
+            If provided, fetch and decode batches in parallel using a thread pool.
+
+        processes:
+            If provided, fetch and decode batches in parallel using a process pool.
+
+    Returns:
+        If format='pandas', a DataFrame with columns ['body', 'z', 'y', 'x']
+        (or ['sv', 'z', 'y', 'x'] if supervoxels=True), with one row for each
+        scale-6 block that each label intersects.
+        If format='dict', a dict of ``{label: coords_zyx}``.
+        In either case, labels for which DVID has no labelindex are omitted.
+    """
+    assert format in ('pandas', 'dict')
+    labels = np.asarray(labels, np.uint64)
+    batches = [labels[start:start+batch_size] for start in range(0, len(labels), batch_size)]
+
+    if threads or processes:
+        f = partial(_fetch_sparsevol_coarse_batch, server, uuid, instance, supervoxels=supervoxels) # No session
+        batch_dfs = compute_parallel(f, batches, 1, threads, processes, ordered=True, leave_progress=True)
+    else:
+        f = partial(_fetch_sparsevol_coarse_batch, server, uuid, instance, supervoxels=supervoxels, session=session)
+        batch_dfs = [f(batch) for batch in tqdm_proxy(batches, disable=(len(batches) <= 1))]
+
+    if batch_dfs:
+        coarse_df = pd.concat(batch_dfs, ignore_index=True)
+    else:
+        coarse_df = _fetch_sparsevol_coarse_batch(server, uuid, instance, labels, supervoxels, session=session)
+
+    if format == 'pandas':
+        return coarse_df
+
+    # Group the coordinates by label, without a slow pandas groupby
+    label_col = coarse_df.columns[0]
+    coarse_df = coarse_df.sort_values(label_col, kind='stable')
+    label_values = coarse_df[label_col].values
+    coords_zyx = coarse_df[['z', 'y', 'x']].values
+    starts = np.flatnonzero(np.r_[True, label_values[1:] != label_values[:-1]])[:len(label_values)]
+    stops = np.r_[starts[1:], len(label_values)]
+    return { label: coords_zyx[start:stop] for label, start, stop in zip(label_values[starts].tolist(), starts, stops) }
+
+
+def _fetch_sparsevol_coarse_batch(server, uuid, instance, labels, supervoxels=False, *, session=None):
+    """
+    Helper for fetch_sparsevol_coarse_via_labelindices().
+
+    Fetch the labelindexes for the given labels (or the bodies they belong to)
+    via a single request to /indices, and return a DataFrame of
+    (label, z, y, x), listing the scale-6 blocks that each label intersects.
+    """
+    label_col = 'sv' if supervoxels else 'body'
+    labels = np.asarray(labels, np.uint64)
+
+    if supervoxels:
+        mapping = fetch_mapping(server, uuid, instance, labels, session=session)
+        bodies = pd.unique(mapping[mapping != 0])
+    else:
+        bodies = pd.unique(labels)
+
+    indices = []
+    if len(bodies) > 0:
+        indices = fetch_labelindices(server, uuid, instance, bodies, format='arrays', session=session)
+
+    label_ids = [np.zeros(0, np.uint64)]
+    block_ids = [np.zeros(0, np.uint64)]
+    for index in indices:
+        if supervoxels:
+            # Each supervoxel is listed at most once per block
+            keep = np.isin(index.svs, labels)
+            label_ids.append(index.svs[keep])
+            block_ids.append(index.block_ids[keep])
+        else:
+            # The entries for each block are contiguous in the labelindex arrays.
+            starts = np.flatnonzero(np.r_[True, index.block_ids[1:] != index.block_ids[:-1]])[:len(index.block_ids)]
+            label_ids.append(np.full(len(starts), index.label, np.uint64))
+            block_ids.append(index.block_ids[starts])
+
+    # Decode all block coordinates at once
+    coords_zyx = decode_labelindex_blocks(np.concatenate(block_ids)) // (2**6)
+
+    coarse_df = pd.DataFrame(coords_zyx.astype(np.int32), columns=['z', 'y', 'x'])
+    coarse_df.insert(0, label_col, np.concatenate(label_ids))
+    return coarse_df
+
+
 def encode_block_coords(coords):
     """
     Encodes a coordinate array into an array of uint64,
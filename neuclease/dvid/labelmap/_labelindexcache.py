@@ -0,0 +1,180 @@
+"""
+In-process cache of parsed labelindexes, for callers which repeatedly fetch
+the labelindex of the same body (e.g. the cleave server, which calls
+``find_missing_adjacencies()`` every time a user clicks on a body).
+
+When the cache is enabled, ``fetch_labelindex()`` and ``fetch_labelindices()``
+(with ``format='arrays'`` or ``format='pandas'``) keep the parsed labelindex
+(a ``LabelIndexArrays`` tuple) in memory.  Before a cached labelindex is used,
+it is revalidated by comparing its ``last_mutid`` with the body's current
+mutation ID (via ``fetch_mutation_id()``, which is much cheaper than
+downloading the labelindex itself). Stale entries are discarded and re-fetched.
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import enable_labelindex_cache, DVID_LABELINDEX_CACHE
+
+        enable_labelindex_cache(max_bytes=2e9)
+        li = fetch_labelindex(server, uuid, 'segmentation', body, format='arrays')  # slow
+        li = fetch_labelindex(server, uuid, 'segmentation', body, format='arrays')  # fast
+        print(DVID_LABELINDEX_CACHE.stats())
+"""
+import threading
+from collections import OrderedDict
+
+# Approximate memory overhead of each cache entry,
+# beyond the size of its arrays.
+_ENTRY_OVERHEAD_BYTES = 500
+
+
+class LabelIndexCache:
+    """
+    Byte-bounded, least-recently-used cache of ``LabelIndexArrays`` tuples,
+    keyed by ``(server, uuid, instance, label)``.
+
+    The cached arrays are marked read-only, since they are shared by all callers.
+    """
+    def __init__(self):
+        self.max_bytes = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._stores = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def configure(self, max_bytes=1e9):
+        """
+        Args:
+            max_bytes:
+                Approximate maximum total size of the cached labelindexes.
+                If 0, the cache is disabled.
+        """
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return { 'hits': self._hits,
+                     'misses': self._misses,
+                     'stale': self._stale,
+                     'stores': self._stores,
+                     'evictions': self._evictions,
+                     'labelindexes': len(self._entries),
+                     'bytes': self._total_bytes }
+
+    def clear(self):
+        """
+        Discard all cached labelindexes.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def contains(self, server, uuid, instance, label):
+        """
+        Return True if a labelindex for the given label is cached,
+        regardless of whether or not it is still valid.
+        """
+        with self._lock:
+            return (server, uuid, instance, int(label)) in self._entries
+
+    def get(self, server, uuid, instance, label, mutid):
+        """
+        Return the cached labelindex for the given label, or None if it isn't
+        cached or if its ``last_mutid`` doesn't match the given mutation ID
+        (in which case the stale entry is discarded).
+        """
+        key = (server, uuid, instance, int(label))
+        with self._lock:
+            arrays = self._entries.get(key)
+            if arrays is None:
+                self._misses += 1
+                return None
+
+            if arrays.last_mutid != mutid:
+                self._discard(key)
+                self._stale += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return arrays
+
+    def discard(self, server, uuid, instance, label):
+        """
+        Remove the cached labelindex for the given label (if present).
+        """
+        with self._lock:
+            self._discard((server, uuid, instance, int(label)))
+
+    def store(self, server, uuid, instance, arrays):
+        """
+        Store the given ``LabelIndexArrays`` tuple (as returned by ``parse_labelindex()``).
+        """
+        for a in arrays[:3]:
+            a.flags.writeable = False
+
+        key = (server, uuid, instance, int(arrays.label))
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = arrays
+            self._total_bytes += _entry_bytes(arrays)
+            self._stores += 1
+            self._evict()
+
+    def _discard(self, key):
+        """
+        Remove the given entry (if present). (The caller must hold self._lock.)
+        """
+        arrays = self._entries.pop(key, None)
+        if arrays is not None:
+            self._total_bytes -= _entry_bytes(arrays)
+
+    def _evict(self):
+        """
+        Discard the least-recently-used labelindexes until the cache
+        is within its maximum size. (The caller must hold self._lock.)
+        """
+        while self._entries and self._total_bytes > self.max_bytes:
+            _key, arrays = self._entries.popitem(last=False)
+            self._total_bytes -= _entry_bytes(arrays)
+            self._evictions += 1
+
+
+def _entry_bytes(arrays):
+    return arrays.block_ids.nbytes + arrays.svs.nbytes + arrays.counts.nbytes + _ENTRY_OVERHEAD_BYTES
+
+
+DVID_LABELINDEX_CACHE = LabelIndexCache()
+
+
+def enable_labelindex_cache(max_bytes=1e9):
+    """
+    Start caching labelindexes fetched via ``fetch_labelindex()``
+    and ``fetch_labelindices()`` (with ``format='arrays'`` or ``format='pandas'``).
+
+    Returns:
+        The global ``DVID_LABELINDEX_CACHE``
+    """
+    DVID_LABELINDEX_CACHE.configure(max_bytes)
+    return DVID_LABELINDEX_CACHE
+
+
+def disable_labelindex_cache():
+    """
+    Stop caching labelindexes, and discard the labelindexes already in the cache.
+    """
+    DVID_LABELINDEX_CACHE.configure(0)
+    DVID_LABELINDEX_CACHE.clear()
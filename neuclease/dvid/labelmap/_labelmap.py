@@ -1,26 +1,39 @@
 import re
 import gzip
+import zlib
+import struct
 import logging
+import threading
 from io import BytesIO
 from functools import partial
+from itertools import islice
+from contextlib import ExitStack
 from multiprocessing.pool import ThreadPool
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
+import ujson
 import numpy as np
 import pandas as pd
+import networkx as nx
+from numba import jit
 from requests import HTTPError
 
 from libdvid import DVIDNodeService, encode_label_block
 
-from ...util import Timer, round_box, extract_subvol, DEFAULT_TIMESTAMP, tqdm_proxy, ndrange, box_to_slicing, compute_parallel
+from ...util import Timer, uuids_match, round_box, extract_subvol, DEFAULT_TIMESTAMP, tqdm_proxy, ndrange, box_to_slicing, compute_parallel
 
 from .. import dvid_api_wrapper, fetch_generic_json, fetch_repo_info
+from ..coalesce import coalesced
 from ..repo import create_voxel_instance, fetch_repo_dag
-from ..kafka import read_kafka_messages, kafka_msgs_to_df
-from ..rle import parse_rle_response
+from ..kafka import read_kafka_messages
+from ..rle import parse_rle_response, iter_rle_ranges, iter_rle_batches
 
 from ._split import SplitEvent, fetch_supervoxel_splits_from_kafka
-from .labelops_pb2 import MappingOps, MappingOp
+from ._kafkacolumns import parse_labelmap_kafka_msgs
+from ._blockcache import DVID_BLOCK_CACHE
+from ._protobuf import _EMPTY_BUF, _varint_size, _write_varint
+from ._labelarray import encode_labelarray_block, decode_labelarray_block, scan_labelarray_blocks, extract_labelarray_labels, _labelarray_block_labels
 from neuclease.dvid.server import fetch_server_info
 
 logger = logging.getLogger(__name__)
@@ -165,6 +178,7 @@ def post_nextlabel(server, uuid, instance, num_labels, *, session=None):
     return (np.uint64(start), np.uint64(end))
 
 
+@coalesced
 @dvid_api_wrapper
 def fetch_supervoxels(server, uuid, instance, body_id, user=None, *, session=None):
     """
@@ -348,6 +362,7 @@ def fetch_label(server, uuid, instance, coordinate_zyx, supervoxels=False, scale
 fetch_label_for_coordinate = fetch_label
 
 
+@coalesced
 @dvid_api_wrapper
 def fetch_labels(server, uuid, instance, coordinates_zyx, supervoxels=False, scale=0, *, session=None):
     """
@@ -401,7 +416,7 @@ def fetch_labels_batched(server, uuid, instance, coordinates_zyx, supervoxels=Fa
     """
     Like fetch_labels, but fetches in batches, optionally multithreaded or multiprocessed.
 
-    See also: ``fetch_label()``, ``fectch_labels()``
+    See also: ``fetch_label()``, ``fectch_labels()``, ``fetch_labels_via_blocks()``
     """
     assert not threads or not processes, "Choose either threads or processes (not both)"
     coords_df = pd.DataFrame(coordinates_zyx, columns=['z', 'y', 'x'], dtype=np.int32)
@@ -449,12 +464,201 @@ def _fetch_labels_batch(server, uuid, instance, supervoxels, scale, batch_df):
     return batch_df
     
 
+def fetch_labels_via_blocks(server, uuid, instance, coordinates_zyx, supervoxels=False, scale=0, *,
+                            mapping=None, strategy='auto', min_block_points=8, blocks_per_batch=64, threads=0):
+    """
+    Like ``fetch_labels_batched()``, but much faster for large, dense point lists
+    (e.g. all synapses in a volume).  Instead of asking DVID to look up each point via
+    the ``/labels`` endpoint, the points are grouped by block, each block containing
+    points is downloaded once (via ``/specificblocks``, as supervoxels),
+    and the labels of all points in the block are extracted locally.
+    If body labels are requested, the supervoxel labels are then mapped to bodies
+    using an in-memory mapping.
+
+    Blocks which contain only a few points are not worth downloading in full;
+    the labels for such points are fetched via ``/labels``, as usual.
+
+    Args:
+        server, uuid, instance:
+            A labelmap instance
+
+        coordinates_zyx:
+            array of shape (N,3) with coordinates to sample (at the given scale).
+
+        supervoxels:
+            If True, return supervoxel IDs, not body IDs.
+
+        scale:
+            Which scale of the data to read from.
+            (Your coordinates must be correspondingly scaled.)
+
+        mapping:
+            Optional. The sv->body mapping to use, as returned by ``fetch_mappings()``.
+            Supervoxels which aren't listed in the mapping are assumed to be identity-mapped.
+            If not provided (and supervoxels=False), the mapping for the sampled supervoxels
+            will be fetched via ``fetch_mapping()``.
+
+        strategy:
+            How to fetch the labels for each point.  One of:
+            - 'points': use the ``/labels`` endpoint for all points (like ``fetch_labels_batched()``)
+            - 'blocks': download every block which contains a point
+            - 'auto': download blocks which contain at least ``min_block_points`` points,
+              and use ``/labels`` for the rest.
+
+        min_block_points:
+            See ``strategy``.
+
+        blocks_per_batch:
+            How many blocks to request from DVID at once.
+            Each thread holds at most one batch of blocks in memory at a time.
+
+        threads:
+            How many threads to use to fetch (and decode) batches of blocks.
+
+    Returns:
+        ndarray of N labels
+    """
+    assert strategy in ('auto', 'points', 'blocks')
+    coords = np.asarray(coordinates_zyx, np.int64)
+    assert coords.ndim == 2 and coords.shape[1] == 3
+    labels = np.zeros(len(coords), np.uint64)
+    if len(coords) == 0:
+        return labels
+
+    # Group points by block.
+    block_keys = _pack_block_coords(coords // 64)
+    unique_keys, point_blocks, block_counts = np.unique(block_keys, return_inverse=True, return_counts=True)
+    point_blocks = point_blocks.reshape(-1)
+
+    if strategy == 'points':
+        dense_blocks = np.zeros(len(unique_keys), bool)
+    elif strategy == 'blocks':
+        dense_blocks = np.ones(len(unique_keys), bool)
+    else:
+        dense_blocks = (block_counts >= min_block_points)
+
+    # Points in sparse blocks
+    sparse_points = np.flatnonzero(~dense_blocks[point_blocks])
+    if len(sparse_points) > 0:
+        labels[sparse_points] = fetch_labels_batched(server, uuid, instance, coords[sparse_points], True, scale,
+                                                     threads=threads, presort=True)
+
+    # Points in dense blocks, grouped by block: The points for the ith block
+    # are listed in point_order[point_offsets[i]:point_offsets[i+1]]
+    point_order = np.argsort(point_blocks, kind='stable')
+    point_offsets = np.zeros(len(unique_keys)+1, np.int64)
+    point_offsets[1:] = np.cumsum(block_counts)
+
+    def sample_blocks(block_indexes):
+        corners = _unpack_block_coords(unique_keys[block_indexes]) * 64
+        encoded = fetch_labelmap_specificblocks(server, uuid, instance, corners, scale, supervoxels=True)
+        buf = memoryview(encoded)
+        block_coords, spans = scan_labelarray_blocks(buf)
+        response_indexes = np.searchsorted(unique_keys, _pack_block_coords(block_coords))
+        for i, (start, stop) in zip(response_indexes, spans):
+            block = decode_labelarray_block(zlib.decompress(buf[start+16:stop], 16 + zlib.MAX_WBITS))
+            points = point_order[point_offsets[i]:point_offsets[i+1]]
+            local = coords[points] - 64 * _unpack_block_coords(unique_keys[i:i+1])
+            labels[points] = block[local[:, 0], local[:, 1], local[:, 2]]
+        return len(block_indexes)
+
+    dense_indexes = np.flatnonzero(dense_blocks)
+    batches = [dense_indexes[i:i+blocks_per_batch] for i in range(0, len(dense_indexes), blocks_per_batch)]
+    with Timer(f"Sampling {block_counts[dense_blocks].sum()} points from {len(dense_indexes)} blocks", logger):
+        if threads <= 1:
+            for batch in tqdm_proxy(batches, leave=False, logger=logger):
+                sample_blocks(batch)
+        else:
+            compute_parallel(sample_blocks, batches, threads=threads, ordered=False)
+
+    if supervoxels:
+        return labels
+
+    if mapping is None:
+        unique_svs = pd.unique(labels)
+        mapping = fetch_mapping(server, uuid, instance, unique_svs, as_series=True)
+
+    return _apply_sv_mapping(labels, mapping)
+
+
+def _pack_block_coords(block_coords_zyx):
+    """
+    Pack an array of block coordinates (N,3) into a single int64 per block,
+    which sorts in the same order as the (Z,Y,X) coordinates themselves.
+    Each coordinate must be within [-2**20, 2**20).
+    """
+    b = np.asarray(block_coords_zyx, np.int64) + 2**20
+    return (b[:, 0] << 42) | (b[:, 1] << 21) | b[:, 2]
+
+
+def _unpack_block_coords(keys):
+    """
+    Inverse of _pack_block_coords()
+    """
+    keys = np.asarray(keys, np.int64)
+    b = np.stack(((keys >> 42), (keys >> 21) & (2**21 - 1), keys & (2**21 - 1)), axis=1)
+    return b - 2**20
+
+
+def _apply_sv_mapping(svs, mapping):
+    """
+    Map the given supervoxels to bodies using the given mapping (a pd.Series, sv->body).
+    Supervoxels which aren't in the mapping are identity-mapped.
+    """
+    indexer = mapping.index.get_indexer(svs)
+    return np.where(indexer >= 0, mapping.values[indexer], svs).astype(np.uint64)
+
+
+@dvid_api_wrapper
+def fetch_labelmap_specificblocks(server, uuid, instance, corners_zyx, scale=0, supervoxels=False, *, session=None):
+    """
+    Fetch the given blocks from a labelmap instance, via the ``/specificblocks`` endpoint.
+    Unlike ``fetch_labelmap_voxels()``, the blocks need not form a contiguous box.
+
+    Args:
+        server, uuid, instance:
+            A labelmap instance
+
+        corners_zyx:
+            The starting coordinates of each block to fetch
+            (in voxel coordinates at the given scale).  Must be block-aligned.
+
+        scale:
+            Which scale of the data to read from.
+
+        supervoxels:
+            If True, request supervoxel data, not body labels.
+
+    Returns:
+        The raw encoded block data, in the same format as ``GET .../blocks``.
+        Blocks which don't exist in DVID are not included.
+        See ``parse_labelarray_data()`` or ``decode_labelarray_blocks()``.
+    """
+    corners_zyx = np.asarray(corners_zyx)
+    assert (corners_zyx % 64 == 0).all(), "Block corners must be block-aligned"
+    block_coords_xyz = (corners_zyx[:, ::-1] // 64)
+
+    params = { 'compression': 'blocks',
+               'blocks': ','.join(map(str, block_coords_xyz.reshape(-1).tolist())) }
+    if scale:
+        params['scale'] = str(scale)
+    if supervoxels:
+        params['supervoxels'] = str(bool(supervoxels)).lower()
+
+    r = session.get(f'http://{server}/api/node/{uuid}/{instance}/specificblocks', params=params)
+    r.raise_for_status()
+    return r.content
+
+
 @dvid_api_wrapper
 def fetch_sparsevol_rles(server, uuid, instance, label, supervoxels=False, scale=0, *, session=None):
     """
     Fetch the sparsevol RLE representation for a given label.
     
     See also: neuclease.dvid.rle.parse_rle_response()
+
+    For very large bodies, consider ``fetch_sparsevol_batches()``,
+    which doesn't hold the entire response in memory.
     """
     supervoxels = str(bool(supervoxels)).lower() # to lowercase string
     url = f'http://{server}/api/node/{uuid}/{instance}/sparsevol/{label}?supervoxels={supervoxels}&scale={scale}'
@@ -642,6 +846,8 @@ def fetch_complete_mappings(server, uuid, instance, include_retired=True, kafka_
         kafka_msgs:
             Optionally provide the complete labelmap kafka log if you've got it,
             in which case this function doesn't need to re-fetch it.
+            (Either a list of messages or a LabelmapKafkaColumns object,
+            as returned by parse_labelmap_kafka_msgs().)
         
         sort:
             Optional.
@@ -656,7 +862,8 @@ def fetch_complete_mappings(server, uuid, instance, include_retired=True, kafka_
     # Read complete kafka log; we need both split and cleave info
     if kafka_msgs is None:
         kafka_msgs = read_kafka_messages(server, uuid, instance)
-    split_events = fetch_supervoxel_splits_from_kafka(server, uuid, instance, kafka_msgs=kafka_msgs, session=session)
+    kafka_cols = parse_labelmap_kafka_msgs(kafka_msgs)
+    split_events = fetch_supervoxel_splits_from_kafka(server, uuid, instance, kafka_msgs=kafka_cols, session=session)
     split_tables = list(map(lambda t: np.asarray([row[:-1] for row in t], np.uint64), split_events.values()))
     if split_tables:
         split_table = np.concatenate(split_tables)
@@ -665,15 +872,10 @@ def fetch_complete_mappings(server, uuid, instance, include_retired=True, kafka_
     else:
         retired_svs = set()
 
-    def extract_cleave_fragments():
-        for msg in kafka_msgs:
-            if msg["Action"] == "cleave":
-                yield msg["CleavedLabel"]
-
     # Cleave fragment IDs (i.e. bodies that were created via a cleave)
     # should not be included in the set of 'identity' rows.
     # (These IDs are guaranteed to be disjoint from supervoxel IDs.)
-    cleave_fragments = set(extract_cleave_fragments())
+    cleave_fragments = set(kafka_cols.new_label[kafka_cols.has_action('cleave')])
 
     # Fetch base mapping
     base_mapping = fetch_mappings(server, uuid, instance, as_array=True, session=session)
@@ -737,10 +939,11 @@ def fetch_complete_mappings(server, uuid, instance, include_retired=True, kafka_
 
 
 @dvid_api_wrapper
-def post_mappings(server, uuid, instance, mappings, mutid, *, batch_size=None, session=None):
+def post_mappings(server, uuid, instance, mappings, mutid, *, batch_size=None, threads=4, session=None):
     """
     Post a list of SV-to-body mappings to DVID, provided as a ``pd.Series``.
-    Will be converted to protobuf structures for upload.
+    The mappings are serialized directly into a ``MappingOps`` protobuf message
+    (see ``encode_mappings()``) for upload.
     
     Note:
         This is not intended for general use. It is used to initialize
@@ -757,57 +960,196 @@ def post_mappings(server, uuid, instance, mappings, mutid, *, batch_size=None, s
             dvid instance name, e.g. 'segmentation'
         
         mappings:
-            ``pd.Series``, indexed by sv, bodies as value
+            ``pd.Series``, indexed by sv, bodies as value.
+            Alternatively, an array of shape (N,2), with columns [sv, body],
+            as returned by ``fetch_mappings(..., as_array=True)``.
         
         mutid:
             The mutation ID to use when posting the mappings
         
         batch_size:
-            If provided, the mappings will be sent in batches, whose sizes will
-            roughly correspond to the given size, in terms of the number of
-            supervoxels in the batch.
+            If provided, the mappings will be sent in batches of the given size,
+            in terms of the number of supervoxels in the batch.
+            (A body's supervoxels may be split across more than one batch.)
+
+        threads:
+            How many batches to encode and post concurrently.
+            (Also the maximum number of requests in flight at any time.)
+            If ``threads > 1``, the given ``session`` is not used; each worker
+            thread posts via its own default session, since sessions aren't thread-safe.
+    """
+    svs, bodies = _mapping_arrays(mappings)
+
+    # Sort once, by body, so each body's supervoxels are contiguous.
+    order = np.argsort(bodies, kind='stable')
+    svs = svs[order]
+    bodies = bodies[order]
+    del order
+
+    if batch_size is None:
+        batch_size = max(1, len(svs))
+    batch_starts = range(0, len(svs), batch_size)
+
+    # Sessions aren't thread-safe, so worker threads use their own default sessions.
+    batch_session = session if threads <= 1 else None
+
+    total_bytes = 0
+    def post_batch(start):
+        payload = _encode_mapping_ops(svs[start:start+batch_size], bodies[start:start+batch_size], mutid)
+        _post_mapping_ops(server, uuid, instance, payload, session=batch_session)
+        return len(bodies[start:start+batch_size]), len(payload)
+
+    pending = deque()
+    with ExitStack() as stack:
+        executor = stack.enter_context(ThreadPoolExecutor(max(1, threads)))
+        progress_bar = stack.enter_context(tqdm_proxy(total=len(svs), disable=(len(batch_starts) <= 1), logger=logger))
+        timer = stack.enter_context(Timer())
+
+        def wait_for_oldest():
+            nonlocal total_bytes
+            num_mappings, num_bytes = pending.popleft().result()
+            total_bytes += num_bytes
+            progress_bar.update(num_mappings)
+
+        try:
+            for start in batch_starts:
+                while len(pending) >= max(1, threads):
+                    wait_for_oldest()
+                pending.append(executor.submit(post_batch, start))
+
+            while pending:
+                wait_for_oldest()
+        except BaseException:
+            # Don't start any more uploads.
+            for f in pending:
+                f.cancel()
+            raise
+
+    if len(batch_starts) > 1:
+        seconds = max(timer.seconds, 1e-6)
+        logger.info(f"Posted {len(svs)} mappings in {len(batch_starts)} batches ({total_bytes/1e6:.1f} MB) "
+                    f"in {seconds:.1f}s ({len(svs)/seconds:.0f} mappings/s, {total_bytes/1e6/seconds:.1f} MB/s)")
+
+
+@dvid_api_wrapper
+def _post_mapping_ops(server, uuid, instance, payload, *, session=None):
     """
-    assert isinstance(mappings, pd.Series)
-    df = pd.DataFrame(mappings.rename('body'))
-    df.index.name = 'sv'
-    df = df.reset_index()
+    Helper for post_mappings().
+    Post an encoded MappingOps message.
+    """
+    r = session.post(f'http://{server}/api/node/{uuid}/{instance}/mappings', data=payload)
+    r.raise_for_status()
+
+
+def encode_mappings(mappings, mutid):
+    """
+    Serialize the given SV-to-body mappings as a ``MappingOps`` protobuf message
+    (one ``MappingOp`` per body), suitable for posting to the ``/mappings`` endpoint,
+    without constructing the protobuf structures.
+
+    Args:
+        mappings:
+            ``pd.Series``, indexed by sv, bodies as value,
+            or an array of shape (N,2), with columns [sv, body].
+
+        mutid:
+            The mutation ID to store in each ``MappingOp``.
+
+    Returns:
+        bytes
+    """
+    svs, bodies = _mapping_arrays(mappings)
+    order = np.argsort(bodies, kind='stable')
+    return _encode_mapping_ops(svs[order], bodies[order], mutid)
 
-    def _post_mapping_ops(ops_list):
-        ops = MappingOps()
-        ops.mappings.extend(ops_list)
-        payload = ops.SerializeToString()
-        r = session.post(f'http://{server}/api/node/{uuid}/{instance}/mappings', data=payload)
-        r.raise_for_status()
 
-    progress_bar = tqdm_proxy(total=len(df), disable=(batch_size is None), logger=logger)
-    progress_bar.update(0)
+def _mapping_arrays(mappings):
+    """
+    Helper for post_mappings() and encode_mappings().
+    Return the (svs, bodies) arrays of the given mappings (Series or (N,2) array).
+    """
+    if isinstance(mappings, pd.Series):
+        svs = mappings.index.values
+        bodies = mappings.values
+    else:
+        mappings = np.asarray(mappings)
+        assert mappings.ndim == 2 and mappings.shape[1] == 2
+        svs = mappings[:, 0]
+        bodies = mappings[:, 1]
+
+    svs = np.ascontiguousarray(svs, np.uint64)
+    bodies = np.ascontiguousarray(bodies, np.uint64)
+    return svs, bodies
+
 
-    batch_ops_so_far = 0
-    ops_list = []
-    for body_id, body_df in df.groupby('body'):
-        op = MappingOp()
-        op.mutid = mutid
-        op.mapped = body_id
-        op.original.extend( body_df['sv'] )
+def _encode_mapping_ops(svs, bodies, mutid):
+    """
+    Serialize the given mappings, in which each body's supervoxels
+    must be contiguous (e.g. sorted by body), as a ``MappingOps`` message.
+    """
+    size = _encode_mapping_ops_kernel(svs, bodies, mutid, _EMPTY_BUF, 0, False)
+    out = np.empty(size, np.uint8)
+    pos = _encode_mapping_ops_kernel(svs, bodies, mutid, out, 0, True)
+    assert pos == size
+    return out.tobytes()
 
-        # Add to this chunk of ops
-        ops_list.append(op)
-        batch_ops_so_far += len(op.original)
 
-        # Send if chunk is full
-        if (batch_size is not None) and (batch_ops_so_far >= batch_size):
-            _post_mapping_ops(ops_list)
-            progress_bar.update(batch_ops_so_far)
-            ops_list = [] # reset
-            batch_ops_so_far = 0
+@jit(nopython=True, nogil=True)
+def _encode_mapping_ops_kernel(svs, bodies, mutid, out, pos, write):
+    """
+    Encode the 'mappings' field of a MappingOps message (repeated MappingOp),
+    with one MappingOp for each contiguous run of identical bodies.
+    The supervoxel list of each MappingOp is 'packed', as in proto3.
+    (Default values are omitted, as in proto3.)
 
-    # send last chunk, if there are leftovers
-    if ops_list:
-        _post_mapping_ops(ops_list)
-        progress_bar.update(batch_ops_so_far)
+    If write is True, the encoded data is written to ``out``, starting at ``pos``.
+    Otherwise, nothing is written.
 
+    Returns:
+        The position after the encoded data.
+    """
+    mutid = np.uint64(mutid)
+    n = len(bodies)
+    i = 0
+    while i < n:
+        # Find this body's supervoxels and compute the size of its MappingOp message
+        body = bodies[i]
+        j = i
+        packed_size = 0
+        while j < n and bodies[j] == body:
+            packed_size += _varint_size(svs[j])
+            j += 1
+
+        op_size = 1 + _varint_size(packed_size) + packed_size
+        if mutid != 0:
+            op_size += 1 + _varint_size(mutid)
+        if body != 0:
+            op_size += 1 + _varint_size(body)
+
+        if not write:
+            pos += 1 + _varint_size(op_size) + op_size
+            i = j
+            continue
 
-def copy_mappings(src_info, dest_info, batch_size=None, *, session=None):
+        # mappings (field 1) {mutid (field 1), mapped (field 2), original (field 3, packed)}
+        out[pos] = 0x0A
+        pos = _write_varint(out, pos+1, op_size)
+        if mutid != 0:
+            out[pos] = 0x08
+            pos = _write_varint(out, pos+1, mutid)
+        if body != 0:
+            out[pos] = 0x10
+            pos = _write_varint(out, pos+1, body)
+        out[pos] = 0x1A
+        pos = _write_varint(out, pos+1, packed_size)
+        for k in range(i, j):
+            pos = _write_varint(out, pos, svs[k])
+
+        i = j
+    return pos
+
+
+def copy_mappings(src_info, dest_info, batch_size=None, threads=4, *, session=None):
     """
     Copy the complete in-memory mapping from one server to another,
     performed in batches and with a progress display.
@@ -823,16 +1165,21 @@ def copy_mappings(src_info, dest_info, batch_size=None, *, session=None):
             If provided, the mappings will be sent in batches, whose sizes will
             roughly correspond to the given size, in terms of the number of
             supervoxels in the batch.
+
+        threads:
+            How many batches to post concurrently.
+            See ``post_mappings()``.
     """
     # Pick the higher mutation id between the source and destination
     src_mutid = fetch_repo_info(*src_info[:2])["MutationID"]
     dest_mutid = fetch_repo_info(*dest_info[:2])["MutationID"]
     mutid = max(src_mutid, dest_mutid)
     
-    mappings = fetch_mappings(*src_info)
-    post_mappings(*dest_info, mappings, mutid, batch_size=batch_size, session=session)
+    mappings = fetch_mappings(*src_info, as_array=True)
+    post_mappings(*dest_info, mappings, mutid, batch_size=batch_size, threads=threads, session=session)
     
 
+@coalesced
 @dvid_api_wrapper
 def fetch_mutation_id(server, uuid, instance, body_id, *, session=None):
     response = fetch_generic_json(f'http://{server}/api/node/{uuid}/{instance}/lastmod/{body_id}', session=session)
@@ -869,6 +1216,9 @@ def fetch_sparsevol_coarse(server, uuid, instance, label_id, supervoxels=False,
 def fetch_sparsevol_coarse_threaded(server, uuid, instance, labels, supervoxels=False, num_threads=2):
     """
     Call fetch_sparsevol_coarse() for a list of labels using a ThreadPool.
+
+    For long lists of labels, ``fetch_sparsevol_coarse_via_labelindices()``
+    is much more efficient.
     
     Returns:
         dict of { label: coords }
@@ -892,20 +1242,154 @@ def fetch_sparsevol_coarse_threaded(server, uuid, instance, labels, supervoxels=
 
 
 @dvid_api_wrapper
-def fetch_sparsevol(server, uuid, instance, label, supervoxels=False, scale=0, dtype=np.int32, *, session=None):
+def fetch_sparsevol(server, uuid, instance, label, supervoxels=False, scale=0, dtype=np.int32, *, format='coords', session=None): # @ReservedAssignment
     """
     Return coordinates of all voxels in the given body/supervoxel at the given scale.
 
-    For dtype arg, see parse_rle_response()
+    For dtype and format args, see parse_rle_response()
 
     Note: At scale 0, this will be a LOT of data for any reasonably large body.
-          Use with caution.
+          Use with caution, or use format='ranges' and the run-length
+          functions in ``neuclease.dvid.rle`` (e.g. ``rle_intersection()``).
     """
     rles = fetch_sparsevol_rles(server, uuid, instance, label, supervoxels, scale, session=session)
-    return parse_rle_response(rles, dtype)
+    return parse_rle_response(rles, dtype, format)
+
+
+@dvid_api_wrapper
+def fetch_sparsevol_batches(server, uuid, instance, label, supervoxels=False, scale=0, *, format='ranges', batch_size=2**20, # @ReservedAssignment
+                            z_slab_size=None, threads=4, session=None):
+    """
+    Fetch the sparsevol of a (possibly huge) body or supervoxel,
+    and return a generator of batches of runs (or coordinates),
+    rather than a single array of all voxels.
+
+    The response is parsed as it streams in, so peak memory usage is
+    proportional to the batch size, not the size of the body.
+
+    Alternatively, the body can be fetched in Z-slabs, via several
+    bounded requests (using DVID's ``minz`` and ``maxz`` query parameters),
+    which are sent in parallel and yielded in Z order.
+    In that case, peak memory usage is proportional to the size of
+    ``threads`` slabs of the body.
+
+    Args:
+        server:
+            dvid server, e.g. 'emdata3:8900'
+
+        uuid:
+            dvid uuid, e.g. 'abc9'
+
+        instance:
+            dvid labelmap instance name, e.g. 'segmentation'
+
+        label:
+            body ID (or supervoxel ID, if ``supervoxels=True``)
+
+        supervoxels:
+            If True, interpret ``label`` as a supervoxel ID.
+
+        scale:
+            Which scale to fetch the sparsevol at.
+
+        format:
+            The format of each batch. Either 'ranges', 'rle', or 'coords'.
+            See ``parse_rle_response()``.
+
+        batch_size:
+            The maximum number of runs per batch,
+            or voxels per batch if ``format='coords'``.
+
+        z_slab_size:
+            If provided, fetch the body in Z-slabs of this thickness
+            (in voxels, at the requested scale), using several requests.
+            The body's Z-range is determined from its sparsevol-coarse.
+
+        threads:
+            How many Z-slabs to fetch in parallel (if using ``z_slab_size``).
+
+    Returns:
+        A generator. The runs are yielded in Z,Y,X order
+        (or, in the case of 'coords', the voxels are).
+
+    Example:
+
+        .. code-block:: python
+
+            voxel_count = 0
+            for ranges in fetch_sparsevol_batches(server, uuid, 'segmentation', body, z_slab_size=1024, threads=8):
+                voxel_count += rle_voxel_count(ranges)
+    """
+    assert format in ('ranges', 'rle', 'coords')
+    if not z_slab_size:
+        url = f'http://{server}/api/node/{uuid}/{instance}/sparsevol/{label}'
+        params = { 'supervoxels': str(bool(supervoxels)).lower(), 'scale': scale }
+        r = session.get(url, params=params, stream=True)
+        r.raise_for_status()
+        return _iter_sparsevol_response_batches(r, format, batch_size)
+
+    # Determine the body's Z-range (at the requested scale) from its coarse sparsevol
+    coarse_z = fetch_sparsevol_coarse(server, uuid, instance, label, supervoxels, session=session)[:, 0]
+    z_start = (64 * int(coarse_z.min())) >> scale
+    z_stop = (64 * (int(coarse_z.max()) + 1) + 2**scale - 1) >> scale
+    z_ranges = [(z, min(z + z_slab_size, z_stop)) for z in range(z_start, z_stop, z_slab_size)]
+
+    fetch_slab = partial(_fetch_sparsevol_slab, server, uuid, instance, label, supervoxels, scale) # No session
+    return _iter_sparsevol_slab_batches(fetch_slab, z_ranges, format, batch_size, threads)
+
+
+def _iter_sparsevol_response_batches(r, format, batch_size, chunk_size=2**20): # @ReservedAssignment
+    """
+    Helper for fetch_sparsevol_batches().
+    Parse a streaming /sparsevol response and yield its runs in batches.
+    """
+    with r:
+        for ranges in iter_rle_ranges(r.iter_content(chunk_size), batch_size):
+            yield from iter_rle_batches(ranges, format, batch_size)
 
 
-def compute_changed_bodies(instance_info_a, instance_info_b, *, session=None):
+def _iter_sparsevol_slab_batches(fetch_slab, z_ranges, format, batch_size, threads): # @ReservedAssignment
+    """
+    Helper for fetch_sparsevol_batches().
+    Fetch the slabs in parallel (but no more than ``threads`` at a time),
+    and yield their runs in batches, in Z order.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        z_ranges = iter(z_ranges)
+        pending = deque(executor.submit(fetch_slab, z_range) for z_range in islice(z_ranges, threads))
+        while pending:
+            ranges = pending.popleft().result()
+            for z_range in islice(z_ranges, 1):
+                pending.append(executor.submit(fetch_slab, z_range))
+            yield from iter_rle_batches(ranges, format, batch_size)
+
+
+@dvid_api_wrapper
+def _fetch_sparsevol_slab(server, uuid, instance, label, supervoxels, scale, z_range, *, session=None):
+    """
+    Helper for fetch_sparsevol_batches().
+    Fetch the runs of the given label within the given Z-range [z_start, z_stop).
+    """
+    z_start, z_stop = z_range
+    url = f'http://{server}/api/node/{uuid}/{instance}/sparsevol/{label}'
+    params = { 'supervoxels': str(bool(supervoxels)).lower(),
+               'scale': scale,
+               'minz': z_start,
+               'maxz': z_stop - 1 }
+
+    r = session.get(url, params=params)
+    if r.status_code == 404:
+        # No voxels in this slab
+        return np.zeros((0,4), np.int32)
+    r.raise_for_status()
+
+    ranges = parse_rle_response(r.content, format='ranges')
+
+    # Just in case DVID returned runs outside of the requested range
+    return ranges[(ranges[:, 0] >= z_start) & (ranges[:, 0] < z_stop)]
+
+
+def compute_changed_bodies(instance_info_a, instance_info_b, method='mappings', *, session=None):
     """
     Returns the list of all bodies whose supervoxels changed
     between uuid_a and uuid_b.
@@ -917,27 +1401,170 @@ def compute_changed_bodies(instance_info_a, instance_info_b, *, session=None):
 
         instance_info_b:
             (server, uuid, instance)
-    """
-    mapping_a = fetch_mappings(*instance_info_a, session=session)
-    mapping_b = fetch_mappings(*instance_info_b, session=session)
-    
-    assert mapping_a.name == 'body'
-    assert mapping_b.name == 'body'
-    
-    mapping_a = pd.DataFrame(mapping_a)
-    mapping_b = pd.DataFrame(mapping_b)
+
+        method:
+            Either 'mappings' or 'kafka'.
+
+            'mappings':
+                Download the raw (binary) /mappings from both nodes and diff them
+                with a sort-merge, which needs no extra RAM beyond the two mapping arrays
+                (and the list of changed bodies). Any body which gained or lost a
+                supervoxel (according to DVID's mapping tables) is returned.
+
+            'kafka':
+                Don't download the mappings at all. Instead, read the kafka log and
+                extract the mutations which were performed in one node's ancestry
+                but not the other's, and pass them to compute_affected_bodies().
+                Both nodes must belong to the same repo and instance.
+                The bodies of any new supervoxels (from 'split-supervoxel')
+                are looked up via fetch_mapping().
+                Note that the result may include bodies from failed operations,
+                and bodies which were changed and then restored to their original state.
     
-    logger.info("Aligning mappings")
-    df = mapping_a.merge(mapping_b, 'outer', left_index=True, right_index=True, suffixes=['_a', '_b'], copy=False)
+    Returns:
+        Sorted array of body IDs (excluding 0)
+    """
+    assert method in ('mappings', 'kafka')
+    if method == 'kafka':
+        return _compute_changed_bodies_from_kafka(instance_info_a, instance_info_b, session=session)
+
+    mapping_a = _fetch_sorted_mapping_array(*instance_info_a, session=session)
+    mapping_b = _fetch_sorted_mapping_array(*instance_info_b, session=session)
 
-    changed_df = df.query('body_a != body_b')
-    changed_df.fillna(0, inplace=True)
-    changed_bodies = np.unique(changed_df.values.astype(np.uint64))
-    if changed_bodies[0] == 0:
+    with Timer("Comparing mappings", logger):
+        # Count first, so we need not over-allocate the output.
+        num_changed = _diff_sorted_mappings(mapping_a, mapping_b, np.zeros(0, np.uint64), False)
+        changed_bodies = np.empty(num_changed, np.uint64)
+        _diff_sorted_mappings(mapping_a, mapping_b, changed_bodies, True)
+
+    del mapping_a, mapping_b
+    changed_bodies = np.unique(changed_bodies)
+    if len(changed_bodies) > 0 and changed_bodies[0] == 0:
         changed_bodies = changed_bodies[1:]
     return changed_bodies
 
 
+@dvid_api_wrapper
+def _fetch_sorted_mapping_array(server, uuid, instance, *, session=None):
+    """
+    Fetch the raw mapping from DVID as an (N,2) array (see fetch_mappings()),
+    sorted by supervoxel.
+
+    The (binary) response is streamed directly into a writable buffer,
+    so the mapping can be sorted in-place, without an extra copy.
+    """
+    uri = f"http://{server}/api/node/{uuid}/{instance}/mappings?format=binary"
+    with Timer(f"Fetching {uri}", logger):
+        r = session.get(uri, stream=True)
+        r.raise_for_status()
+        buf = bytearray()
+        for chunk in r.iter_content(2**24):
+            buf += chunk
+
+    mapping = np.frombuffer(buf, np.uint64).reshape(-1, 2)
+    if not _is_sorted_by_sv(mapping):
+        with Timer(f"Sorting mapping from {uuid}", logger):
+            # View each row as a single (sv, body) record to sort the rows in-place.
+            mapping.view([('sv', '<u8'), ('body', '<u8')]).sort(axis=0)
+    return mapping
+
+
+@jit(nopython=True, nogil=True)
+def _is_sorted_by_sv(mapping):
+    for i in range(1, len(mapping)):
+        if mapping[i, 0] < mapping[i-1, 0]:
+            return False
+    return True
+
+
+@jit(nopython=True, nogil=True)
+def _diff_sorted_mappings(mapping_a, mapping_b, out, write):
+    """
+    Walk through two (N,2) sv-to-body mappings (each sorted by sv) in lockstep,
+    and find the bodies of supervoxels whose mapping differs between them.
+    If a supervoxel is mapped to different bodies, both bodies are emitted.
+    If a supervoxel is present in only one mapping, its body in that mapping is emitted.
+
+    If write is False, nothing is written; the bodies are only counted
+    (so the caller can allocate an output array of the correct size).
+    Bodies may be emitted more than once.
+
+    Returns:
+        The number of bodies emitted.
+    """
+    i = 0
+    j = 0
+    n = 0
+    while i < len(mapping_a) or j < len(mapping_b):
+        if j == len(mapping_b) or (i < len(mapping_a) and mapping_a[i, 0] < mapping_b[j, 0]):
+            if write:
+                out[n] = mapping_a[i, 1]
+            n += 1
+            i += 1
+        elif i == len(mapping_a) or mapping_b[j, 0] < mapping_a[i, 0]:
+            if write:
+                out[n] = mapping_b[j, 1]
+            n += 1
+            j += 1
+        else:
+            if mapping_a[i, 1] != mapping_b[j, 1]:
+                if write:
+                    out[n] = mapping_a[i, 1]
+                    out[n+1] = mapping_b[j, 1]
+                n += 2
+            i += 1
+            j += 1
+    return n
+
+
+def _compute_changed_bodies_from_kafka(instance_info_a, instance_info_b, *, session=None):
+    """
+    Helper for compute_changed_bodies(method='kafka').
+    """
+    server, uuid_a, instance = instance_info_a
+    server_b, uuid_b, instance_b = instance_info_b
+    assert (server, instance) == (server_b, instance_b), \
+        "Can't compare nodes from different servers or instances via kafka"
+
+    # Mutations in a common ancestor are shared by both nodes.
+    # (Nodes can't be branched from until they're locked,
+    # so a common ancestor can't have been mutated after the branch point.)
+    dag = fetch_repo_dag(server, uuid_b, session=session)
+    lineage_a = _uuid_lineage(dag, uuid_a)
+    lineage_b = _uuid_lineage(dag, uuid_b)
+
+    msgs = read_kafka_messages(server, uuid_b, instance, dag_filter=None, session=session)
+
+    changed_bodies = []
+    for uuid, lineage, other_lineage in [(uuid_a, lineage_a, lineage_b), (uuid_b, lineage_b, lineage_a)]:
+        side_msgs = [msg for msg in msgs if msg['UUID'] in lineage and msg['UUID'] not in other_lineage]
+        if not side_msgs:
+            continue
+
+        new_bodies, changed, removed_bodies, new_supervoxels = compute_affected_bodies(side_msgs)
+        changed_bodies.extend([new_bodies, changed, removed_bodies])
+        if len(new_supervoxels) > 0:
+            # The new supervoxels only exist on this side.
+            changed_bodies.append(fetch_mapping(server, uuid, instance, new_supervoxels, session=session))
+
+    if not changed_bodies:
+        return np.zeros(0, np.uint64)
+
+    changed_bodies = np.unique(np.concatenate(changed_bodies).astype(np.uint64))
+    if len(changed_bodies) > 0 and changed_bodies[0] == 0:
+        changed_bodies = changed_bodies[1:]
+    return changed_bodies
+
+
+def _uuid_lineage(dag, uuid):
+    """
+    Return the set of full UUIDs for the given node and all of its ancestors.
+    """
+    matches = [u for u in dag.nodes() if uuids_match(u, uuid)]
+    assert len(matches) == 1, f"Couldn't uniquely identify node {uuid} in the repo DAG"
+    return {matches[0], *nx.ancestors(dag, matches[0])}
+
+
 @dvid_api_wrapper
 def generate_sample_coordinate(server, uuid, instance, label_id, supervoxels=False, *, session=None):
     """
@@ -947,6 +1574,9 @@ def generate_sample_coordinate(server, uuid, instance, label_id, supervoxels=Fal
     This function fetches the sparsevol-coarse to select a block
     in which the body of interest can be found, then it fetches the segmentation
     for that block and picks a point within it that lies within the body of interest.
+
+    If the labelindex cache is enabled (see ``enable_labelindex_cache()``),
+    the block is selected from the (cached) labelindex instead of the sparsevol-coarse.
     
     Args:
         server:
@@ -967,10 +1597,26 @@ def generate_sample_coordinate(server, uuid, instance, label_id, supervoxels=Fal
     Returns:
         [Z,Y,X] -- An arbitrary point within the body of interest.
     """
-    SCALE = 6 # sparsevol-coarse is always scale 6
-    coarse_block_coords = fetch_sparsevol_coarse(server, uuid, instance, label_id, supervoxels, session=session)
-    num_blocks = len(coarse_block_coords)
-    middle_block_coord = (2**SCALE) * np.array(coarse_block_coords[num_blocks//2]) // 64 * 64
+    from ._labelindex import fetch_labelindex, decode_labelindex_blocks # late import to avoid recursive import
+    from ._labelindexcache import DVID_LABELINDEX_CACHE
+
+    if DVID_LABELINDEX_CACHE.enabled:
+        if supervoxels:
+            body = fetch_mapping(server, uuid, instance, [label_id], session=session)[0]
+        else:
+            body = label_id
+        labelindex = fetch_labelindex(server, uuid, instance, body, format='arrays', session=session)
+        block_ids = labelindex.block_ids
+        if supervoxels:
+            block_ids = block_ids[labelindex.svs == label_id]
+        block_ids = np.unique(block_ids)
+        middle_block_coord = decode_labelindex_blocks(block_ids[[len(block_ids)//2]])[0]
+    else:
+        SCALE = 6 # sparsevol-coarse is always scale 6
+        coarse_block_coords = fetch_sparsevol_coarse(server, uuid, instance, label_id, supervoxels, session=session)
+        num_blocks = len(coarse_block_coords)
+        middle_block_coord = (2**SCALE) * np.array(coarse_block_coords[num_blocks//2]) // 64 * 64
+
     middle_block_box = (middle_block_coord, middle_block_coord + 64)
     
     block = fetch_labelarray_voxels(server, uuid, instance, middle_block_box, supervoxels=supervoxels, session=session)
@@ -983,8 +1629,9 @@ def generate_sample_coordinate(server, uuid, instance, label_id, supervoxels=Fal
     return middle_block_coord + nonzero_coords[0]
 
 
+@coalesced(unless=lambda kwargs: kwargs.get('format') == 'block-iterator')
 @dvid_api_wrapper
-def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=False, supervoxels=False, *, format='array', session=None):
+def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=False, supervoxels=False, *, format='array', skip_empty=False, session=None):
     """
     Fetch a volume of voxels from the given instance.
     
@@ -1011,7 +1658,9 @@ def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=Fal
         throttle:
             If True, passed via the query string to DVID, in which case DVID might return a '503' error
             if the server is too busy to service the request.
-            It is your responsibility to catch DVIDExceptions in that case.
+            If you're using the default session, such requests are automatically retried
+            (with backoff) via ``DVID_ADMISSION_CONTROL``. See ``neuclease.dvid.admission``.
+            Otherwise, it is your responsibility to catch HTTPErrors in that case.
         
         supervoxels:
             If True, request supervoxel data from the given labelmap instance.
@@ -1021,11 +1670,24 @@ def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=Fal
             If 'lazy-array', return a callable proxy that stores the compressed data internally,
             and that will inflate the data when called.
             If 'raw-response', return DVID's raw /blocks response buffer without inflating it.
+            If 'block-iterator', stream the response from DVID and return an iterator
+            of ``(corner_zyx, block)`` pairs, inflating one block at a time.
+            In that case, the blocks are NOT cropped to the requested box.
+
+            Note:
+                If the block cache is enabled (see ``enable_labelmap_block_cache()``),
+                requests in all formats except 'block-iterator' are served from
+                the cache if all of the requested blocks are present in it.
+
+        skip_empty:
+            Only used if format='block-iterator'.
+            If True, don't yield blocks which contain only label 0.
     
     Returns:
-        ndarray, with shape == (box[1] - box[0])
+        ndarray, with shape == (box[1] - box[0]),
+        or an iterator of ``(corner_zyx, block)`` (see ``format``).
     """
-    assert format in ('array', 'lazy-array', 'raw-response')
+    assert format in ('array', 'lazy-array', 'raw-response', 'block-iterator')
     box_zyx = np.asarray(box_zyx)
     assert np.issubdtype(box_zyx.dtype, np.integer), \
         f"Box has the wrong dtype.  Use an integer type, not {box_zyx.dtype}"
@@ -1055,22 +1717,39 @@ def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=Fal
     if supervoxels:
         params['supervoxels'] = str(bool(supervoxels)).lower()
 
-    r = session.get(f'http://{server}/api/node/{uuid}/{instance}/blocks/{shape_str}/{offset_str}', params=params)
-    r.raise_for_status()
+    url = f'http://{server}/api/node/{uuid}/{instance}/blocks/{shape_str}/{offset_str}'
+
+    if format == 'block-iterator':
+        r = session.get(url, params=params, stream=True)
+        r.raise_for_status()
+        return _iter_labelarray_response_blocks(r, skip_empty)
+
+    # See neuclease.dvid.labelmap._blockcache
+    content = None
+    use_cache = DVID_BLOCK_CACHE.enabled
+    if use_cache:
+        content = DVID_BLOCK_CACHE.fetch_box(server, uuid, instance, scale, supervoxels, aligned_box)
+
+    if content is None:
+        r = session.get(url, params=params)
+        r.raise_for_status()
+        content = r.content
+        if use_cache:
+            DVID_BLOCK_CACHE.store_box(server, uuid, instance, scale, supervoxels, aligned_box, content)
 
     def inflate_labelarray_blocks():
-        aligned_volume = DVIDNodeService.inflate_labelarray_blocks3D_from_raw(r.content, aligned_shape, aligned_box[0])
+        aligned_volume = DVIDNodeService.inflate_labelarray_blocks3D_from_raw(content, aligned_shape, aligned_box[0])
         requested_box_within_aligned = box_zyx - aligned_box[0]
         return extract_subvol(aligned_volume, requested_box_within_aligned )
         
-    inflate_labelarray_blocks.content = r.content
+    inflate_labelarray_blocks.content = content
     
     if format == 'array':
         return inflate_labelarray_blocks()
     elif format == 'lazy-array':
         return inflate_labelarray_blocks
     elif format == 'raw-response':
-        return r.content
+        return content
     else:
         raise AssertionError(f"Unknown format: {format}")
 
@@ -1079,6 +1758,61 @@ def fetch_labelmap_voxels(server, uuid, instance, box_zyx, scale=0, throttle=Fal
 fetch_labelarray_voxels = fetch_labelmap_voxels
 
 
+def _iter_labelarray_response_blocks(r, skip_empty=False, chunk_size=2**20):
+    """
+    Helper for ``fetch_labelmap_voxels(..., format='block-iterator')``.
+    Read a streaming /blocks response and yield its blocks one at a time,
+    as ``(corner_zyx, block)`` pairs.
+    """
+    with r:
+        for corner_zyx, block_data in iter_labelarray_block_data(r.iter_content(chunk_size)):
+            if skip_empty and is_empty_labelarray_block(block_data):
+                continue
+            block = DVIDNodeService.inflate_labelarray_blocks3D_from_raw(block_data, (64,64,64), corner_zyx)
+            yield corner_zyx, block
+
+
+def iter_labelarray_block_data(chunks):
+    """
+    Split a stream of encoded labelarray/labelmap data (as returned by
+    ``GET .../blocks?compression=blocks``) into its individual blocks.
+    Only one block is held in memory at a time (plus one chunk of input).
+
+    Args:
+        chunks:
+            An iterable of bytes objects, e.g. ``response.iter_content()``
+
+    Yields:
+        ``(corner_zyx, block_data)`` pairs, where corner_zyx is in voxel units
+        and block_data contains the block's complete encoding, including its header.
+        (See ``parse_labelarray_data()`` for format details.)
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while len(buf) - pos >= 16:
+            bx, by, bz, num_bytes = struct.unpack_from('<iiii', buf, pos)
+            end = pos + 16 + num_bytes
+            if end > len(buf):
+                break
+            corner_zyx = 64 * np.array((bz, by, bx), np.int32)
+            yield corner_zyx, bytes(buf[pos:end])
+            pos = end
+        del buf[:pos]
+
+    assert len(buf) == 0, \
+        f"Encoded block data ended unexpectedly ({len(buf)} bytes left over)"
+
+
+def is_empty_labelarray_block(block_data):
+    """
+    Return True if the given encoded labelarray block (including its 16-byte header)
+    contains only label 0.  Only the beginning of the block (its label list) is decompressed.
+    """
+    return not _labelarray_block_labels(block_data[16:]).any()
+
+
 def post_labelmap_voxels(server, uuid, instance, offset_zyx, volume, scale=0, downres=False, noindexing=False, throttle=False, *, session=None):
     """
     Post a supervoxel segmentation subvolume to a labelmap instance.
@@ -1119,7 +1853,9 @@ def post_labelmap_voxels(server, uuid, instance, offset_zyx, volume, scale=0, do
         throttle:
             If True, passed via the query string to DVID, in which case DVID might return a '503' error
             if the server is too busy to service the request.
-            It is your responsibility to catch DVIDExceptions in that case.
+            If you're using the default session, such requests are automatically retried
+            (with backoff) via ``DVID_ADMISSION_CONTROL``. See ``neuclease.dvid.admission``.
+            Otherwise, it is your responsibility to catch HTTPErrors in that case.
         
         supervoxels:
             If True, request supervoxel data from the given labelmap instance.
@@ -1145,7 +1881,7 @@ post_labelarray_voxels = post_labelmap_voxels
 
 
 @dvid_api_wrapper
-def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, downres=False, noindexing=False, throttle=False, *, is_raw=False, gzip_level=6, session=None):
+def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, downres=False, noindexing=False, throttle=False, *, is_raw=False, gzip_level=6, threads=0, session=None):
     """
     Post supervoxel data to a labelmap instance, from a list of blocks.
     
@@ -1182,7 +1918,9 @@ def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, d
         throttle:
             If True, passed via the query string to DVID, in which case DVID might return a '503' error
             if the server is too busy to service the request.
-            It is your responsibility to catch DVIDExceptions in that case.
+            If you're using the default session, such requests are automatically retried
+            (with backoff) via ``DVID_ADMISSION_CONTROL``. See ``neuclease.dvid.admission``.
+            Otherwise, it is your responsibility to catch HTTPErrors in that case.
         
         is_raw:
             If you have already encoded the blocks in DVID's compressed labelmap format
@@ -1191,6 +1929,11 @@ def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, d
 
         gzip_level:
             The level of gzip compression to use, from 0 (no compression) to 9.
+
+        threads:
+            If nonzero, encode the blocks in parallel, using a threadpool.
+            See ``encode_labelarray_blocks()``.
+            For large uploads, consider ``post_labelmap_blocks_pipelined()``.
     """
     assert not downres or scale == 0, "downres option is only valid for scale 0"
 
@@ -1198,7 +1941,7 @@ def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, d
         assert isinstance(blocks, (bytes, memoryview))
         body_data = blocks
     else:
-        body_data = encode_labelarray_blocks(corners_zyx, blocks, gzip_level)
+        body_data = encode_labelarray_blocks(corners_zyx, blocks, gzip_level, threads)
     
     if not body_data:
         return # No blocks
@@ -1218,7 +1961,123 @@ def post_labelmap_blocks(server, uuid, instance, corners_zyx, blocks, scale=0, d
 post_labelarray_blocks = post_labelmap_blocks
 
 
-def encode_labelarray_blocks(corners_zyx, blocks, gzip_level=6):
+def post_labelmap_blocks_pipelined(server, uuid, instance, corners_zyx, blocks, scale=0, downres=False, noindexing=False, throttle=False, *,
+                                   gzip_level=6, batch_size=256, threads=4, max_pending_batches=2, progress=True, session=None):
+    """
+    Post a (potentially very large) sequence of blocks to a labelmap instance,
+    in batches, using a pipeline which overlaps block encoding with network I/O:
+    While batch N is being sent to DVID (in a background thread),
+    batch N+1 is encoded (using a threadpool).
+
+    The blocks are consumed lazily, so they may be produced by a generator.
+    At most ``max_pending_batches`` encoded batches (plus the one being encoded)
+    are held in memory at once.  If DVID can't keep up, encoding is paused.
+
+    Args:
+        server, uuid, instance, scale, downres, noindexing, throttle, gzip_level:
+            See ``post_labelmap_blocks()``
+
+        corners_zyx:
+            Iterable of block corners (in full-res voxel coordinates)
+
+        blocks:
+            Iterable of uint64 blocks, each with shape (64,64,64),
+            in the same order as ``corners_zyx``.
+
+        batch_size:
+            How many blocks to send in each request.
+
+        threads:
+            How many threads to use for encoding blocks.
+            If 0, encode in the calling thread (still overlapped with network I/O).
+
+        max_pending_batches:
+            How many encoded batches may be waiting to be sent (or being sent).
+
+        progress:
+            If True, show a progress bar (counted in blocks).
+
+        session:
+            Optional. The session to use for the POST requests,
+            which are all sent from a single background thread.
+
+    Returns:
+        DataFrame of per-stage statistics, indexed by stage ('encode' and 'post'),
+        with columns for the number of blocks and bytes processed by each stage,
+        the total time spent in each stage, and the resulting throughput.
+        The 'encode' stage counts uncompressed voxel bytes, and the 'post' stage
+        counts encoded bytes.  The 'stall' row indicates how long encoding was
+        paused while waiting for DVID to accept previous batches.
+    """
+    assert batch_size >= 1
+    assert max_pending_batches >= 1
+    assert not downres or scale == 0, "downres option is only valid for scale 0"
+
+    stats = pd.DataFrame(0.0, index=['encode', 'post', 'stall'], columns=['blocks', 'bytes', 'seconds'])
+    stats_lock = threading.Lock()
+
+    def post_batch(body_data, num_blocks):
+        with Timer() as timer:
+            post_labelmap_blocks( server, uuid, instance, None, body_data, scale, downres, noindexing, throttle,
+                                  is_raw=True, session=session )
+        with stats_lock:
+            stats.loc['post'] += (num_blocks, len(body_data), timer.seconds)
+        return num_blocks
+
+    pairs = zip(corners_zyx, blocks)
+    pending = deque()
+
+    with ExitStack() as stack:
+        post_executor = stack.enter_context(ThreadPoolExecutor(1))
+        encode_pool = None
+        if threads:
+            encode_pool = stack.enter_context(ThreadPool(threads))
+        progress_bar = stack.enter_context(tqdm_proxy(disable=not progress, logger=logger))
+
+        def wait_for_oldest():
+            num_blocks = pending.popleft().result()
+            progress_bar.update(num_blocks)
+
+        try:
+            while True:
+                batch = list(islice(pairs, batch_size))
+                if not batch:
+                    break
+
+                batch_corners, batch_blocks = zip(*batch)
+                del batch
+                with Timer() as timer:
+                    body_data = _encode_labelarray_blocks(batch_corners, batch_blocks, gzip_level, encode_pool)
+                with stats_lock:
+                    stats.loc['encode'] += (len(batch_blocks), 8 * 64**3 * len(batch_blocks), timer.seconds)
+                del batch_blocks
+
+                # Bound the memory in use: wait for DVID to catch up if necessary.
+                with Timer() as timer:
+                    while len(pending) >= max_pending_batches:
+                        wait_for_oldest()
+                with stats_lock:
+                    stats.loc['stall', 'seconds'] += timer.seconds
+
+                pending.append(post_executor.submit(post_batch, body_data, len(batch_corners)))
+                del body_data
+
+            while pending:
+                wait_for_oldest()
+        except BaseException:
+            # Don't start any more uploads.
+            for f in pending:
+                f.cancel()
+            raise
+
+    stats['blocks'] = stats['blocks'].astype(int)
+    stats['bytes'] = stats['bytes'].astype(int)
+    stats['MB/s'] = stats['bytes'] / 1e6 / stats['seconds']
+    stats.loc['stall', ['blocks', 'bytes', 'MB/s']] = 0
+    return stats
+
+
+def encode_labelarray_blocks(corners_zyx, blocks, gzip_level=6, threads=0):
     """
     Encode a sequence of labelmap blocks to bytes, in the
     format expected by dvid's ``/blocks`` endpoint.
@@ -1240,10 +2099,28 @@ def encode_labelarray_blocks(corners_zyx, blocks, gzip_level=6):
         
         gzip_level:
             The level of gzip compression to use, from 0 (no compression) to 9.
+
+        threads:
+            If nonzero, encode and compress the blocks in parallel, using a threadpool.
+            In that case, the blocks are encoded with ``encode_labelarray_block()``
+            (which releases the GIL) instead of libdvid's encoder.
+            (The encoded data is identical either way.)
     
     Returns:
         memoryview
     """
+    if threads == 0:
+        return _encode_labelarray_blocks(corners_zyx, blocks, gzip_level)
+
+    with ThreadPool(threads) as pool:
+        return _encode_labelarray_blocks(corners_zyx, blocks, gzip_level, pool)
+
+
+def _encode_labelarray_blocks(corners_zyx, blocks, gzip_level=6, pool=None):
+    """
+    Helper for encode_labelarray_blocks() and post_labelmap_blocks_pipelined().
+    If a pool is provided, use it to encode the blocks.
+    """
     if not hasattr(corners_zyx, '__len__'):
         corners_zyx = list(corners_zyx)
 
@@ -1260,34 +2137,48 @@ def encode_labelarray_blocks(corners_zyx, blocks, gzip_level=6):
     if hasattr(blocks, '__len__'):
         assert len(blocks) == len(corners_zyx)
 
-    corners_xyz = corners_zyx[:, ::-1].copy('C')
+    if pool is None:
+        encoded_blocks = [*map(partial(_compress_label_block, gzip_level=gzip_level), blocks)]
+    else:
+        encoded_blocks = pool.map(partial(_compress_label_block, gzip_level=gzip_level, native=True), blocks)
+    assert len(encoded_blocks) == len(corners_zyx)
 
+    # Each block gets a 16-byte header:
+    # its block coordinate (in X,Y,Z order) and its encoded length.
     # dvid wants block coordinates, not voxel coordinates
-    encoded_corners = map(bytes, corners_xyz // 64)
+    headers = np.empty((len(encoded_blocks), 4), np.int32)
+    headers[:, :3] = corners_zyx[:, ::-1] // 64
+    headers[:, 3] = np.fromiter(map(len, encoded_blocks), np.int32, len(encoded_blocks))
 
-    def _encode_label_block(block):
-        # We wrap the C++ call in this little pure-python function
-        # solely for the sake of nice profiler output.
-        return encode_label_block(block)
+    # Copy everything into a single preallocated buffer.
+    starts = np.zeros(len(encoded_blocks)+1, np.int64)
+    starts[1:] = np.cumsum(16 + headers[:, 3].astype(np.int64))
+    body_data = np.empty(starts[-1], np.uint8)
+    for start, header, block_buf in zip(starts[:-1], headers.view(np.uint8), encoded_blocks):
+        body_data[start:start+16] = header
+        body_data[start+16:start+16+len(block_buf)] = np.frombuffer(block_buf, np.uint8)
 
-    encoded_blocks = []
-    for block in blocks:
-        assert block.shape == (64,64,64)
-        block = np.asarray(block, np.uint64, 'C')
-        encoded_blocks.append( gzip.compress(_encode_label_block(block), gzip_level) )
-        del block
-    assert len(encoded_blocks) == len(corners_xyz)
+    return memoryview(body_data)
 
-    encoded_lengths = np.fromiter(map(len, encoded_blocks), np.int32)
-    
-    stream = BytesIO()
-    for corner_buf, len_buf, block_buf in zip(encoded_corners, encoded_lengths, encoded_blocks):
-        stream.write(corner_buf)
-        stream.write(len_buf)
-        stream.write(block_buf)
 
-    body_data = stream.getbuffer()
-    return body_data
+def _compress_label_block(block, gzip_level, native=False):
+    """
+    Encode and gzip a single block.
+    Helper for _encode_labelarray_blocks().
+    """
+    assert block.shape == (64,64,64)
+    block = np.asarray(block, np.uint64, 'C')
+    if native:
+        encoded = encode_labelarray_block(block)
+    else:
+        encoded = _encode_label_block(block)
+    return gzip.compress(encoded, gzip_level)
+
+
+def _encode_label_block(block):
+    # We wrap the C++ call in this little pure-python function
+    # solely for the sake of nice profiler output.
+    return encode_label_block(block)
 
 
 def encode_labelarray_volume(offset_zyx, volume, gzip_level=6):
@@ -1381,7 +2272,7 @@ def decode_labelarray_volume(box_zyx, encoded_data):
     return DVIDNodeService.inflate_labelarray_blocks3D_from_raw(encoded_data, shape, box_zyx[0])
 
 
-def parse_labelarray_data(encoded_data, extract_labels=True):
+def parse_labelarray_data(encoded_data, extract_labels=True, *, format='dict', threads=0): # @ReservedAssignment
     """
     For a buffer of encoded labelarray/labelmap data,
     extract the block IDs and label list for each block,
@@ -1397,13 +2288,27 @@ def parse_labelarray_data(encoded_data, extract_labels=True):
         extract_labels:
             If True, extract the list of labels contained within the block.
             This is somewhat expensive because it requires decompressing the block's
-            gzip-compressed portion.
+            gzip-compressed portion (but only the label list is decompressed).
+
+        format:
+            Either 'dict' or 'arrays'. See return value explanation.
+            For large responses, 'arrays' is much more efficient.
+
+        threads:
+            If nonzero, extract the label lists in parallel, using a threadpool.
     
     Returns:
-        spans, or (spans, labels) depending on whether or not extract_labels is True,
-        where spans and labels are both dicts using block_ids as keys:
-            spans: { block_id: (start, stop) }
-            labels: { block_id: label_ids }
+        If format == 'dict':
+            spans, or (spans, labels) depending on whether or not extract_labels is True,
+            where spans and labels are both dicts using block_ids as keys:
+                spans: { block_id: (start, stop) }
+                labels: { block_id: label_ids }
+
+        If format == 'arrays':
+            (block_ids, spans) or (block_ids, spans, labels, label_offsets),
+            where block_ids is an array of shape (N,3), spans has shape (N,2),
+            and the label lists are given in "CSR" form:
+            The labels for block i are ``labels[label_offsets[i]:label_offsets[i+1]]``
     """
     # The format for each block is:
     # - 12 bytes for the block (X,Y,Z) location (its upper corner)
@@ -1421,33 +2326,27 @@ def parse_labelarray_data(encoded_data, extract_labels=True):
     #                       sub-block indices.
     # 
     # See dvid's ``POST .../blocks`` documentation for more details.
-
+    # (Also see neuclease.dvid.labelmap._labelarray)
     assert isinstance(encoded_data, (bytes, memoryview))
+    assert format in ('dict', 'arrays')
 
-    spans = {}
-    labels = {}
-
-    pos = 0
-    while pos < len(encoded_data):
-        start_pos = pos
-        x, y, z, num_bytes = np.frombuffer(encoded_data[pos:pos+16], np.int32)
-        pos += 16
-        end_pos = pos + num_bytes
-        spans[(z, y, x)] = (start_pos, end_pos)
+    block_ids, spans = scan_labelarray_blocks(encoded_data)
+    if extract_labels:
+        labels, label_offsets = extract_labelarray_labels(encoded_data, spans, threads)
 
+    if format == 'arrays':
         if extract_labels:
-            block_data = gzip.decompress( encoded_data[pos:end_pos] )
-            gx, gy, gz, num_labels = np.frombuffer(block_data[:16], np.uint32)
-            assert gx == gy == gz == 8, "Invalid block data"
-            block_labels = np.frombuffer(block_data[16:16+8*num_labels], np.uint64)
-            labels[(z, y, x)] = block_labels
-        
-        pos = end_pos
+            return block_ids, spans, labels, label_offsets
+        return block_ids, spans
 
-    if extract_labels:
-        return (spans, labels)
-    else:
-        return spans
+    block_keys = [*map(tuple, block_ids.tolist())]
+    spans_dict = dict(zip(block_keys, map(tuple, spans.tolist())))
+    if not extract_labels:
+        return spans_dict
+
+    labels_dict = { k: labels[start:stop]
+                    for k, start, stop in zip(block_keys, label_offsets[:-1], label_offsets[1:]) }
+    return (spans_dict, labels_dict)
 
 
 @dvid_api_wrapper
@@ -1746,57 +2645,38 @@ def labelmap_kafka_msgs_to_df(kafka_msgs, default_timestamp=DEFAULT_TIMESTAMP, d
             still be included in the output.
     
     """
-    df = kafka_msgs_to_df(kafka_msgs, drop_duplicates=False, default_timestamp=default_timestamp)
+    msgs = list(kafka_msgs)
+    if msgs and hasattr(msgs[0], 'value'):
+        msgs = [rec.value for rec in msgs]
+    if msgs and not isinstance(msgs[0], dict):
+        msgs = [ujson.loads(msg) for msg in msgs]
 
-    # Append action and 'body'
-    df['action'] = [msg['Action'] for msg in df['msg']]
+    cols = parse_labelmap_kafka_msgs(msgs, default_timestamp)
+    # The ID columns are int64 (not uint64), for compatibility with existing callers.
+    df = pd.DataFrame({ 'timestamp': cols.timestamp,
+                        'uuid': cols.uuid,
+                        'mutid': cols.mutid.astype(np.int64),
+                        'action': np.asarray(cols.action, object),
+                        'target_body': cols.target_body.astype(np.int64),
+                        'target_sv': cols.target_sv.astype(np.int64),
+                        'msg': msgs })
 
+    is_complete = cols.is_complete
     if drop_completes:
-        completes = df['action'].map(lambda s: s.endswith('-complete'))
-        df = df[~completes].copy()
-    
-    mutation_bodies = defaultdict(lambda: 0)
-    mutation_svs = defaultdict(lambda: 0)
-    
-    target_bodies = []
-    target_svs = []
-    
-    # This logic is somewhat more complex than you might think is necessary,
-    # but that's because the kafka logs (sadly) contain duplicate mutation IDs,
-    # i.e. the mutation ID was not unique in our earlier logs.
-    for msg in df['msg'].values:
-        action = msg['Action']
-        try:
-            mutid = msg['MutationID']
-        except KeyError:
-            mutid = 0
-
-        if not action.endswith('complete'):
-            target_body = 0
-            target_sv = 0
-
-            if action == 'cleave':
-                target_body = msg['OrigLabel']
-            elif action in ('merge', 'split'):
-                target_body = msg['Target']
-            elif action == 'split-supervoxel':
-                target_sv = msg['Supervoxel']
-
-            target_bodies.append(target_body)
-            target_svs.append(target_sv)
-
-            mutation_bodies[mutid] = target_body
-            mutation_svs[mutid] = target_sv
-
-        else:
-            # The ...-complete messages contain nothing but the action, uuid, and mutation ID,
-            # but as a convenience we will match them with the target_body or target_sv,
-            # based on the most recent message with a matching mutation ID.
-            target_bodies.append( mutation_bodies[mutid] )
-            target_svs.append( mutation_svs[mutid] )
-
-    df['target_body'] = target_bodies
-    df['target_sv'] = target_svs
+        df = df[~is_complete].copy()
+    elif is_complete.any():
+        # The ...-complete messages contain nothing but the action, uuid, and mutation ID,
+        # but as a convenience we will match them with the target_body or target_sv,
+        # based on the most recent message with a matching mutation ID.
+        # (We can't simply join on mutid, because the kafka logs (sadly)
+        # contain duplicate mutation IDs, i.e. the mutation ID was not unique in our earlier logs.)
+        source_rows = pd.Series(np.where(is_complete, np.nan, np.arange(len(df))))
+        source_rows = source_rows.groupby(cols.mutid).ffill().values
+        matched = ~np.isnan(source_rows)
+        source_rows = np.where(matched, source_rows, 0).astype(np.int64)
+        for col in ('target_body', 'target_sv'):
+            values = df[col].values
+            df[col] = np.where(is_complete & ~matched, 0, values[source_rows])
 
     return df[['timestamp', 'uuid', 'mutid', 'action', 'target_body', 'target_sv', 'msg']]
 
@@ -1818,7 +2698,8 @@ def compute_affected_bodies(kafka_msgs):
         neuclease.dvid.kafka.filter_kafka_msgs_by_timerange()
 
     Args:
-        Kafka log for a labelmap instance, obtained via read_kafka_messages().
+        Kafka log for a labelmap instance, obtained via read_kafka_messages(),
+        or a LabelmapKafkaColumns object (see parse_labelmap_kafka_msgs()).
     
     Returns:
         new_bodies, changed_bodies, removed_bodies, new_supervoxels
@@ -1836,37 +2717,27 @@ def compute_affected_bodies(kafka_msgs):
         >>> possibly_outdated_bodies = (new_bodies | changed_bodies | sv_split_bodies)
     
     """
-    new_bodies = set()
-    changed_bodies = set()
-    removed_bodies = set()
-    new_supervoxels = set()
-    
-    for msg in kafka_msgs:
-        if msg['Action'].endswith('complete'):
-            continue
-        
-        if msg['Action'] == 'cleave':
-            changed_bodies.add( msg['OrigLabel'] )
-            new_bodies.add( msg['CleavedLabel'] )
-    
-        if msg['Action'] == 'merge':
-            changed_bodies.add( msg['Target'] )
-            labels = set( msg['Labels'] )
-            removed_bodies |= labels
-            changed_bodies -= labels
-            new_bodies -= labels
-        
-        if msg['Action'] == 'split':
-            changed_bodies.add( msg['Target'] )
-            new_bodies.add( msg['NewLabel'] )
-            
-        if msg['Action'] == 'split-supervoxel':
-            new_supervoxels.add(msg['SplitSupervoxel'])
-            new_supervoxels.add(msg['RemainSupervoxel'])
-    
-    new_bodies = np.fromiter(new_bodies, np.uint64)
-    changed_bodies = np.fromiter(changed_bodies, np.uint64)
-    removed_bodies = np.fromiter(removed_bodies, np.uint64)
-    new_supervoxels = np.fromiter(new_supervoxels, np.uint64)
+    cols = parse_labelmap_kafka_msgs(kafka_msgs)
+
+    removed_bodies = pd.unique(cols.merged_labels)
+
+    # A body which is merged away is no longer 'new' or 'changed',
+    # unless it is mentioned again by a subsequent message
+    # (e.g. if the merge failed and the body was later cleaved).
+    last_merge_rows = pd.Series(cols.csr_rows('merged_labels')).groupby(cols.merged_labels).max()
+
+    def not_merged_afterwards(bodies, rows):
+        last_merge = last_merge_rows.reindex(bodies).fillna(-1).values
+        return np.unique(bodies[rows > last_merge])
+
+    is_cleave_or_split = cols.has_action('cleave', 'split')
+    rows = np.flatnonzero(is_cleave_or_split)
+    new_bodies = not_merged_afterwards(cols.new_label[rows], rows)
+
+    rows = np.flatnonzero(is_cleave_or_split | cols.has_action('merge'))
+    changed_bodies = not_merged_afterwards(cols.target_body[rows], rows)
+
+    is_sv_split = cols.has_action('split-supervoxel')
+    new_supervoxels = pd.unique(np.concatenate((cols.split_sv[is_sv_split], cols.remain_sv[is_sv_split])))
 
     return new_bodies, changed_bodies, removed_bodies, new_supervoxels
@@ -0,0 +1,429 @@
+"""
+An in-memory supervoxel-to-body mapping for a labelmap instance,
+which is kept up-to-date by applying the mutations from the instance's
+kafka log, rather than re-fetching the complete mapping from DVID.
+
+``fetch_complete_mappings()`` takes minutes on large volumes.
+A ``LabelmapMapping`` only needs to be fetched once (or loaded from a local
+snapshot), and can then be updated in a fraction of a second by applying
+the merge, cleave, split, and split-supervoxel messages which have been
+logged since the mapping's ``last_mutid``.
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import LabelmapMapping
+
+        mapping = None
+        if os.path.exists('mapping-snapshot.npz'):
+            mapping = LabelmapMapping.load('mapping-snapshot.npz')
+            if mapping.is_compatible(server, uuid, 'segmentation'):
+                mapping.update(server, uuid, 'segmentation')
+            else:
+                mapping = None
+
+        if mapping is None:
+            mapping = LabelmapMapping.from_dvid(server, uuid, 'segmentation')
+        mapping.save('mapping-snapshot.npz')
+
+        bodies = mapping.loc[svs]  # Same as with fetch_complete_mappings()
+"""
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from ...util import Timer, uuids_match
+
+logger = logging.getLogger(__name__)
+
+
+class LabelmapMapping:
+    """
+    A complete sv-to-body mapping (as returned by ``fetch_complete_mappings()``),
+    which can be updated incrementally from the labelmap kafka log.
+
+    The mapping supports the same lookups as the ``pd.Series`` returned by
+    ``fetch_complete_mappings()`` (e.g. ``mapping.loc[svs]``, ``mapping.index``,
+    ``mapping == body``), which are forwarded to the current ``series``.
+
+    Updates never modify a published ``series`` in-place.
+    Instead, a new Series is constructed and swapped in when the update is complete,
+    so readers in other threads never see a partially-applied update.
+    (Readers that need several consistent lookups should fetch ``mapping.series`` once.)
+    """
+    def __init__(self, mapping, last_mutid=0, include_retired=True, source=None):
+        """
+        Args:
+            mapping:
+                pd.Series(index=sv, data=body), as returned by fetch_complete_mappings().
+
+            last_mutid:
+                The mutation ID of the most recent mutation reflected in the mapping.
+                Only kafka messages with greater mutation IDs will be applied by update().
+
+            include_retired:
+                Whether or not the mapping includes rows for 'retired' supervoxels
+                (i.e. supervoxels which have been split), which map to 0.
+                Determines whether or not newly retired supervoxels
+                are mapped to 0 or dropped from the mapping.
+
+            source:
+                Optional. The labelmap instance the mapping was obtained from, as a tuple:
+                ``(server, uuid, instance, data_uuid)``, where ``data_uuid`` is the
+                instance's 'DataUUID' (which distinguishes it from other instances that
+                had the same name).  Stored in snapshots, and used by ``is_compatible()``.
+        """
+        assert isinstance(mapping, pd.Series)
+        if not mapping.index.is_monotonic_increasing:
+            mapping = mapping.sort_index()
+
+        self.include_retired = include_retired
+        self.source = source and tuple(source)
+        self._update_lock = threading.Lock()
+        self._state = (_normalize_series(mapping), int(last_mutid))
+
+    @classmethod
+    def from_dvid(cls, server, uuid, instance, include_retired=True, kafka_msgs=None, *, session=None):
+        """
+        Fetch the complete mapping from DVID (via fetch_complete_mappings()).
+
+        Note:
+            The kafka log is read BEFORE the mapping is fetched, so the mapping may
+            reflect some mutations that occur after ``last_mutid``.  That's harmless:
+            When those mutations are replayed by update(), the end result is the same.
+        """
+        from ..kafka import read_kafka_messages
+        from ._labelmap import fetch_complete_mappings
+
+        source = _fetch_source(server, uuid, instance, session=session)
+        if kafka_msgs is None:
+            kafka_msgs = read_kafka_messages(server, uuid, instance)
+
+        last_mutid = max((msg.get('MutationID', 0) for msg in kafka_msgs), default=0)
+        mapping = fetch_complete_mappings(server, uuid, instance, include_retired, kafka_msgs, sort='sv', session=session)
+        return cls(mapping, last_mutid, include_retired, source)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a mapping snapshot which was written via save().
+        """
+        with np.load(path) as npz:
+            mapping = pd.Series(npz['bodies'], index=npz['svs'])
+            source = None
+            if 'data_uuid' in npz.files:
+                source = tuple(str(npz[k]) for k in ('server', 'uuid', 'instance', 'data_uuid'))
+            return cls(mapping, int(npz['last_mutid']), bool(npz['include_retired']), source)
+
+    def save(self, path):
+        """
+        Save a snapshot of the mapping (and its last_mutid and source) to the given .npz path.
+        """
+        series, last_mutid = self._state
+        source = {}
+        if self.source:
+            source = dict(zip(('server', 'uuid', 'instance', 'data_uuid'), self.source))
+        np.savez(path, svs=series.index.values, bodies=series.values,
+                 last_mutid=last_mutid, include_retired=self.include_retired, **source)
+
+    def is_compatible(self, server, uuid, instance, *, session=None):
+        """
+        Determine whether or not this mapping can be brought up-to-date
+        for the given labelmap instance via ``update()``, i.e. whether it came
+        from the same instance (same server, name, and DataUUID) and from
+        the given node or one of its ancestors.
+
+        Mappings without a known ``source`` (e.g. old snapshots) are never compatible.
+        """
+        from ..repo import fetch_repo_dag
+        from ._labelmap import _uuid_lineage
+
+        if not self.source:
+            return False
+
+        src_server, src_uuid, src_instance, src_data_uuid = self.source
+        if (src_server, src_instance) != (server, instance):
+            return False
+
+        target_server, _target_uuid, target_instance, target_data_uuid = _fetch_source(server, uuid, instance, session=session)
+        if target_data_uuid != src_data_uuid:
+            return False
+
+        dag = fetch_repo_dag(target_server, uuid, session=session)
+        return any(uuids_match(src_uuid, u) for u in _uuid_lineage(dag, uuid))
+
+    @property
+    def series(self):
+        """
+        The current mapping, as pd.Series(index=sv, data=body).
+        Do not modify it.
+        """
+        return self._state[0]
+
+    @property
+    def last_mutid(self):
+        return self._state[1]
+
+    def update(self, server, uuid, instance, kafka_msgs=None):
+        """
+        Read the kafka log for the given labelmap instance,
+        and apply the mutations that have been logged since last_mutid.
+
+        Returns:
+            The number of kafka messages that were applied.
+        """
+        from ..kafka import read_kafka_messages
+
+        if kafka_msgs is None:
+            kafka_msgs = read_kafka_messages(server, uuid, instance)
+        num_applied = self.apply_kafka_messages(kafka_msgs)
+
+        # The mapping now reflects the given node.
+        if self.source and (self.source[0], self.source[2]) == (server, instance):
+            self.source = (server, uuid, instance, self.source[3])
+        return num_applied
+
+    def apply_kafka_messages(self, kafka_msgs):
+        """
+        Apply the given labelmap kafka messages to the mapping.
+        Messages whose mutation ID is not greater than last_mutid are ignored.
+
+        Returns:
+            The number of kafka messages that were applied.
+        """
+        from ._labelmap import labelmap_kafka_msgs_to_df
+
+        with self._update_lock:
+            series, last_mutid = self._state
+
+            kafka_msgs = [msg for msg in kafka_msgs if msg.get('MutationID', 0) > last_mutid]
+            if len(kafka_msgs) == 0:
+                return 0
+
+            msgs_df = labelmap_kafka_msgs_to_df(kafka_msgs, drop_completes=True)
+            with Timer(f"Applying {len(msgs_df)} mutations to the mapping", logger):
+                changes = _MappingChanges(series, msgs_df)
+                series = _apply_changes(series, changes.sv_bodies, self.include_retired)
+
+            last_mutid = max(last_mutid, max(msg['MutationID'] for msg in kafka_msgs))
+            self._state = (series, last_mutid)
+            return len(msgs_df)
+
+    # Forward all other lookups (e.g. loc, index, values) to the current Series.
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.series, name)
+
+    def __getitem__(self, key):
+        return self.series[key]
+
+    def __len__(self):
+        return len(self.series)
+
+    def __iter__(self):
+        return iter(self.series)
+
+    def __contains__(self, sv):
+        return sv in self.series.index
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.series.values, dtype)
+
+    def __eq__(self, other):
+        return self.series == other
+
+    def __ne__(self, other):
+        return self.series != other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"LabelmapMapping(last_mutid={self.last_mutid}, {len(self.series)} supervoxels)"
+
+
+class _MappingChanges:
+    """
+    Helper for LabelmapMapping.apply_kafka_messages().
+
+    Replays the mutations in a labelmap kafka DataFrame,
+    tracking only the supervoxels and bodies they touch.
+    The results are in ``sv_bodies``, a dict of ``{sv: new_body}``
+    (where retired supervoxels map to 0).
+    """
+    def __init__(self, series, msgs_df):
+        self.sv_bodies = {}
+        self.body_svs = {}
+
+        # These are the only bodies whose complete set of supervoxels must be known,
+        # so we find them all with a single pass over the mapping.
+        # We also look up the initial bodies of all supervoxels the messages mention.
+        self.tracked_bodies = set()
+        referenced_svs = []
+        for action, msg in msgs_df[['action', 'msg']].itertuples(index=False):
+            if action == 'merge':
+                self.tracked_bodies.add(msg['Target'])
+                self.tracked_bodies.update(msg['Labels'])
+            elif action == 'cleave':
+                self.tracked_bodies.update((msg['OrigLabel'], msg['CleavedLabel']))
+                referenced_svs.extend(msg['CleavedSupervoxels'])
+            elif action == 'renumber':
+                self.tracked_bodies.update((msg['OrigLabel'], msg['NewLabel']))
+            elif action == 'split':
+                self.tracked_bodies.update((msg['Target'], msg['NewLabel']))
+                referenced_svs.extend(map(int, (msg['SVSplits'] or {}).keys()))
+            elif action == 'split-supervoxel':
+                referenced_svs.append(msg['Supervoxel'])
+
+        svs = series.index.values
+        bodies = series.values
+        tracked_rows = pd.Series(bodies).isin(np.fromiter(self.tracked_bodies, np.uint64)).values
+        tracked = pd.Series(svs[tracked_rows], index=bodies[tracked_rows])
+        self.initial_body_svs = { body: set(svs) for body, svs in tracked.groupby(level=0) }
+
+        # Bodies are also checked as supervoxels (see _svs(), below).
+        referenced_svs = np.array([*referenced_svs, *self.tracked_bodies], np.uint64)
+        if len(svs) > 0:
+            pos = np.minimum(svs.searchsorted(referenced_svs), len(svs) - 1)
+            found = (svs[pos] == referenced_svs)
+            self.initial_sv_bodies = dict(zip(referenced_svs[found].tolist(), bodies[pos[found]].tolist()))
+        else:
+            self.initial_sv_bodies = {}
+        self.initial_sv_bodies.update(zip(tracked.values.tolist(), tracked.index.tolist()))
+
+        for action, msg in msgs_df[['action', 'msg']].itertuples(index=False):
+            if action == 'merge':
+                for label in msg['Labels']:
+                    for sv in list(self._svs(label)):
+                        self._assign(sv, msg['Target'])
+            elif action == 'cleave':
+                self._new_body(msg['CleavedLabel'])
+                for sv in msg['CleavedSupervoxels']:
+                    self._assign(sv, msg['CleavedLabel'])
+            elif action == 'renumber':
+                self._new_body(msg['NewLabel'])
+                for sv in list(self._svs(msg['OrigLabel'])):
+                    self._assign(sv, msg['NewLabel'])
+            elif action == 'split':
+                self._new_body(msg['NewLabel'])
+                for old_sv, split_info in (msg['SVSplits'] or {}).items():
+                    self._assign(int(old_sv), 0)
+                    self._assign(split_info['Split'], msg['NewLabel'])
+                    self._assign(split_info['Remain'], msg['Target'])
+            elif action == 'split-supervoxel':
+                body = self._body(msg['Supervoxel'])
+                self._assign(msg['Supervoxel'], 0)
+                self._assign(msg['SplitSupervoxel'], body)
+                self._assign(msg['RemainSupervoxel'], body)
+            else:
+                logger.warning(f"Ignoring unrecognized labelmap action '{action}' (mutation {msg.get('MutationID')})")
+
+    def _body(self, sv):
+        try:
+            return self.sv_bodies[sv]
+        except KeyError:
+            pass
+        # Unmapped supervoxels are implicitly mapped to themselves.
+        return self.initial_sv_bodies.get(sv, sv)
+
+    def _svs(self, body):
+        try:
+            return self.body_svs[body]
+        except KeyError:
+            pass
+
+        svs = self.initial_body_svs.get(body)
+        if svs is None:
+            # Single-supervoxel bodies are not necessarily listed in the mapping.
+            svs = {body} if self._body(body) == body else set()
+        self.body_svs[body] = svs
+        return svs
+
+    def _new_body(self, body):
+        """
+        Start tracking a body which was just created by a mutation.
+        (Unlike existing bodies, it can't be an implicit single-supervoxel body.)
+        """
+        if body not in self.body_svs:
+            self.body_svs[body] = set(self.initial_body_svs.get(body, ()))
+
+    def _assign(self, sv, body):
+        old_body = self._body(sv)
+        if old_body in self.tracked_bodies:
+            self._svs(old_body).discard(sv)
+        if body in self.tracked_bodies:
+            self._svs(body).add(sv)
+        self.sv_bodies[sv] = body
+
+
+def _apply_changes(series, sv_bodies, include_retired):
+    """
+    Helper for LabelmapMapping.apply_kafka_messages().
+    Return a new Series with the given changes applied.
+    (The given Series is not modified.)
+    """
+    if len(sv_bodies) == 0:
+        return series
+
+    changed_svs = np.fromiter(sv_bodies.keys(), np.uint64, len(sv_bodies))
+    new_bodies = np.fromiter(sv_bodies.values(), np.uint64, len(sv_bodies))
+
+    svs = series.index.values
+    if len(svs) > 0:
+        pos = np.minimum(svs.searchsorted(changed_svs), len(svs) - 1)
+        exists = (svs[pos] == changed_svs)
+    else:
+        pos = np.zeros(len(changed_svs), np.int64)
+        exists = np.zeros(len(changed_svs), bool)
+
+    bodies = series.values.copy()
+    bodies[pos[exists]] = new_bodies[exists]
+
+    keep = None
+    if not include_retired:
+        drop_pos = pos[exists & (new_bodies == 0)]
+        if len(drop_pos):
+            keep = np.ones(len(svs), bool)
+            keep[drop_pos] = False
+
+    added = ~exists
+    if not include_retired:
+        added &= (new_bodies != 0)
+
+    if keep is None and not added.any():
+        # Same index, so it need not be rebuilt.
+        return _normalize_series(pd.Series(bodies, index=series.index))
+
+    if keep is not None:
+        svs = svs[keep]
+        bodies = bodies[keep]
+
+    svs = np.concatenate((svs, changed_svs[added]))
+    bodies = np.concatenate((bodies, new_bodies[added]))
+    order = np.argsort(svs, kind='stable')
+    return _normalize_series(pd.Series(bodies[order], index=svs[order]))
+
+
+def _normalize_series(s):
+    """
+    Return a shallow copy of the given Series, with the index and column names we use.
+    (The given Series is not modified.)
+    """
+    s = s.copy(deep=False)
+    s.index = s.index.rename('sv')
+    s.name = 'body'
+    return s
+
+
+def _fetch_source(server, uuid, instance, *, session=None):
+    """
+    Return the (server, full_uuid, instance, data_uuid) of the given labelmap instance.
+    """
+    from ..repo import expand_uuid
+    from ..node import fetch_instance_info
+
+    data_uuid = fetch_instance_info(server, uuid, instance, session=session)['Base']['DataUUID']
+    return (server, expand_uuid(server, uuid, session=session), instance, data_uuid)
@@ -0,0 +1,67 @@
+"""
+Helpers for encoding and decoding protobuf varints,
+used to (de)serialize protobuf messages without constructing the message structures.
+"""
+import numpy as np
+from numba import jit
+
+# Placeholder output buffer, for the 'size-only' pass of two-pass encoders
+# (which compute the encoded size before allocating the output).
+_EMPTY_BUF = np.zeros(0, np.uint8)
+
+
+@jit(nopython=True, nogil=True)
+def _read_varint(buf, pos):
+    """
+    Read a protobuf varint from the given position.
+    Returns the value (as uint64) and the position after the varint.
+    """
+    result = np.uint64(0)
+    shift = np.uint64(0)
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= np.uint64(b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += np.uint64(7)
+
+
+def _varint_bytes(value):
+    """
+    Encode the given non-negative integer as a protobuf varint.
+    """
+    value = int(value)
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+@jit(nopython=True, nogil=True)
+def _varint_size(value):
+    """
+    The number of bytes required to encode the given value as a protobuf varint.
+    """
+    value = np.uint64(value)
+    size = 1
+    while value >= 0x80:
+        value >>= np.uint64(7)
+        size += 1
+    return size
+
+
+@jit(nopython=True, nogil=True)
+def _write_varint(out, pos, value):
+    """
+    Write the given value as a protobuf varint, and return the position after it.
+    """
+    value = np.uint64(value)
+    while value >= 0x80:
+        out[pos] = (value & np.uint64(0x7F)) | np.uint64(0x80)
+        value >>= np.uint64(7)
+        pos += 1
+    out[pos] = value
+    return pos + 1
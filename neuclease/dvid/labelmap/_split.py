@@ -9,6 +9,7 @@ import networkx as nx
 from ...util import Timer, find_root
 from .. import dvid_api_wrapper
 from ..kafka import read_kafka_messages
+from ._kafkacolumns import parse_labelmap_kafka_msgs
 
 logger = logging.getLogger(__name__)
 
@@ -138,7 +139,8 @@ def fetch_supervoxel_splits_from_kafka(server, uuid, instance, actions=['split',
         
         kafka_msgs:
             The first step of this function is to fetch the kafka log, but if you've already downloaded it,
-            you can provide it here.  Should be a list of parsed JSON structures.
+            you can provide it here.  Should be a list of parsed JSON structures,
+            or a LabelmapKafkaColumns object (see parse_labelmap_kafka_msgs()).
 
     Returns:
         Dict of { uuid: event_list }, where event_list is a list of SplitEvent tuples.
@@ -150,25 +152,41 @@ def fetch_supervoxel_splits_from_kafka(server, uuid, instance, actions=['split',
         f"Invalid actions: {actions}"
     
     if kafka_msgs is None:
-        msgs = read_kafka_messages(server, uuid, instance, action_filter=actions, dag_filter='leaf-and-parents', session=session)
-    else:
-        msgs = list(filter(lambda msg: msg["Action"] in actions, kafka_msgs))
-    
+        kafka_msgs = read_kafka_messages(server, uuid, instance, action_filter=actions, dag_filter='leaf-and-parents', session=session)
+    cols = parse_labelmap_kafka_msgs(kafka_msgs)
+
     # Supervoxels can be split via either /split or /split-supervoxel.
     # We need to parse them both.
+    # Each table has columns [row, mutid, old, remain, split], where 'row' is the message index.
+    tables = []
+    if 'split-supervoxel' in actions:
+        rows = np.flatnonzero(cols.has_action('split-supervoxel'))
+        tables.append(np.array([rows, cols.mutid[rows], cols.target_sv[rows], cols.remain_sv[rows], cols.split_sv[rows]], np.uint64).transpose())
+    else:
+        tables.append(np.zeros((0,5), np.uint64))
+
+    if 'split' in actions:
+        split_rows = cols.has_action('split')
+        rows = cols.csr_rows('sv_splits')
+        tables.append(np.concatenate((np.array([rows, cols.mutid[rows]], np.uint64).transpose(), cols.sv_splits), axis=1))
+
+        null_splits = split_rows & (np.diff(cols.sv_splits_ptr) == 0)
+        for body in cols.target_body[null_splits]:
+            logger.error(f"SVSplits is null for body {body}")
+    else:
+        tables.append(np.zeros((0,5), np.uint64))
+
+    # Restore the original (log) order, keeping the order of the SVSplits within each message.
+    table = np.concatenate(tables)
+    types = np.array(["split-supervoxel"] * len(tables[0]) + ["split"] * len(tables[1]), object)
+    order = np.argsort(table[:, 0], kind='stable')
+    table = table[order]
+    types = types[order]
+
     events = {}
-    for msg in msgs:
-        if msg['Action'] == 'split-supervoxel':
-            event = SplitEvent( msg["MutationID"], msg["Supervoxel"], msg["RemainSupervoxel"], msg["SplitSupervoxel"], "split-supervoxel" )
-            events.setdefault(msg["UUID"], []).append( event )
-    
-        elif msg['Action'] == 'split':
-            if msg["SVSplits"] is None:
-                logger.error(f"SVSplits is null for body {msg['Target']}")
-                continue
-            for old_sv_str, split_info in msg["SVSplits"].items():
-                event = SplitEvent(msg["MutationID"], int(old_sv_str), split_info["Remain"], split_info["Split"], "split")
-                events.setdefault(msg["UUID"], []).append( event )
+    uuids = np.asarray(cols.uuid, object)[table[:, 0].astype(np.int64)]
+    for msg_uuid, (_row, mutid, old, remain, split), _type in zip(uuids, table.tolist(), types):
+        events.setdefault(msg_uuid, []).append( SplitEvent(mutid, old, remain, split, _type) )
 
     return events
 
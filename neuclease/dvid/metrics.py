@@ -0,0 +1,191 @@
+"""
+Opt-in instrumentation of the requests we send to DVID.
+
+When enabled, every request sent via a default DVID session
+(i.e. every ``@dvid_api_wrapper`` function which wasn't given an explicit
+``session``) is recorded in the global ``DVID_METRICS`` registry,
+grouped by HTTP method and DVID endpoint (e.g. ``('GET', 'blocks')``).
+
+Example:
+
+    .. code-block:: python
+
+        from neuclease.dvid import enable_dvid_metrics, DVID_METRICS
+
+        enable_dvid_metrics()
+        fetch_labelmap_voxels(server, uuid, 'segmentation', box)
+        print(DVID_METRICS.to_dataframe())
+        DVID_METRICS.dump('dvid-metrics.json')
+"""
+import time
+import threading
+from urllib.parse import urlparse
+
+import ujson
+import numpy as np
+import pandas as pd
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, np.inf)
+
+
+class DvidMetrics:
+    """
+    Thread-safe registry of per-endpoint request statistics:
+    request counts, latency histograms, response bytes, and error counts.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._start_time = time.time()
+
+    def record(self, method, url, seconds, nbytes=0, status=None):
+        """
+        Record a single request.
+
+        Args:
+            method:
+                HTTP method, e.g. 'GET'
+            url:
+                The full request URL (it will be reduced to its endpoint name).
+            seconds:
+                The time it took to send the request and receive the response.
+            nbytes:
+                The size of the response body.
+            status:
+                The HTTP status code of the response,
+                or None if no response was received at all (e.g. a connection error).
+        """
+        key = (method, endpoint_name(url))
+        bucket = int(np.searchsorted(LATENCY_BUCKETS, seconds))
+        with self._lock:
+            try:
+                stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = _EndpointStats()
+
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bytes += nbytes
+            stats.histogram[bucket] += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            if status == 503:
+                stats.unavailable += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._start_time = time.time()
+
+    def to_dict(self):
+        """
+        Return the statistics as a JSON-serializable dict, of the form:
+        ``{ "METHOD endpoint": {"count": ..., "seconds": ..., ...} }``
+        """
+        with self._lock:
+            stats = { f'{method} {endpoint}': s.to_dict()
+                      for (method, endpoint), s in sorted(self._stats.items()) }
+            elapsed = time.time() - self._start_time
+
+        return { 'enabled': self.enabled,
+                 'elapsed_seconds': elapsed,
+                 'latency_buckets': [str(b) for b in LATENCY_BUCKETS],
+                 'endpoints': stats }
+
+    def to_json(self, **kwargs):
+        kwargs.setdefault("escape_forward_slashes", False)
+        return ujson.dumps(self.to_dict(), **kwargs)
+
+    def dump(self, path):
+        """
+        Write the statistics to the given path as JSON.
+        """
+        with open(path, 'w') as f:
+            f.write(self.to_json(indent=2))
+
+    def to_dataframe(self):
+        """
+        Return a summary of the statistics as a DataFrame,
+        indexed by (method, endpoint), sorted by total time.
+        The latency histograms are not included.
+        """
+        columns = ['count', 'seconds', 'mean_seconds', 'max_seconds', 'bytes', 'errors', 'unavailable']
+        with self._lock:
+            rows = [(method, endpoint, *(s.to_dict()[c] for c in columns))
+                    for (method, endpoint), s in self._stats.items()]
+
+        df = pd.DataFrame(rows, columns=['method', 'endpoint', *columns])
+        return df.set_index(['method', 'endpoint']).sort_values('seconds', ascending=False)
+
+
+class _EndpointStats:
+    """
+    Helper for DvidMetrics. Accumulated statistics for a single endpoint.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.errors = 0
+        self.unavailable = 0
+        self.histogram = np.zeros(len(LATENCY_BUCKETS), np.int64)
+
+    def to_dict(self):
+        return { 'count': self.count,
+                 'seconds': self.seconds,
+                 'mean_seconds': self.seconds / max(self.count, 1),
+                 'max_seconds': self.max_seconds,
+                 'bytes': self.bytes,
+                 'errors': self.errors,
+                 'unavailable': self.unavailable,
+                 'latency_histogram': self.histogram.tolist() }
+
+
+def endpoint_name(url):
+    """
+    Reduce a DVID request URL to the name of its endpoint.
+
+    Example:
+
+        >>> endpoint_name('http://emdata3:8900/api/node/abc9/segmentation/sparsevol/123?scale=2')
+        'sparsevol'
+        >>> endpoint_name('http://emdata3:8900/api/repo/abc9/info')
+        'repo/info'
+        >>> endpoint_name('http://emdata3:8900/api/server/info')
+        'server/info'
+    """
+    parts = urlparse(url).path.strip('/').split('/')
+    if parts[0] != 'api' or len(parts) < 2:
+        return '/'.join(parts)
+
+    if parts[1] == 'node' and len(parts) >= 5:
+        # /api/node/<uuid>/<instance>/<endpoint>/...
+        return parts[4]
+
+    if parts[1] == 'node' and len(parts) == 4:
+        # /api/node/<uuid>/<action>, e.g. commit or branch
+        return f'node/{parts[3]}'
+
+    if parts[1] == 'repo' and len(parts) >= 4:
+        # /api/repo/<uuid>/<endpoint>
+        return f'repo/{parts[3]}'
+
+    return '/'.join(parts[1:3])
+
+
+DVID_METRICS = DvidMetrics()
+
+
+def enable_dvid_metrics(enabled=True, reset=False):
+    """
+    Start (or stop) recording statistics for all requests sent via
+    default DVID sessions into the global ``DVID_METRICS`` registry.
+    """
+    DVID_METRICS.enabled = enabled
+    if reset:
+        DVID_METRICS.reset()
+
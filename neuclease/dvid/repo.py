@@ -1,3 +1,5 @@
+import time
+import logging
 from collections.abc import Iterable
 
 import pandas as pd
@@ -6,6 +8,8 @@ import networkx as nx
 from ..util import uuids_match
 from . import dvid_api_wrapper, fetch_generic_json
 
+logger = logging.getLogger(__name__)
+
 VOXEL_INSTANCE_TYPENAMES = """\
 float32blk
 googlevoxels
@@ -424,3 +428,45 @@ def is_locked(server, uuid):
     repo_info = fetch_repo_info(server, uuid)
     uuid = expand_uuid(server, uuid, repo_info=repo_info)
     return repo_info['DAG']['Nodes'][uuid]['Locked']
+
+
+def is_locked_memoized(server, uuid, known_nodes, lock, recheck_seconds):
+    """
+    Determine whether or not the given UUID is locked,
+    using (and updating) a caller-provided memo of previous answers.
+
+    Locked nodes stay locked forever, so that answer is remembered permanently.
+    Unlocked nodes are re-checked every ``recheck_seconds``.
+    If the lock status can't be determined, the node is treated as
+    unlocked (and the answer isn't remembered).
+
+    Args:
+        server:
+            dvid server, e.g. 'emdata3:8900'
+        uuid:
+            dvid uuid
+        known_nodes:
+            dict of ``{(server, uuid): (locked, check_time)}``
+        lock:
+            A lock which guards ``known_nodes``
+        recheck_seconds:
+            How long an 'unlocked' answer remains valid.
+
+    Returns:
+        bool
+    """
+    now = time.time()
+    with lock:
+        locked, checked = known_nodes.get((server, uuid), (False, -float('inf')))
+    if locked or now - checked < recheck_seconds:
+        return locked
+
+    try:
+        locked = is_locked(server, uuid)
+    except Exception as ex:
+        logger.warning(f"Couldn't determine whether {uuid} is locked: {ex}")
+        return False
+
+    with lock:
+        known_nodes[(server, uuid)] = (locked, now)
+    return locked
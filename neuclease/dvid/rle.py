@@ -1,3 +1,8 @@
+import struct
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from numba import jit
 from numba.types import int32
@@ -5,6 +10,8 @@ from numba.typed import List
 
 import pandas as pd
 
+from ..util import SparseBlockMask
+
 def extract_rle_size_and_first_coord(rle_payload_bytes):
     """
     Given a binary RLE payload as returned by the /sparsevol endpoint,
@@ -67,7 +74,7 @@ def parse_rle_response(response_bytes, dtype=np.int32, format='coords'):
             you can save some RAM by selecting np.int16
 
         format:
-            Either 'coords' or 'rle'.  See return value explanation.
+            Either 'coords', 'rle', or 'ranges'.  See return value explanation.
 
     Return:
         If format == 'coords', returns an array of coordinates of the form:
@@ -89,10 +96,19 @@ def parse_rle_response(response_bytes, dtype=np.int32, format='coords'):
             and lengths is a 1-D array:
             
                 [length, length, ...]
+
+        If format == 'ranges', returns a single array of runs:
+
+            [[Z,Y,X1,X2], [Z,Y,X1,X2], ...]
+
+            (The interval [X1,X2] is INCLUSIVE, as in runlength_encode_to_ranges().)
+            This is the representation used by the run-length algebra functions
+            in this module (e.g. ``rle_union()``), which don't require decoding
+            the runs into one coordinate per voxel.
     """
     assert isinstance(response_bytes, bytes)
     assert dtype in (np.int32, np.int16)
-    assert format in ('coords', 'rle')
+    assert format in ('coords', 'rle', 'ranges')
     descriptor = response_bytes[0]
     ndim = response_bytes[1]
     run_dimension = response_bytes[2]
@@ -109,36 +125,167 @@ def parse_rle_response(response_bytes, dtype=np.int32, format='coords'):
     assert len(rle_items) == run_count, \
         f"run_count ({run_count}) doesn't match data array length ({len(rle_items)})"
 
-    rle_starts_xyz = rle_items[:,:3]
-    rle_starts_zyx = rle_starts_xyz[:,::-1]
-    rle_lengths = rle_items[:,3]
-
-    # Sadly, the decode function requires contiguous arrays, so we must copy.
-    rle_starts_zyx = rle_starts_zyx.copy('C')
-    rle_lengths = rle_lengths.copy('C')
-
     # For now, DVID always returns a voxel_count of 0, so we can't make this assertion.
     #assert rle_lengths.sum() == _voxel_count,\
     #    f"Voxel count ({voxel_count}) doesn't match expected sum of run-lengths ({rle_lengths.sum()})"
 
-    if dtype == np.int16:
-        assert rle_starts_zyx[:2].min() >= -(2**15), "Can't return np.int16 -- result would overflow"
-        assert rle_starts_zyx[:2].max() < 2**15, "Can't return np.int16 -- result would overflow"
-        assert (rle_starts_zyx[:,2] + rle_lengths).min() >= -(2**15), "Can't return np.int16 -- result would overflow"
-        assert (rle_starts_zyx[:,2] + rle_lengths).max() < 2**15, "Can't return np.int16 -- result would overflow"
-        rle_starts_zyx = rle_starts_zyx.astype(np.int16)
-        rle_lengths = rle_lengths.astype(np.int16)
+    if dtype == np.int16 and len(rle_items) > 0:
+        # Columns are X,Y,Z,N
+        assert rle_items[:, :3].min() >= -(2**15), "Can't return np.int16 -- result would overflow"
+        assert rle_items[:, 1:3].max() < 2**15, "Can't return np.int16 -- result would overflow"
+        assert (rle_items[:, 0] + rle_items[:, 3]).max() < 2**15, "Can't return np.int16 -- result would overflow"
+
+    if format == 'ranges':
+        return _rle_items_to_ranges(rle_items).astype(dtype, copy=False)
 
     if format == 'rle':
+        rle_starts_zyx = rle_items[:, 2::-1].astype(dtype, order='C')
+        rle_lengths = rle_items[:, 3].astype(dtype)
         return rle_starts_zyx, rle_lengths
 
-    dense_coords = runlength_decode_from_lengths(rle_starts_zyx, rle_lengths)
-    assert dense_coords.dtype == dtype
-    
-    assert rle_lengths.sum() == len(dense_coords), "Got the wrong number of coordinates!"
+    # Decode directly from the response buffer, without intermediate copies.
+    dense_coords = np.empty((rle_items[:, 3].sum(dtype=np.int64), 3), dtype)
+    _runlength_decode_items(rle_items, dense_coords)
     return dense_coords
 
 
+def iter_rle_ranges(chunks, batch_size=2**20):
+    """
+    Parse a stream of (legacy) RLE data as returned by DVID's ``/sparsevol``
+    endpoint (e.g. ``response.iter_content()``), and yield the runs in batches.
+    At most one batch (plus one chunk of input) is held in memory at a time.
+
+    Args:
+        chunks:
+            An iterable of bytes objects
+
+        batch_size:
+            Maximum number of runs per batch.
+
+    Yields:
+        Arrays of runs (int32) ``[[Z,Y,X1,X2], ...]``,
+        in the same form as ``parse_rle_response(..., format='ranges')``.
+    """
+    buf = bytearray()
+    run_count = None
+    runs_parsed = 0
+    for chunk in chunks:
+        buf += chunk
+        if run_count is None:
+            if len(buf) < 12:
+                continue
+            assert (buf[0], buf[1], buf[2]) == (0, 3, 0), \
+                "Expected a 3D payload in DVID's 'Legacy RLE' format, with runs along X"
+            run_count = struct.unpack_from('<I', buf, 8)[0]
+            del buf[:12]
+
+        while len(buf) >= 16*batch_size:
+            yield _rle_items_to_ranges(np.frombuffer(buf, np.int32, 4*batch_size).reshape(-1, 4))
+            del buf[:16*batch_size]
+            runs_parsed += batch_size
+
+    assert run_count is not None, "RLE data ended before its header was complete"
+    assert len(buf) % 16 == 0, \
+        f"RLE data ended unexpectedly ({len(buf) % 16} bytes left over)"
+
+    if len(buf) > 0:
+        yield _rle_items_to_ranges(np.frombuffer(buf, np.int32).reshape(-1, 4))
+        runs_parsed += len(buf) // 16
+
+    assert runs_parsed == run_count, \
+        f"run_count ({run_count}) doesn't match the number of runs received ({runs_parsed})"
+
+
+def iter_rle_batches(rle_ranges_zyx, format='ranges', batch_size=2**20): # @ReservedAssignment
+    """
+    Split a table of runs into batches, in one of the formats
+    supported by ``parse_rle_response()``.
+
+    Args:
+        rle_ranges_zyx:
+            Table of runs [[Z,Y,X1,X2], ...]
+
+        format:
+            'ranges', 'rle', or 'coords'
+
+        batch_size:
+            Maximum number of runs per batch, or voxels per batch if format='coords'.
+            (Individual runs are not split, so a batch of coords
+            may exceed batch_size if a single run is longer than that.)
+    """
+    assert format in ('ranges', 'rle', 'coords')
+    ranges = np.asarray(rle_ranges_zyx)
+    if format == 'coords':
+        stops = _voxel_batch_stops(np.ascontiguousarray(ranges), batch_size)
+    else:
+        stops = np.minimum(np.arange(batch_size, len(ranges) + batch_size, batch_size), len(ranges))
+
+    start = 0
+    for stop in stops.tolist():
+        batch = ranges[start:stop]
+        start = stop
+        if format == 'ranges':
+            yield batch
+        elif format == 'rle':
+            yield rle_lengths_from_ranges(batch)
+        else:
+            yield runlength_decode_from_ranges(np.ascontiguousarray(batch, np.int32))
+
+
+@jit(nopython=True, nogil=True)
+def _voxel_batch_stops(ranges, batch_size):
+    """
+    Helper for iter_rle_batches().
+    Choose batch boundaries (between runs) such that each batch
+    contains at most batch_size voxels (unless a single run is longer than that).
+    """
+    stops = np.empty(len(ranges), np.int64)
+    n = 0
+    count = 0
+    for i in range(len(ranges)):
+        length = ranges[i, 3] - ranges[i, 2] + 1
+        if count > 0 and count + length > batch_size:
+            stops[n] = i
+            n += 1
+            count = 0
+        count += length
+    if count > 0:
+        stops[n] = len(ranges)
+        n += 1
+    return stops[:n]
+
+
+def _rle_items_to_ranges(rle_items_xyzn):
+    """
+    Convert runs in DVID's [[X,Y,Z,N], ...] format to [[Z,Y,X1,X2], ...]
+    """
+    ranges = np.empty((len(rle_items_xyzn), 4), np.int32)
+    ranges[:, 0] = rle_items_xyzn[:, 2]
+    ranges[:, 1] = rle_items_xyzn[:, 1]
+    ranges[:, 2] = rle_items_xyzn[:, 0]
+    ranges[:, 3] = rle_items_xyzn[:, 0] + rle_items_xyzn[:, 3] - 1
+    return ranges
+
+
+@jit(nopython=True, nogil=True)
+def _runlength_decode_items(rle_items_xyzn, coords):
+    """
+    Helper for parse_rle_response().
+    Decode runs in DVID's [[X,Y,Z,N], ...] format into the
+    given (preallocated) array of [Z,Y,X] coordinates.
+    """
+    c = 0
+    for i in range(len(rle_items_xyzn)):
+        x0 = rle_items_xyzn[i, 0]
+        y = rle_items_xyzn[i, 1]
+        z = rle_items_xyzn[i, 2]
+        for x in range(x0, x0 + rle_items_xyzn[i, 3]):
+            coords[c, 0] = z
+            coords[c, 1] = y
+            coords[c, 2] = x
+            c += 1
+
+
 def rle_box_dilation(start_coords, lengths, radius):
     """
     Dilate the given RLEs by some radius, using simple
@@ -474,3 +621,548 @@ def runlength_decode_from_ranges(rle_array_zyx):
             c += 1
 
     return coords
+
+
+#
+# Run-length algebra
+#
+# The functions below operate on tables of runs in the same
+# form that runlength_encode_to_ranges() produces:
+#
+#     [[Z,Y,X1,X2],
+#      [Z,Y,X1,X2],
+#      ...]
+#
+# where the interval [X1,X2] is INCLUSIVE (following DVID conventions).
+# The voxels are never decoded, so even billion-voxel bodies require
+# only a few MB of RAM.
+#
+# Results are always "normalized": sorted by Z,Y,X1, with no
+# overlapping or adjacent runs in the same row (see rle_normalize()).
+#
+
+def rle_ranges_from_lengths(rle_start_coords_zyx, rle_lengths):
+    """
+    Convert RLEs from the format used by runlength_decode_from_lengths()
+    (i.e. start coordinates and lengths) into a table of runs [[Z,Y,X1,X2], ...].
+    """
+    rle_start_coords_zyx = np.asarray(rle_start_coords_zyx)
+    rle_lengths = np.asarray(rle_lengths)
+    ranges = np.empty((len(rle_lengths), 4), rle_start_coords_zyx.dtype)
+    ranges[:, :3] = rle_start_coords_zyx
+    ranges[:, 3] = rle_start_coords_zyx[:, 2] + rle_lengths - 1
+    return ranges
+
+
+def rle_lengths_from_ranges(rle_ranges_zyx):
+    """
+    Convert a table of runs [[Z,Y,X1,X2], ...] into start coordinates and lengths,
+    as used by runlength_decode_from_lengths().
+
+    Returns:
+        (start_coords, lengths)
+    """
+    rle_ranges_zyx = np.asarray(rle_ranges_zyx)
+    start_coords = rle_ranges_zyx[:, :3].copy('C')
+    lengths = (1 + rle_ranges_zyx[:, 3] - rle_ranges_zyx[:, 2]).astype(rle_ranges_zyx.dtype)
+    return start_coords, lengths
+
+
+def rle_normalize(rle_ranges_zyx):
+    """
+    Sort the given runs by Z,Y,X1, and combine any runs that overlap or touch.
+    Empty runs (X2 < X1) are dropped.
+
+    If the runs are already normalized, they're returned as-is (no copy).
+    """
+    ranges = np.asarray(rle_ranges_zyx)
+    if len(ranges) == 0:
+        return np.zeros((0,4), ranges.dtype)
+
+    assert ranges.ndim == 2 and ranges.shape[1] == 4
+    ranges = np.ascontiguousarray(ranges)
+    if _rle_is_normalized(ranges):
+        return ranges
+
+    ranges = ranges[ranges[:, 3] >= ranges[:, 2]]
+    order = np.lexsort(ranges[:, 2::-1].transpose())
+    return _rle_merge_sorted(ranges[order])
+
+
+def rle_union(a, b):
+    """
+    Return the runs that cover all voxels in either of the given run tables.
+    """
+    return _rle_binary_op(a, b, _UNION)
+
+
+def rle_intersection(a, b):
+    """
+    Return the runs that cover the voxels found in both of the given run tables.
+    """
+    return _rle_binary_op(a, b, _INTERSECTION)
+
+
+def rle_difference(a, b):
+    """
+    Return the runs that cover the voxels of ``a`` that are not in ``b``.
+    """
+    return _rle_binary_op(a, b, _DIFFERENCE)
+
+
+def rle_clip_to_box(rle_ranges_zyx, box_zyx):
+    """
+    Discard the portions of the given runs that fall outside the given box.
+
+    Args:
+        rle_ranges_zyx:
+            Table of runs [[Z,Y,X1,X2], ...]
+
+        box_zyx:
+            [(z0,y0,x0), (z1,y1,x1)] (The stop coordinate is exclusive, as usual.)
+    """
+    ranges = rle_normalize(rle_ranges_zyx)
+    (z0, y0, x0), (z1, y1, x1) = np.asarray(box_zyx)
+
+    keep = ( (ranges[:, 0] >= z0) & (ranges[:, 0] < z1)
+           & (ranges[:, 1] >= y0) & (ranges[:, 1] < y1)
+           & (ranges[:, 3] >= x0) & (ranges[:, 2] < x1) )
+
+    ranges = ranges[keep]
+    ranges[:, 2] = np.maximum(ranges[:, 2], x0)
+    ranges[:, 3] = np.minimum(ranges[:, 3], x1 - 1)
+    return ranges
+
+
+def rle_downsample(rle_ranges_zyx, scale):
+    """
+    Downsample the given runs by a factor of ``2**scale``.
+    A voxel in the downsampled result is included if
+    ANY of its corresponding full-resolution voxels is included.
+    (This is how DVID generates ``/sparsevol-coarse`` and the
+    ``scale`` option of ``/sparsevol``.)
+    """
+    ranges = rle_normalize(rle_ranges_zyx)
+    if scale == 0:
+        return ranges
+    return rle_normalize(ranges >> scale)
+
+
+def rle_voxel_count(rle_ranges_zyx):
+    """
+    Return the total number of voxels in the given runs.
+    (If the runs overlap, the overlapping voxels are counted more than once.
+    Use rle_normalize() first if that's a concern.)
+    """
+    ranges = np.asarray(rle_ranges_zyx)
+    return int((1 + ranges[:, 3].astype(np.int64) - ranges[:, 2]).sum())
+
+
+def rle_bounding_box(rle_ranges_zyx):
+    """
+    Return the bounding box of the given runs, as [(z0,y0,x0), (z1,y1,x1)],
+    with an exclusive stop coordinate (unlike the X2 column of the runs themselves).
+    """
+    ranges = np.asarray(rle_ranges_zyx)
+    assert len(ranges) > 0, "Empty RLEs have no bounding box"
+    return np.array([ ranges[:, (0,1,2)].min(axis=0),
+                      1 + ranges[:, (0,1,3)].max(axis=0) ])
+
+
+_UNION = 0
+_INTERSECTION = 1
+_DIFFERENCE = 2
+
+
+def _rle_binary_op(a, b, op):
+    """
+    Helper for rle_union(), rle_intersection(), and rle_difference().
+    """
+    a = rle_normalize(a)
+    b = rle_normalize(b)
+    dtype = np.promote_types(a.dtype, b.dtype)
+    return _rle_binary_op_sorted(a.astype(dtype, copy=False), b.astype(dtype, copy=False), op)
+
+
+@jit(nopython=True, nogil=True)
+def _rle_is_normalized(ranges):
+    """
+    Return True if the given runs are sorted by Z,Y,X1,
+    non-empty, and no two runs in the same row overlap or touch.
+    """
+    for i in range(len(ranges)):
+        if ranges[i, 3] < ranges[i, 2]:
+            return False
+        if i == 0:
+            continue
+        if ranges[i, 0] < ranges[i-1, 0]:
+            return False
+        if ranges[i, 0] == ranges[i-1, 0]:
+            if ranges[i, 1] < ranges[i-1, 1]:
+                return False
+            if ranges[i, 1] == ranges[i-1, 1] and ranges[i, 2] <= ranges[i-1, 3] + 1:
+                return False
+    return True
+
+
+@jit(nopython=True, nogil=True)
+def _rle_merge_sorted(ranges):
+    """
+    Combine overlapping or adjacent runs, which must already be sorted by Z,Y,X1.
+    """
+    out = np.empty_like(ranges)
+    n = 0
+    for i in range(len(ranges)):
+        z, y, x1, x2 = ranges[i]
+        if n > 0 and out[n-1, 0] == z and out[n-1, 1] == y and x1 <= out[n-1, 3] + 1:
+            out[n-1, 3] = max(out[n-1, 3], x2)
+        else:
+            out[n] = ranges[i]
+            n += 1
+    return out[:n].copy()
+
+
+@jit(nopython=True, nogil=True)
+def _rle_row_end(ranges, start):
+    """
+    Return the index just past the last run in the same (Z,Y) row as ranges[start].
+    """
+    end = start + 1
+    while end < len(ranges) and ranges[end, 0] == ranges[start, 0] and ranges[end, 1] == ranges[start, 1]:
+        end += 1
+    return end
+
+
+@jit(nopython=True, nogil=True)
+def _rle_append(out, n, row_start, z, y, x1, x2):
+    """
+    Append a run to out[:n], combining it with the previous run
+    if they touch (and belong to the same row).  Returns the new length.
+    """
+    if n > row_start and x1 <= out[n-1, 3] + 1:
+        out[n-1, 3] = max(out[n-1, 3], x2)
+        return n
+    out[n, 0] = z
+    out[n, 1] = y
+    out[n, 2] = x1
+    out[n, 3] = x2
+    return n + 1
+
+
+@jit(nopython=True, nogil=True)
+def _rle_binary_op_sorted(a, b, op):
+    """
+    Helper for _rle_binary_op().
+    Sweep through the rows of two normalized run tables in parallel,
+    combining the runs of rows that appear in both tables.
+    """
+    # No operation can produce more runs than the two inputs combined:
+    # Each run in b can split at most one run of a into two.
+    out = np.empty((len(a) + len(b), 4), a.dtype)
+    n = 0
+    i = 0
+    j = 0
+    while i < len(a) or j < len(b):
+        if j == len(b):
+            a_first = True
+        elif i == len(a):
+            a_first = False
+        else:
+            a_first = (a[i, 0] < b[j, 0]) or (a[i, 0] == b[j, 0] and a[i, 1] < b[j, 1])
+
+        # Row found only in a
+        if a_first:
+            i_end = _rle_row_end(a, i)
+            if op != _INTERSECTION:
+                out[n:n + i_end - i] = a[i:i_end]
+                n += i_end - i
+            i = i_end
+            continue
+
+        # Row found only in b
+        if i == len(a) or a[i, 0] != b[j, 0] or a[i, 1] != b[j, 1]:
+            j_end = _rle_row_end(b, j)
+            if op == _UNION:
+                out[n:n + j_end - j] = b[j:j_end]
+                n += j_end - j
+            j = j_end
+            continue
+
+        # Row found in both
+        z, y = a[i, 0], a[i, 1]
+        i_end = _rle_row_end(a, i)
+        j_end = _rle_row_end(b, j)
+        row_start = n
+
+        if op == _UNION:
+            p, q = i, j
+            while p < i_end or q < j_end:
+                if q == j_end or (p < i_end and a[p, 2] <= b[q, 2]):
+                    n = _rle_append(out, n, row_start, z, y, a[p, 2], a[p, 3])
+                    p += 1
+                else:
+                    n = _rle_append(out, n, row_start, z, y, b[q, 2], b[q, 3])
+                    q += 1
+
+        elif op == _INTERSECTION:
+            p, q = i, j
+            while p < i_end and q < j_end:
+                lo = max(a[p, 2], b[q, 2])
+                hi = min(a[p, 3], b[q, 3])
+                if lo <= hi:
+                    n = _rle_append(out, n, row_start, z, y, lo, hi)
+                if a[p, 3] < b[q, 3]:
+                    p += 1
+                else:
+                    q += 1
+
+        else:
+            q = j
+            for p in range(i, i_end):
+                x1, x2 = a[p, 2], a[p, 3]
+                while q < j_end and b[q, 3] < x1:
+                    q += 1
+                k = q
+                while k < j_end and b[k, 2] <= x2:
+                    if b[k, 2] > x1:
+                        n = _rle_append(out, n, row_start, z, y, x1, b[k, 2] - 1)
+                    x1 = max(x1, b[k, 3] + 1)
+                    k += 1
+                if x1 <= x2:
+                    n = _rle_append(out, n, row_start, z, y, x1, x2)
+
+        i = i_end
+        j = j_end
+
+    return out[:n].copy()
+
+
+#
+# Block masks
+# -----------
+#
+# The functions below convert runs into block-level (or dense) masks,
+# without decoding the runs into per-voxel coordinates.
+# The runs are split into Z-slabs (aligned to the block grid),
+# which are processed in parallel.
+#
+
+def rle_to_sparse_block_mask(rle_ranges_zyx, block_shape=64, threads=4):
+    """
+    Create a SparseBlockMask that marks every block which
+    contains at least one voxel of the given runs.
+
+    Args:
+        rle_ranges_zyx:
+            Table of runs [[Z,Y,X1,X2], ...]
+
+        block_shape:
+            The width (or shape) of each block, i.e. the resolution of the mask.
+            With block_shape=1, the result is a dense full-resolution mask of the runs.
+
+        threads:
+            How many threads to use.
+
+    Returns:
+        SparseBlockMask
+    """
+    block_shape = _block_shape_array(block_shape)
+    ranges = np.asarray(rle_ranges_zyx)
+    if len(ranges) == 0:
+        return SparseBlockMask.create_empty(block_shape)
+
+    box = rle_bounding_box(ranges)
+    lowres_box = np.array([box[0] // block_shape, -(-box[1] // block_shape)])
+    mask = np.zeros(lowres_box[1] - lowres_box[0], bool)
+
+    # The slabs are aligned to the block grid,
+    # so each thread writes to a different portion of the mask.
+    slabs = _rle_z_slabs(ranges, block_shape[0], min_runs=max(1, len(ranges) // (4*max(1, threads))))
+    mark = lambda slab: _mark_rle_blocks(slab, block_shape, lowres_box[0], mask)  # noqa
+    if threads <= 1 or len(slabs) == 1:
+        for slab in slabs:
+            mark(slab)
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            for _ in executor.map(mark, slabs):
+                pass
+
+    return SparseBlockMask(mask, lowres_box * block_shape, block_shape)
+
+
+def iter_rle_block_masks(rle_ranges_zyx, block_shape=64, threads=4, batch_blocks=256):
+    """
+    For each block that contains at least one voxel of the given runs,
+    yield the block's corner and a dense boolean mask of the block's voxels.
+    Blocks are yielded in (bz,by,bx) order.
+
+    Only ``threads * batch_blocks`` masks are held in RAM at a time
+    (plus whatever the caller keeps).
+
+    Args:
+        rle_ranges_zyx:
+            Table of runs [[Z,Y,X1,X2], ...]
+
+        block_shape:
+            The width (or shape) of each block, e.g. 64 for DVID labelmap blocks.
+
+        threads:
+            How many threads to use.
+
+        batch_blocks:
+            How many block masks each thread generates per task.
+
+    Yields:
+        (corner_zyx, mask), where mask is a bool array of shape block_shape.
+    """
+    block_shape = _block_shape_array(block_shape)
+    ranges = np.asarray(rle_ranges_zyx)
+    if len(ranges) == 0:
+        return
+
+    # One slab per row of blocks
+    slabs = _rle_z_slabs(ranges, block_shape[0], min_runs=1)
+
+    def prepare(slab):
+        return _rle_block_pieces(slab, block_shape)
+
+    def fill(task):
+        (block_coords, starts, pieces), i, j = task
+        masks = np.zeros((j - i, *block_shape), bool)
+        _fill_block_masks(pieces, starts[i:j+1], block_coords[i:j], block_shape, masks)
+        return block_coords[i:j] * block_shape, masks
+
+    with ThreadPoolExecutor(max(1, threads)) as executor:
+        prepared = executor.map(prepare, slabs)
+        tasks = ( (p, i, min(i + batch_blocks, len(p[0])))
+                  for p in prepared
+                  for i in range(0, len(p[0]), batch_blocks) )
+
+        pending = deque(executor.submit(fill, task) for task in islice(tasks, max(1, threads)))
+        while pending:
+            corners, masks = pending.popleft().result()
+            for task in islice(tasks, 1):
+                pending.append(executor.submit(fill, task))
+            yield from zip(corners, masks)
+
+
+def _block_shape_array(block_shape):
+    a = np.zeros(3, np.int64)
+    a[:] = block_shape
+    return a
+
+
+def _rle_z_slabs(ranges, slab_depth, min_runs):
+    """
+    Helper for rle_to_sparse_block_mask() and iter_rle_block_masks().
+    Sort the runs by Z (if they aren't already), and split them into contiguous
+    slabs whose Z-boundaries are multiples of slab_depth.
+    Consecutive slabs with fewer than min_runs runs are combined.
+    """
+    ranges = np.ascontiguousarray(ranges)
+    z = ranges[:, 0]
+    if (np.diff(z) < 0).any():
+        ranges = ranges[np.argsort(z, kind='stable')]
+        z = ranges[:, 0]
+
+    slab_ids = z // slab_depth
+    boundaries = 1 + np.flatnonzero(np.diff(slab_ids))
+
+    slabs = []
+    start = 0
+    for b in [*boundaries.tolist(), len(ranges)]:
+        if b - start >= min_runs or b == len(ranges):
+            slabs.append(ranges[start:b])
+            start = b
+    return slabs
+
+
+@jit(nopython=True, nogil=True)
+def _mark_rle_blocks(ranges, block_shape, lowres_corner, mask):
+    """
+    Helper for rle_to_sparse_block_mask().
+    Set the mask voxels of all blocks touched by the given runs.
+    """
+    bz, by, bx = block_shape
+    cz, cy, cx = lowres_corner
+    for i in range(len(ranges)):
+        z, y, x1, x2 = ranges[i]
+        if x2 < x1:
+            continue
+        mask[z // bz - cz, y // by - cy, x1 // bx - cx:x2 // bx - cx + 1] = True
+
+
+@jit(nopython=True, nogil=True)
+def _rle_block_pieces(ranges, block_shape):
+    """
+    Helper for iter_rle_block_masks().
+    Given runs which all lie within a single row of blocks (in Z),
+    split each run at the block boundaries, and sort the pieces by block.
+
+    Returns:
+        (block_coords, starts, pieces), where block_coords are the (bz,by,bx)
+        indexes of the touched blocks (in sorted order), and the pieces of
+        block_coords[k] are pieces[starts[k]:starts[k+1]].
+    """
+    bz, by, bx = block_shape
+    n = 0
+    min_by = ranges[0, 1] // by
+    min_bx = ranges[0, 2] // bx
+    for i in range(len(ranges)):
+        z, y, x1, x2 = ranges[i]
+        if x2 < x1:
+            continue
+        n += x2 // bx - x1 // bx + 1
+        min_by = min(min_by, y // by)
+        min_bx = min(min_bx, x1 // bx)
+
+    pieces = np.empty((n, 4), ranges.dtype)
+    keys = np.empty(n, np.int64)
+    row_width = 0
+    for i in range(len(ranges)):
+        row_width = max(row_width, ranges[i, 3] // bx - min_bx + 1)
+
+    j = 0
+    for i in range(len(ranges)):
+        z, y, x1, x2 = ranges[i]
+        if x2 < x1:
+            continue
+        for block_x in range(x1 // bx, x2 // bx + 1):
+            pieces[j, 0] = z
+            pieces[j, 1] = y
+            pieces[j, 2] = max(x1, block_x * bx)
+            pieces[j, 3] = min(x2, block_x * bx + bx - 1)
+            keys[j] = (y // by - min_by) * row_width + (block_x - min_bx)
+            j += 1
+
+    order = np.argsort(keys, kind='mergesort')
+    pieces = pieces[order]
+    keys = keys[order]
+
+    block_coords = np.empty((n, 3), np.int64)
+    starts = np.empty(n + 1, np.int64)
+    k = 0
+    for j in range(n):
+        if j == 0 or keys[j] != keys[j-1]:
+            block_coords[k, 0] = pieces[j, 0] // bz
+            block_coords[k, 1] = pieces[j, 1] // by
+            block_coords[k, 2] = pieces[j, 2] // bx
+            starts[k] = j
+            k += 1
+    starts[k] = n
+    return block_coords[:k].copy(), starts[:k+1].copy(), pieces
+
+
+@jit(nopython=True, nogil=True)
+def _fill_block_masks(pieces, starts, block_coords, block_shape, masks):
+    """
+    Helper for iter_rle_block_masks().
+    Write the pieces of each block into its (zero-initialized) mask.
+    """
+    for k in range(len(block_coords)):
+        cz = block_coords[k, 0] * block_shape[0]
+        cy = block_coords[k, 1] * block_shape[1]
+        cx = block_coords[k, 2] * block_shape[2]
+        for j in range(starts[k], starts[k+1]):
+            z, y, x1, x2 = pieces[j]
+            masks[k, z - cz, y - cy, x1 - cx:x2 - cx + 1] = True
@@ -7,7 +7,7 @@ import pandas as pd
 
 from ..util import NumpyConvertingEncoder, tqdm_proxy, extract_labels_from_volume
 from . import dvid_api_wrapper, fetch_generic_json
-from .rle import runlength_decode_from_ranges
+from .rle import runlength_decode_from_ranges, rle_clip_to_box, rle_bounding_box, rle_to_sparse_block_mask
 
 logger = logging.getLogger(__name__)
 
@@ -73,18 +73,13 @@ def fetch_roi(server, uuid, instance, format='ranges', *, session=None): # @Rese
     if format == 'ranges':
         return rle_ranges
 
-    coords = runlength_decode_from_ranges(rle_ranges)
     if format == 'coords':
-        return coords
+        return runlength_decode_from_ranges(rle_ranges)
 
     if format == 'mask':
-        mask_box = np.array([coords.min(axis=0), 1+coords.max(axis=0)])
-        mask_shape = mask_box[1] - mask_box[0]
-
-        coords -= mask_box[0]
-        mask = np.zeros(mask_shape, bool)
-        mask[tuple(coords.transpose())] = True
-        return mask, mask_box
+        # Paint the runs directly, without decoding them into coordinates.
+        sbm = rle_to_sparse_block_mask(rle_ranges, 1)
+        return sbm.lowres_mask, sbm.box.astype(np.int32)
 
     assert False, "Shouldn't get here."
 
@@ -200,11 +195,7 @@ def fetch_combined_roi_volume(server, uuid, rois, as_bool=False, box_zyx=None, *
     for roi in tqdm_proxy(rois.keys(), leave=False):
         all_rle_ranges[roi] = fetch_roi(server, uuid, roi, format='ranges', session=session)
     
-    roi_boxes = []
-    for rle_ranges in all_rle_ranges.values():
-        roi_boxes.append( [  rle_ranges[:, (0,1,2)].min(axis=0),
-                           1+rle_ranges[:, (0,1,3)].max(axis=0)] )
-    
+    roi_boxes = [rle_bounding_box(rle_ranges) for rle_ranges in all_rle_ranges.values()]
     roi_boxes = np.array(roi_boxes)
 
     if box_zyx is None:
@@ -235,11 +226,9 @@ def fetch_combined_roi_volume(server, uuid, rois, as_bool=False, box_zyx=None, *
 
     # Overlay ROIs one-by-one
     for roi, label in tqdm_proxy(rois.items(), leave=False):
-        coords = runlength_decode_from_ranges(all_rle_ranges[roi])
-        
-        # Drop coords that are out-of-bounds
-        in_bounds = (coords >= box_zyx[0]).all(axis=1) & (coords < box_zyx[1]).all(axis=1)
-        coords = coords[in_bounds]
+        # Drop out-of-bounds runs before decoding
+        rle_ranges = rle_clip_to_box(all_rle_ranges[roi], box_zyx).astype(np.int32)
+        coords = runlength_decode_from_ranges(rle_ranges)
 
         # Offset for output
         coords -= box_zyx[0]
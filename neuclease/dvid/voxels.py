@@ -35,7 +35,9 @@ def fetch_raw(server, uuid, instance, box_zyx, throttle=False, *, dtype=np.uint8
         throttle:
             If True, passed via the query string to DVID, in which case DVID might return a '503' error
             if the server is too busy to service the request.
-            It is your responsibility to catch DVIDExceptions in that case.
+            If you're using the default session, such requests are automatically retried
+            (with backoff) via ``DVID_ADMISSION_CONTROL``. See ``neuclease.dvid.admission``.
+            Otherwise, it is your responsibility to catch HTTPErrors in that case.
 
         dtype:
             The datatype of the underlying data instance.
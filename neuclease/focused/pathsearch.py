@@ -9,11 +9,8 @@ from collections import namedtuple
 import numpy as np
 import pandas as pd
 
-# flyem
-from dvidutils import LabelMapper
-
 # local
-from ..util import Timer, read_csv_col, NumpyConvertingEncoder
+from ..util import Timer, read_csv_col, NumpyConvertingEncoder, SortedMapping, as_sorted_mapping
 from ..merge_table import load_mapping
 
 logger = logging.getLogger(__name__)
@@ -77,10 +74,10 @@ def compute_focused_paths( server, uuid, instance,
         with Timer("Loading mapping", logger):
             original_mapping = load_mapping(original_mapping)
     else:
-        assert isinstance(original_mapping, pd.Series)
+        assert isinstance(original_mapping, (pd.Series, SortedMapping))
 
     with Timer("Applying mapping", logger):
-        mapper = LabelMapper(original_mapping.index.values, original_mapping.values)
+        mapper = as_sorted_mapping(original_mapping)
         merge_table_df['body_a'] = mapper.apply(merge_table_df['id_a'].values, allow_unmapped=True)
         merge_table_df['body_b'] = mapper.apply(merge_table_df['id_b'].values, allow_unmapped=True)
 
@@ -107,7 +104,6 @@ def compute_focused_paths( server, uuid, instance,
         return (edges, original_mapping, important_bodies, max_depth, stop_after_endpoint_num)
 
     logger.info(f"Finding paths among {len(important_bodies)} important bodies")
-    # FIXME: Need to augment original_mapping with rows for single-sv bodies that are 'important'
     all_paths = find_all_paths(edges, original_mapping, important_bodies, max_depth, stop_after_endpoint_num)
     return all_paths
 
@@ -130,7 +126,9 @@ def find_all_paths(edges, original_mapping, important_bodies, max_depth=10, stop
 
     with Timer("Mapping SV importances"):
         # Select the rows of the mapping that are actually mentioned in the merge graph.
-        mapping_subset = original_mapping.loc[v_to_sv]
+        # (Supervoxels which aren't in the mapping are single-supervoxel bodies.)
+        mapping_subset = as_sorted_mapping(original_mapping).apply(v_to_sv, allow_unmapped=True)
+        mapping_subset = pd.Series(mapping_subset, index=v_to_sv)
         
         sv_importances = pd.DataFrame({'body': mapping_subset})
         sv_importances['v'] = sv_to_v.loc[mapping_subset.index]
@@ -8,7 +8,8 @@ import numpy as np
 import pandas as pd
 
 from .util import Timer
-from .dvid import fetch_repo_info, fetch_supervoxels_for_body, fetch_labels, fetch_complete_mappings, fetch_mutation_id, fetch_supervoxel_splits
+from .dvid import fetch_repo_info, fetch_supervoxels_for_body, fetch_labels, fetch_mutation_id, fetch_supervoxel_splits
+from .dvid.labelmap import fetch_labelindex, DVID_LABELINDEX_CACHE, LabelmapMapping
 from .merge_table import MERGE_TABLE_DTYPE, load_mapping, load_merge_table, normalize_merge_table, apply_mapping_to_mergetable
 from .focused.ingest import fetch_focused_decisions
 from .adjacency import find_missing_adjacencies
@@ -102,13 +103,49 @@ class LabelmapMergeGraph:
         self.mapping = mapping
 
 
-    def fetch_and_apply_mapping(self, server, uuid, instance):
+    def fetch_and_apply_mapping(self, server, uuid, instance, snapshot_path=None):
+        """
+        Fetch the complete mapping from DVID and apply it to the merge table.
+
+        Args:
+            server, uuid, instance:
+                A labelmap instance
+
+            snapshot_path:
+                Optional. Path to a LabelmapMapping snapshot (.npz).
+                If the file exists, the mapping is loaded from it and then
+                updated with the mutations from the kafka log, which is much
+                faster than fetching the complete mapping from DVID.
+                (If the snapshot came from a different instance, or from a node
+                which isn't the given uuid or one of its ancestors, it is ignored.)
+                Either way, the up-to-date mapping is then written to the snapshot path.
+        """
         # For testing purposes, we have a special means of avoiding kafkas
         kafka_msgs = None
         if self.no_kafka:
             kafka_msgs = []
-        mapping = fetch_complete_mappings(server, uuid, instance, include_retired=True, kafka_msgs=kafka_msgs)
-        self.apply_mapping(mapping)
+
+        mapping = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            with Timer(f"Loading mapping snapshot from {snapshot_path}", _logger):
+                mapping = LabelmapMapping.load(snapshot_path)
+
+            if mapping.is_compatible(server, uuid, instance):
+                mapping.update(server, uuid, instance, kafka_msgs=kafka_msgs)
+            else:
+                _logger.warning(f"Mapping snapshot {snapshot_path} (from {mapping.source}) can't be used "
+                                f"for {server}/{uuid}/{instance}. Fetching the complete mapping instead.")
+                mapping = None
+
+        if mapping is None:
+            mapping = LabelmapMapping.from_dvid(server, uuid, instance, include_retired=True, kafka_msgs=kafka_msgs)
+
+        if snapshot_path:
+            mapping.save(snapshot_path)
+
+        # The merge table's 'body' column is only valid for this version of
+        # the mapping, so we keep a snapshot of it rather than the live object.
+        self.apply_mapping(mapping.series)
 
 
     def append_edges_for_focused_merges(self, server, uuid, focused_decisions_instance):
@@ -272,7 +309,13 @@ class LabelmapMergeGraph:
                     return (mutid, supervoxels, edges, scores)
 
             logger.info("Edges not found in cache.  Extracting from merge graph.")
-            dvid_supervoxels = fetch_supervoxels_for_body(server, uuid, instance, body_id, session=session)
+            if DVID_LABELINDEX_CACHE.enabled:
+                # find_missing_adjacencies() will need the labelindex anyway,
+                # so we can obtain the supervoxels from it rather than asking DVID.
+                labelindex = fetch_labelindex(server, uuid, instance, body_id, format='arrays', session=session)
+                dvid_supervoxels = np.unique(labelindex.svs)
+            else:
+                dvid_supervoxels = fetch_supervoxels_for_body(server, uuid, instance, body_id, session=session)
 
             # It's very fast to select rows based on the body_id,
             # so we prefer that if the mapping is already in sync with DVID.
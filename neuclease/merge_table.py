@@ -9,9 +9,7 @@ import ujson
 import numpy as np
 import pandas as pd
 
-from dvidutils import LabelMapper
-
-from .util import Timer, read_csv_header, tqdm_proxy
+from .util import Timer, read_csv_header, tqdm_proxy, SortedMapping, as_sorted_mapping
 from .dvid import (fetch_complete_mappings, fetch_split_supervoxel_sizes, read_kafka_messages,
                    fetch_supervoxel_splits, split_events_to_mapping, fetch_label)
 
@@ -97,14 +95,16 @@ def apply_mapping_to_mergetable(merge_table_df, mapping):
     """
     Set the 'body' column of the given merge table (append one if it didn't exist)
     by applying the given SV->body mapping to the merge table's id_a column.
+
+    The mapping may be a pd.Series, a SortedMapping, or a path to a file which can be loaded by load_mapping().
     """
     if isinstance(mapping, str):
         with Timer("Loading mapping", logger):
             mapping = load_mapping(mapping)
 
-    assert isinstance(mapping, pd.Series), "Mapping must be a pd.Series"        
+    assert isinstance(mapping, (pd.Series, SortedMapping)), "Mapping must be a pd.Series or SortedMapping"
     with Timer("Applying mapping to merge table", logger):
-        mapper = LabelMapper(mapping.index.values, mapping.values)
+        mapper = as_sorted_mapping(mapping)
         body_a = mapper.apply(merge_table_df['id_a'].values, allow_unmapped=True)
         body_b = mapper.apply(merge_table_df['id_b'].values, allow_unmapped=True)
 
@@ -314,11 +314,9 @@ def apply_mappings(supervoxels, mappings):
     df.index.name = 'sv'
 
     for name, mapping in mappings.items():
-        assert isinstance(mapping, pd.Series)
-        index_values = mapping.index.values.astype(np.uint64, copy=False)
-        mapping_values = mapping.values.astype(np.uint64, copy=False)
-        mapper = LabelMapper(index_values, mapping_values)
-        df[name] = mapper.apply(df.index.values, allow_unmapped=True)
+        assert isinstance(mapping, (pd.Series, SortedMapping))
+        mapper = as_sorted_mapping(mapping)
+        df[name] = mapper.apply(df.index.values, allow_unmapped=True).astype(np.uint64, copy=False)
 
     return df
 
@@ -393,7 +391,7 @@ def compute_body_sizes(sv_sizes, mapping, include_unmapped_singletons=False):
             can be loaded via load_supervoxel_sizes()
         
         mapping:
-            pd.Series, indexed by sv, with body as value,
+            pd.Series, indexed by sv, with body as value, or a SortedMapping,
             or a path to a file which can be loaded by load_mapping()
        
         include_unmapped_singletons:
@@ -423,20 +421,22 @@ def compute_body_sizes(sv_sizes, mapping, include_unmapped_singletons=False):
         mapping = load_mapping(mapping)
     
     assert isinstance(sv_sizes, pd.Series)
-    assert isinstance(mapping, pd.Series)
+    assert isinstance(mapping, (pd.Series, SortedMapping))
     
     assert sv_sizes.index.dtype == np.uint64
     
     sv_sizes = sv_sizes.astype(np.uint64, copy=False)
-    size_mapper = LabelMapper(sv_sizes.index.values, sv_sizes.values)
+    size_mapper = as_sorted_mapping(sv_sizes)
+    mapping = as_sorted_mapping(mapping)
 
     # Just drop SVs that we don't have sizes for.
     logger.info("Dropping unknown supervoxels")
-    mapping = mapping.loc[mapping.index.isin(sv_sizes.index)]
+    known = size_mapper.isin(mapping.keys)
+    mapped_svs = mapping.keys[known]
 
     logger.info("Applying sizes to mapping")
-    df = pd.DataFrame({'body': mapping})
-    df['voxel_count'] = size_mapper.apply(mapping.index.values)
+    df = pd.DataFrame({'body': mapping.values[known]})
+    df['voxel_count'] = size_mapper.apply(mapped_svs)
 
     logger.info("Aggregating sizes by body")
     body_stats = df.groupby('body').agg({'voxel_count': ['sum', 'size']})
@@ -446,7 +446,7 @@ def compute_body_sizes(sv_sizes, mapping, include_unmapped_singletons=False):
     
     if include_unmapped_singletons:
         logger.info("Appending singleton sizes")
-        nonsingleton_rows = sv_sizes.index.isin(mapping.index)
+        nonsingleton_rows = mapping.isin(sv_sizes.index.values)
         singleton_sizes = sv_sizes[~nonsingleton_rows]
         singleton_stats = pd.DataFrame({'voxel_count': singleton_sizes})
         singleton_stats['sv_count'] = np.uint32(1)
@@ -468,8 +468,8 @@ def extract_important_merges(speculative_merge_tables, important_bodies, body_ma
     if mapping_instance_info is not None:
         body_mapping = fetch_complete_mappings(mapping_instance_info)
 
-    assert isinstance(body_mapping, pd.Series)
-    mapper = LabelMapper(body_mapping.index.values, body_mapping.values)
+    assert isinstance(body_mapping, (pd.Series, SortedMapping))
+    mapper = as_sorted_mapping(body_mapping)
 
     # pd.Index is faster than builtin set for large sets
     important_bodies = pd.Index(important_bodies)
@@ -566,12 +566,12 @@ def update_merge_table(server, uuid, instance, table_df, complete_mapping=None,
 
     if complete_mapping is None:
         complete_mapping = fetch_complete_mappings(*seg_info, include_retired=True, kafka_msgs=kafka_msgs)
-    complete_mapper = LabelMapper(complete_mapping.index.values, complete_mapping.values)
+    complete_mapper = as_sorted_mapping(complete_mapping)
 
     if split_mapping is None:
         split_events = fetch_supervoxel_splits(*seg_info)
         split_mapping = split_events_to_mapping(split_events, leaves_only=False)
-    split_mapper = LabelMapper(split_mapping.index.values, split_mapping.values)
+    split_mapper = as_sorted_mapping(split_mapping)
 
     # Apply up-to-date body mapping
     # (Retired supervoxels will map to body 0)
@@ -50,7 +50,7 @@ def _repair_index(master_seg, body):
     # there isn't supposed to be segmentation in that region.)
     pli.blocks.query('z >= 1024 and y >= 1024 and x >= 1024', inplace=True)
     
-    li = create_labelindex(pli)
+    li = create_labelindex(pli, format='raw')
     post_labelindex(*master_seg, pli.label, li)
 
 
@@ -0,0 +1,158 @@
+import re
+import tarfile
+import threading
+from io import BytesIO
+from functools import partial
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import ujson
+import pytest
+import numpy as np
+import pandas as pd
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from neuclease.dvid import parse_rle_response, create_labelindex, PandasLabelIndex, LabelIndices
+from neuclease.dvid.aio import (compute_async, fetch_mutation_id, fetch_supervoxels, fetch_labels,
+                                fetch_sparsevol, fetch_labelindex, fetch_labelindices, fetch_tarfile)
+
+
+def _labelindex(label):
+    blocks_df = pd.DataFrame({ 'z': [0, 0, 64],
+                               'y': [0, 64, 64],
+                               'x': [64, 128, 0],
+                               'sv': [label, label, label+1],
+                               'count': [10, 20, 30] })
+    return create_labelindex(PandasLabelIndex(blocks_df, label, 7, 'some-time', 'some-user'))
+
+
+def _rle_bytes(label):
+    # Two runs: (x,y,z,length)
+    runs = np.array([[label, 0, 0, 3],
+                     [0, 1, 2, 2]], np.int32)
+    # descriptor, ndim, run dimension, reserved, voxel count, run count
+    header = np.array([0, 3, 0, 0], np.uint8).tobytes() + np.array([0, len(runs)], np.int32).tobytes()
+    return header + runs.tobytes()
+
+
+def _tarfile_bytes(label):
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tf:
+        for name in (f'{label}.drc', f'{label}.txt'):
+            data = name.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, BytesIO(data))
+    return buf.getvalue()
+
+
+class _FakeDvidHandler(BaseHTTPRequestHandler):
+    """
+    Serves canned responses for the handful of endpoints used in these tests.
+    """
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+
+        label = re.match(r'.*/(\d+)$', path)
+        label = label and int(label.group(1))
+
+        if '/lastmod/' in path:
+            content = ujson.dumps({"mutation id": label + 1000}).encode()
+        elif path.endswith('/labels'):
+            coords_xyz = ujson.loads(body)
+            content = ujson.dumps([sum(c) for c in coords_xyz]).encode()
+        elif '/sparsevol/' in path:
+            content = _rle_bytes(label)
+        elif '/index/' in path:
+            content = _labelindex(label).SerializeToString()
+        elif path.endswith('/indices'):
+            indices = LabelIndices()
+            indices.indices.extend(map(_labelindex, ujson.loads(body)))
+            content = indices.SerializeToString()
+        elif '/tarfile/' in path:
+            content = _tarfile_bytes(label)
+        else:
+            self.send_response(400)
+            self.send_header('Content-Length', '9')
+            self.end_headers()
+            self.wfile.write(b'bad path!')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def fake_dvid():
+    httpd = HTTPServer(('127.0.0.1', 0), _FakeDvidHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield (f'127.0.0.1:{httpd.server_port}', 'abc123', 'segmentation')
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_compute_async(fake_dvid):
+    f = partial(fetch_mutation_id, *fake_dvid)
+    bodies = list(range(100))
+    mutids = compute_async(f, bodies, max_concurrency=4)
+    assert mutids == [b + 1000 for b in bodies]
+
+    # Unordered results still contain everything
+    mutids = compute_async(f, iter(bodies), max_concurrency=4, ordered=False)
+    assert sorted(mutids) == [b + 1000 for b in bodies]
+
+
+def test_fetch_labels(fake_dvid):
+    coords_zyx = [[1,2,3], [4,5,6]]
+    labels = compute_async(partial(fetch_labels, *fake_dvid), [coords_zyx])[0]
+    assert labels.dtype == np.uint64
+    assert labels.tolist() == [6, 15]
+
+
+def test_fetch_sparsevol(fake_dvid):
+    coords = compute_async(partial(fetch_sparsevol, *fake_dvid), [5])[0]
+    expected = parse_rle_response(_rle_bytes(5))
+    assert (coords == expected).all()
+
+    starts, lengths = compute_async(partial(fetch_sparsevol, *fake_dvid, format='rle'), [5])[0]
+    assert starts.tolist() == [[0,0,5], [2,1,0]]
+    assert lengths.tolist() == [3, 2]
+
+
+def test_fetch_labelindex(fake_dvid):
+    labels = [100, 200, 300]
+    results = compute_async(partial(fetch_labelindex, *fake_dvid, format='pandas'), labels)
+    for label, pli in zip(labels, results):
+        assert pli.label == label
+        assert pli.last_mutid == 7
+        assert sorted(pli.blocks['count'].tolist()) == [10, 20, 30]
+
+    results = compute_async(partial(fetch_labelindices, *fake_dvid, format='list-of-protobuf'), [labels])[0]
+    assert [li.label for li in results] == labels
+
+
+def test_fetch_tarfile(fake_dvid):
+    tar_bytes = compute_async(partial(fetch_tarfile, *fake_dvid), [42])[0]
+    assert tar_bytes == _tarfile_bytes(42)
+
+    d = compute_async(partial(fetch_tarfile, *fake_dvid, format='dict'), [42])[0]
+    assert d == {'42.drc': b'42.drc', '42.txt': b'42.txt'}
+
+
+def test_error(fake_dvid):
+    # The fake server doesn't implement /supervoxels
+    with pytest.raises(aiohttp.ClientResponseError) as ex:
+        compute_async(partial(fetch_supervoxels, *fake_dvid), [1])
+    assert 'bad path!' in str(ex.value)
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_aio'])
@@ -2,29 +2,49 @@
 Test module for the dvid API wrapper functions defined in neuclease.dvid
 """
 import sys
+import gzip
+import json
 import time
 import logging
 import datetime
+import threading
+from io import BytesIO
 from multiprocessing.pool import ThreadPool
 
 import pytest
+import requests
 import numpy as np
 import pandas as pd
 
-from libdvid import DVIDNodeService
+from libdvid import DVIDNodeService, encode_label_block
 
 from neuclease.dvid import (dvid_api_wrapper, DvidInstanceInfo, fetch_supervoxels_for_body, fetch_supervoxel_sizes_for_body,
                             fetch_label, fetch_labels, fetch_labels_batched, fetch_mappings, fetch_complete_mappings, post_mappings,
                             fetch_mutation_id, generate_sample_coordinate, fetch_labelmap_voxels, post_labelmap_blocks, post_labelmap_voxels,
+                            post_labelmap_blocks_pipelined, fetch_labels_via_blocks, fetch_sparsevol, fetch_sparsevol_batches,
                             encode_labelarray_volume, encode_nonaligned_labelarray_volume, fetch_raw, post_raw,
                             fetch_labelindex, post_labelindex, fetch_labelindices, create_labelindex, PandasLabelIndex,
-                            copy_labelindices,
+                            copy_labelindices, convert_labelindex_to_pandas, parse_labelindex, parse_labelindices, labelindex_arrays_to_pandas,
+                            encode_labelindex, encode_labelindices,
                             fetch_maxlabel, post_maxlabel, fetch_nextlabel, post_nextlabel, create_labelmap_instance,
-                            post_merge, fetch_sparsevol_coarse, fetch_sparsevol_coarse_via_labelindex, post_branch,
-                            post_hierarchical_cleaves, fetch_mapping)
-
-from neuclease.dvid._dvid import default_dvid_session
-from neuclease.util import box_to_slicing, extract_subvol, ndrange
+                            post_merge, fetch_sparsevol_coarse, fetch_sparsevol_coarse_via_labelindex, fetch_sparsevol_coarse_via_labelindices, post_branch,
+                            post_hierarchical_cleaves, fetch_mapping, iter_labelarray_block_data, is_empty_labelarray_block,
+                            encode_labelarray_blocks, encode_labelarray_block, decode_labelarray_block, decode_labelarray_blocks,
+                            parse_labelarray_data, encode_mappings, parse_labelmap_kafka_msgs, labelmap_kafka_msgs_to_df,
+                            compute_affected_bodies, fetch_supervoxel_splits_from_kafka, SplitEvent)
+
+from neuclease.dvid._dvid import default_dvid_session, default_dvid_pool
+from neuclease.dvid.metrics import DvidMetrics
+from neuclease.dvid.cache import DvidResponseCache
+from neuclease.dvid.kafkacache import KafkaLogCache, KafkaLogRecord
+from neuclease.dvid.coalesce import coalesced, DVID_SINGLE_FLIGHT
+from neuclease.dvid.admission import AimdLimiter, AdmissionControl
+from neuclease.dvid.labelmap._blockcache import LabelmapBlockCache, _KafkaState
+from neuclease.dvid.labelmap._labelindexcache import LabelIndexCache
+from neuclease.dvid.labelmap._mapping import LabelmapMapping
+from neuclease.dvid.labelmap._labelmap import _diff_sorted_mappings, _fetch_sorted_mapping_array
+from neuclease.dvid.labelmap.labelops_pb2 import LabelIndex, LabelIndices, MappingOps, MappingOp
+from neuclease.util import box_to_slicing, extract_subvol, overwrite_subvol, ndrange
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -48,6 +68,265 @@ def test_default_dvid_session():
     assert len(set(ids)) == 2
 
 
+def test_default_dvid_pool():
+    """
+    Verify that all default sessions share a single connection pool.
+    """
+    def adapter_id(_):
+        time.sleep(0.01)
+        return id(default_dvid_session().get_adapter('http://127.0.0.1'))
+
+    with ThreadPool(2) as pool:
+        ids = list(pool.map(adapter_id, range(20)))
+    assert len(set(ids)) == 1
+    assert ids[0] == id(default_dvid_pool())
+
+
+def test_dvid_metrics():
+    metrics = DvidMetrics()
+    metrics.record('GET', 'http://foo:8000/api/node/abc9/segmentation/blocks/64_64_64/0_0_0', 0.2, 1000, 200)
+    metrics.record('GET', 'http://foo:8000/api/node/abc9/segmentation/blocks/64_64_64/0_0_64', 0.4, 2000, 200)
+    metrics.record('GET', 'http://foo:8000/api/node/abc9/segmentation/blocks/64_64_64/0_0_128', 0.0, 0, 503)
+    metrics.record('GET', 'http://foo:8000/api/server/info', 0.01, 10, 200)
+
+    d = metrics.to_dict()
+    assert d["endpoints"]["GET blocks"]["count"] == 3
+    assert d["endpoints"]["GET blocks"]["bytes"] == 3000
+    assert d["endpoints"]["GET blocks"]["errors"] == 1
+    assert d["endpoints"]["GET blocks"]["unavailable"] == 1
+    assert sum(d["endpoints"]["GET blocks"]["latency_histogram"]) == 3
+    assert d["endpoints"]["GET server/info"]["count"] == 1
+
+    df = metrics.to_dataframe()
+    assert df.index[0] == ('GET', 'blocks')
+
+
+def test_dvid_response_cache(tmp_path):
+    cache = DvidResponseCache()
+    cache.configure(str(tmp_path), max_bytes=2500, endpoints=['mappings', 'blocks'])
+
+    # Pretend we already checked which nodes are locked.
+    cache._locked_nodes[('foo:8000', 'abc9')] = (True, time.time())
+    cache._locked_nodes[('foo:8000', 'def0')] = (False, time.time())
+
+    def request(url, **params):
+        return requests.Request('GET', url, params=params).prepare()
+
+    def response(content):
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = 'OK'
+        r.headers['Content-Type'] = 'application/octet-stream'
+        r._content = content
+        return r
+
+    url = 'http://foo:8000/api/node/abc9/segmentation/mappings'
+    key = cache.request_key(request(url, format='binary', u='me', app='x'))
+    assert key is not None
+    assert key == cache.request_key(request(url, app='y', format='binary', u='someone-else'))
+    assert key != cache.request_key(request(url, format='text'))
+
+    # Unlocked nodes, non-allowed endpoints, and non-GET requests aren't eligible
+    assert cache.request_key(request('http://foo:8000/api/node/def0/segmentation/mappings')) is None
+    assert cache.request_key(request('http://foo:8000/api/node/abc9/segmentation/sparsevol/1')) is None
+    assert cache.request_key(requests.Request('POST', url).prepare()) is None
+
+    assert cache.get(key, request(url)) is None
+    cache.put(key, response(b'x'*1000))
+    r = cache.get(key, request(url))
+    assert r.content == b'x'*1000
+    assert r.headers['Content-Type'] == 'application/octet-stream'
+    assert r._content_consumed
+    assert list(r.iter_content(100)) == [b'x'*100]*10
+
+    # If the lock status can't be determined, the node is treated as unlocked.
+    assert cache.request_key(request('http://no-such-server.invalid:8000/api/node/abc9/segmentation/mappings')) is None
+    assert ('no-such-server.invalid:8000', 'abc9') not in cache._locked_nodes
+
+    # Fill beyond the size limit; the least-recently-used entry is evicted.
+    time.sleep(0.01)
+    key2 = cache.request_key(request('http://foo:8000/api/node/abc9/segmentation/blocks/64_64_64/0_0_0'))
+    cache.put(key2, response(b'y'*1000))
+    time.sleep(0.01)
+    assert cache.get(key, request(url)) is not None
+    time.sleep(0.01)
+    key3 = cache.request_key(request('http://foo:8000/api/node/abc9/segmentation/blocks/64_64_64/0_0_64'))
+    cache.put(key3, response(b'z'*1000))
+
+    assert cache.get(key2, request(url)) is None
+    assert cache.get(key, request(url)) is not None
+    assert cache.get(key3, request(url)) is not None
+    assert cache.stats()['evictions'] == 1
+
+
+class FileBackedKafkaTopic:
+    """
+    Stand-in for a kafka topic, for testing KafkaLogCache.
+    Records are stored in a JSON file, as {partition: [value, value, ...]}.
+    Also records the offsets of each read() call.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.reads = []
+        with open(path, 'w') as f:
+            json.dump({}, f)
+
+    def append(self, partition_id, *values):
+        with open(self.path, 'r') as f:
+            partitions = json.load(f)
+        partitions.setdefault(str(partition_id), []).extend(values)
+        with open(self.path, 'w') as f:
+            json.dump(partitions, f)
+
+    def _partitions(self):
+        with open(self.path, 'r') as f:
+            return {int(p): values for p, values in json.load(f).items()}
+
+    def latest_offsets(self):
+        return {p: len(values) for p, values in self._partitions().items()}
+
+    def read(self, start_offsets):
+        self.reads.append(dict(start_offsets))
+        for p, values in self._partitions().items():
+            if p in start_offsets:
+                for offset in range(start_offsets[p], len(values)):
+                    yield KafkaLogRecord(p, offset, 1000 + offset, values[offset].encode('utf-8'))
+
+
+def test_kafka_log_cache(tmp_path):
+    topic = FileBackedKafkaTopic(str(tmp_path / 'topic.json'))
+    cache = KafkaLogCache()
+    cache.configure(str(tmp_path / 'cache'))
+
+    def values(records):
+        return [(r.partition_id, r.offset, r.value.decode('utf-8')) for r in records]
+
+    topic.append(0, '{"a": 0}', '{"a": 1}')
+    topic.append(1, '{"b": 0}')
+    assert cache.sync('t', topic) == 3
+    assert values(cache.records('t')) == [(0, 0, '{"a": 0}'), (0, 1, '{"a": 1}'), (1, 0, '{"b": 0}')]
+    assert cache.records('t')[0].timestamp == 1000
+
+    # Nothing new: the topic isn't read at all.
+    assert cache.sync('t', topic) == 0
+    assert len(topic.reads) == 1
+
+    # Only new offsets are read.
+    topic.append(0, '{"a": 2}')
+    assert cache.sync('t', topic) == 1
+    assert topic.reads[-1] == {0: 2}
+    assert values(cache.records('t', {0: 2, 1: 1})) == [(0, 2, '{"a": 2}')]
+
+    # A new cache object (e.g. in another process) uses the same files.
+    cache2 = KafkaLogCache()
+    cache2.configure(str(tmp_path / 'cache'))
+    assert cache2.sync('t', topic) == 0
+    assert len(cache2.records('t')) == 4
+
+    # Simulate an interrupted append: unindexed data in the log is discarded.
+    with open(str(tmp_path / 'cache' / 't' / '0.log'), 'ab') as f:
+        f.write(b'garbage')
+    with open(str(tmp_path / 'cache' / 't' / '0.idx'), 'ab') as f:
+        f.write(b'xyz')
+    topic.append(0, '{"a": 3}')
+    assert cache.sync('t', topic) == 1
+    assert values(cache.records('t'))[:4] == [(0, 0, '{"a": 0}'), (0, 1, '{"a": 1}'), (0, 2, '{"a": 2}'), (0, 3, '{"a": 3}')]
+
+    cache.clear('t')
+    assert cache.records('t') == []
+    assert cache.sync('t', topic) == 5
+
+
+def test_coalesced():
+    num_requests = [0]
+    release = threading.Event()
+
+    @coalesced
+    @dvid_api_wrapper
+    def fetch_thing(server, uuid, instance, box, *, session=None):
+        num_requests[0] += 1
+        release.wait()
+        return np.asarray(box).sum(axis=0)
+
+    box = np.array([[0,0,0], [64,64,64]])
+    DVID_SINGLE_FLIGHT.reset()
+
+    with ThreadPool(4) as pool:
+        results = pool.map_async(lambda _: fetch_thing('foo', 'abc9', 'seg', box), range(4))
+        time.sleep(0.1)
+        release.set()
+        results = results.get()
+
+    assert num_requests[0] == 1
+    assert all((r == [64,64,64]).all() for r in results)
+    assert len(set(map(id, results))) == 4, "Each caller should receive its own copy"
+    assert DVID_SINGLE_FLIGHT.stats()['fetch_thing'] == {'calls': 4, 'coalesced': 3}
+
+    # Callers which modify their result in-place don't affect the other callers' results.
+    def fetch_and_modify(_):
+        r = fetch_thing('foo', 'abc9', 'seg', box)
+        r_copy = r.copy()
+        r[:] = -1
+        return r_copy
+
+    release.clear()
+    with ThreadPool(4) as pool:
+        results = pool.map_async(fetch_and_modify, range(4))
+        time.sleep(0.1)
+        release.set()
+        results = results.get()
+
+    assert num_requests[0] == 2
+    assert all((r == [64,64,64]).all() for r in results)
+
+    # Opt-out
+    fetch_thing('foo', 'abc9', 'seg', box, coalesce=False)
+    assert num_requests[0] == 3
+
+
+def test_aimd_limiter():
+    lim = AimdLimiter(initial_limit=4, min_limit=1, max_limit=8)
+    tokens = [lim.acquire() for _ in range(4)]
+    assert lim.in_flight == 4
+
+    # Simultaneous failures only decrease the limit once
+    lim.release(tokens[0], True)
+    lim.release(tokens[1], True)
+    assert lim.limit == 2.0
+
+    lim.release(tokens[2], False)
+    lim.release(tokens[3], False)
+    assert 2.0 < lim.limit < 3.0
+    assert lim.in_flight == 0
+
+
+def test_admission_control_retries():
+    ac = AdmissionControl()
+    ac.backoff_base = 0.001
+    ac.max_retries = 3
+
+    def send_fn(statuses):
+        def send():
+            r = requests.Response()
+            r.raw = BytesIO()
+            r.status_code = statuses.pop(0)
+            if r.status_code is None:
+                raise requests.ConnectionError("connection reset")
+            return r
+        return send
+
+    r = ac.send('foo:8000', send_fn([503, None, 429, 200]))
+    assert r.status_code == 200
+    stats = ac.stats()['foo:8000']
+    assert stats['retries'] == 3
+    assert stats['overloaded'] == 3
+    assert stats['in_flight'] == 0
+
+    # After max_retries, the caller gets the error response.
+    r = ac.send('foo:8000', send_fn([503]*4))
+    assert r.status_code == 503
+
+
 def test_dvid_api_wrapper():
     f = dvid_api_wrapper(lambda server, uuid, instance, x, *, session=None: (server, uuid, instance, x))
     server, uuid, instance, x = f("http://foo", "bar", "baz", 5)
@@ -134,6 +413,23 @@ def test_fetch_labels_batched(labelmap_setup):
     assert (labels == [1,1,1,2,2,2]).all() # See init_labelmap_nodes() in conftest.py
 
 
+def test_fetch_labels_via_blocks(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    coords = [[0,0,0], [0,0,1], [0,0,2],
+              [0,0,3], [0,0,4], [0,0,4]]
+
+    for strategy in ['auto', 'points', 'blocks']:
+        labels = fetch_labels_via_blocks(*instance_info, coords, supervoxels=False, strategy=strategy, min_block_points=4, blocks_per_batch=1, threads=2)
+        assert labels.dtype == np.uint64
+        assert (labels == 1).all() # See init_labelmap_nodes() in conftest.py
+
+        labels = fetch_labels_via_blocks(*instance_info, coords, supervoxels=True, strategy=strategy, min_block_points=4)
+        assert labels.dtype == np.uint64
+        assert (labels == [1,1,1,2,2,2]).all() # See init_labelmap_nodes() in conftest.py
+
+
 def test_fetch_mappings(labelmap_setup):
     """
     Test the wrapper function for the /mappings DVID API.
@@ -197,6 +493,27 @@ def test_post_mappings(labelmap_setup):
     assert (fetched_mapping == 1).all()
     
 
+def test_encode_mappings():
+    mappings = pd.Series(index=[1, 2, 3, 4, 5, 2**40], data=[10, 20, 10, 0, 2**50, 20], dtype=np.uint64)
+
+    # Compare with the protobuf implementation
+    expected_ops = MappingOps()
+    for body, body_svs in mappings.groupby(mappings.values):
+        op = MappingOp()
+        op.mutid = 7
+        op.mapped = body
+        op.original.extend(body_svs.index)
+        expected_ops.mappings.append(op)
+
+    assert encode_mappings(mappings, 7) == expected_ops.SerializeToString()
+
+    ops = MappingOps.FromString(encode_mappings(np.array([mappings.index, mappings.values]).transpose(), 0))
+    assert [(op.mutid, op.mapped, list(op.original)) for op in ops.mappings] == \
+        [(0, 0, [4]), (0, 10, [1, 3]), (0, 20, [2, 2**40]), (0, 2**50, [5])]
+
+    assert encode_mappings(mappings.iloc[:0], 7) == b''
+
+
 def test_fetch_complete_mappings(labelmap_setup):
     """
     Very BASIC test for fetch_complete_mappings().
@@ -284,6 +601,224 @@ def test_fetch_labelmap_voxels(labelmap_setup):
         "Fetched data was apparently not compressed"
     assert (voxels_proxy() == supervoxel_vol).all()
 
+    # Test block-iterator mode
+    voxels = np.zeros_like(supervoxel_vol)
+    blocks = fetch_labelmap_voxels(*instance_info, [(0,0,0), supervoxel_vol.shape], supervoxels=True, format='block-iterator')
+    for corner, block in blocks:
+        assert block.shape == (64,64,64)
+        overwrite_subvol(voxels, [corner, corner+64], block)
+    assert (voxels == supervoxel_vol).all()
+
+
+def test_iter_labelarray_block_data():
+    def encode(corner_zyx, labels):
+        # Just the label list is enough for this test (no indices)
+        data = gzip.compress(np.array([8,8,8,len(labels)], np.uint32).tobytes()
+                             + np.array(labels, np.uint64).tobytes())
+        header = np.array([*(np.array(corner_zyx[::-1]) // 64), len(data)], np.int32).tobytes()
+        return header + data
+
+    blocks = [encode((0,0,0), [0]), encode((0,0,64), [1,2,3]), encode((64,128,0), [0,0])]
+    payload = b''.join(blocks)
+
+    # Split the payload into awkward chunks
+    chunks = [payload[i:i+7] for i in range(0, len(payload), 7)]
+    results = list(iter_labelarray_block_data(chunks))
+    assert [c.tolist() for (c, _) in results] == [[0,0,0], [0,0,64], [64,128,0]]
+    assert [d for (_, d) in results] == blocks
+    assert [is_empty_labelarray_block(d) for d in blocks] == [True, False, True]
+
+    with pytest.raises(AssertionError):
+        list(iter_labelarray_block_data([payload[:-1]]))
+
+
+def _test_blocks():
+    """
+    A few blocks with various properties, for testing the labelarray codec.
+    """
+    rng = np.random.default_rng(0)
+    solid = np.full((64,64,64), 7, np.uint64)
+    few = rng.integers(0, 3, (64,64,64)).astype(np.uint64)
+    many = np.arange(64**3, dtype=np.uint64).reshape((64,64,64)) + np.uint64(2**63)
+    mixed = np.zeros((64,64,64), np.uint64)
+    mixed[:32] = 1
+    mixed[10:20, 10:20, 10:20] = np.arange(1000).reshape((10,10,10)) + 5
+    return [solid, few, many, mixed]
+
+
+def test_labelarray_block_codec():
+    for block in _test_blocks():
+        encoded = encode_labelarray_block(block)
+        assert (decode_labelarray_block(encoded) == block).all()
+
+    # Solid blocks are encoded with their header and label only.
+    assert len(encode_labelarray_block(_test_blocks()[0])) == 16+8
+
+    # Decode into a strided view
+    volume = np.zeros((128,128,128), np.uint64)
+    decode_labelarray_block(encode_labelarray_block(_test_blocks()[-1]), volume[64:, :64, 64:])
+    assert (volume[64:, :64, 64:] == _test_blocks()[-1]).all()
+    assert not volume[:64].any()
+
+
+def test_labelarray_block_codec_matches_libdvid():
+    for block in _test_blocks():
+        assert bytes(encode_labelarray_block(block)) == bytes(encode_label_block(block))
+
+        raw = encode_labelarray_blocks([(0,0,0)], [block])
+        libdvid_decoded = DVIDNodeService.inflate_labelarray_blocks3D_from_raw(raw, (64,64,64), (0,0,0))
+        assert (decode_labelarray_block(gzip.decompress(raw[16:])) == libdvid_decoded).all()
+
+
+@pytest.mark.parametrize('threads', [0, 4])
+def test_decode_labelarray_blocks(threads):
+    blocks = _test_blocks()
+    corners = [(0,0,0), (0,0,64), (64,64,0), (64,64,64)]
+    encoded = b""
+    for corner, block in zip(corners, blocks):
+        data = gzip.compress(encode_labelarray_block(block).tobytes())
+        encoded += np.array([*(np.array(corner[::-1]) // 64), len(data)], np.int32).tobytes() + data
+
+    volume = decode_labelarray_blocks(encoded, [(0,0,0), (128,128,128)], threads)
+    for corner, block in zip(corners, blocks):
+        assert (volume[box_to_slicing(corner, np.array(corner)+64)] == block).all()
+    assert not volume[64:, :64, :].any()
+
+    # Blocks outside the requested box are ignored
+    volume = decode_labelarray_blocks(encoded, [(0,0,64), (64,64,128)], threads)
+    assert (volume == blocks[1]).all()
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_parse_labelarray_data(threads):
+    blocks = _test_blocks()
+    corners = [(0,0,0), (0,0,64), (-64,64,0), (64,64,64)]
+    encoded = b""
+    for corner, block in zip(corners, blocks):
+        data = gzip.compress(encode_labelarray_block(block).tobytes())
+        encoded += np.array([*(np.array(corner[::-1]) // 64), len(data)], np.int32).tobytes() + data
+
+    block_ids, spans, labels, offsets = parse_labelarray_data(encoded, format='arrays', threads=threads)
+    assert block_ids.tolist() == [[0,0,0], [0,0,1], [-1,1,0], [1,1,1]]
+    assert spans[0,0] == 0 and spans[-1,1] == len(encoded)
+    assert (spans[1:,0] == spans[:-1,1]).all()
+    for i, block in enumerate(blocks):
+        assert set(labels[offsets[i]:offsets[i+1]]) == set(pd.unique(block.ravel()))
+
+    spans_dict, labels_dict = parse_labelarray_data(encoded, threads=threads)
+    assert list(spans_dict.keys()) == [(0,0,0), (0,0,1), (-1,1,0), (1,1,1)]
+    assert list(spans_dict.values()) == [tuple(s) for s in spans.tolist()]
+    for i, k in enumerate(spans_dict.keys()):
+        assert (labels_dict[k] == labels[offsets[i]:offsets[i+1]]).all()
+
+    assert parse_labelarray_data(encoded, False) == spans_dict
+
+    # Corrupt block sizes are rejected (rather than scanned forever)
+    for bad_size in (-16, 0, len(encoded)):
+        corrupt = bytearray(encoded)
+        corrupt[12:16] = np.int32(bad_size).tobytes()
+        with pytest.raises(ValueError):
+            parse_labelarray_data(bytes(corrupt), format='arrays')
+
+
+def test_labelmap_block_cache():
+    def encode(corner_zyx, block):
+        data = gzip.compress(encode_labelarray_block(block).tobytes())
+        return np.array([*(np.array(corner_zyx[::-1]) // 64), len(data)], np.int32).tobytes() + data
+
+    blocks = _test_blocks()
+    corners = [(0,0,0), (0,0,64), (0,64,0), (0,64,64)]
+    box = [(0,0,0), (64,128,128)]
+    encoded_blocks = [encode(c, b) for c, b in zip(corners, blocks)]
+    payload = b''.join(encoded_blocks)
+
+    cache = LabelmapBlockCache()
+    cache.configure(max_bytes=1e9)
+
+    # Locked node
+    cache._locked_nodes[('fake:8000', 'abc')] = (True, time.time())
+    assert cache.fetch_box('fake:8000', 'abc', 'seg', 0, True, box) is None
+    cache.store_box('fake:8000', 'abc', 'seg', 0, True, box, payload)
+    assert cache.fetch_box('fake:8000', 'abc', 'seg', 0, True, box) == payload
+    assert cache.fetch_box('fake:8000', 'abc', 'seg', 0, False, box) is None
+
+    # Missing blocks are cached as empty
+    cache.store_box('fake:8000', 'abc', 'seg', 0, True, [(0,0,0), (64,128,192)], payload)
+    assert cache.fetch_box('fake:8000', 'abc', 'seg', 0, True, [(0,0,128), (64,64,192)]) == b''
+
+    # Unlocked node, whose kafka log has already been read.
+    cache._locked_nodes[('fake:8000', 'def')] = (False, time.time())
+    cache._kafka_states[('fake:8000', 'def', 'seg')] = state = _KafkaState()
+    state.refresh_time = time.time()
+    state.valid = True
+    cache.store_box('fake:8000', 'def', 'seg', 0, True, box, payload)
+    cache.store_box('fake:8000', 'def', 'seg', 0, False, box, payload)
+
+    # Merging label 7 doesn't affect supervoxel blocks,
+    # but the 'solid' and 'mixed' body blocks must be discarded.
+    cache.apply_kafka_messages('fake:8000', 'def', 'seg', [{'Action': 'merge', 'UUID': 'def', 'MutationID': 1, 'Target': 1000, 'Labels': [7]}])
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, True, box) == payload
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, False, box) is None
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, False, [(0,0,64), (64,128,128)]) is None
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, False, [(0,0,64), (64,64,128)]) == encoded_blocks[1]
+
+    # Splitting supervoxel 2 affects the 'few' block, but not the others.
+    cache.apply_kafka_messages('fake:8000', 'def', 'seg', [{'Action': 'split-supervoxel', 'UUID': 'def', 'MutationID': 2, 'Supervoxel': 2}])
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, True, box) is None
+    assert cache.fetch_box('fake:8000', 'def', 'seg', 0, True, [(0,0,0), (64,64,64)]) is not None
+
+    # Eviction
+    assert cache.stats()['invalidations'] == 3
+    cache.configure(max_bytes=len(payload) // 2)
+    assert cache.stats()['bytes'] <= len(payload) // 2
+    assert cache.fetch_box('fake:8000', 'abc', 'seg', 0, True, box) is None
+
+
+def test_labelmap_block_cache_refresh(monkeypatch):
+    import neuclease.dvid.kafka
+
+    log = []
+    reads = []
+    read_started = threading.Event()
+    release_read = threading.Event()
+    def read_kafka_messages(server, uuid, instance, **kwargs):
+        reads.append(uuid)
+        if len(reads) > 1:
+            read_started.set()
+            release_read.wait(10.0)
+        return list(log)
+
+    monkeypatch.setattr(neuclease.dvid.kafka, 'read_kafka_messages', read_kafka_messages)
+
+    cache = LabelmapBlockCache()
+    cache.configure(max_bytes=1e9)
+    cache._locked_nodes[('fake:8000', 'def')] = (False, time.time())
+
+    # The first check reads the log synchronously.
+    assert cache._check_node('fake:8000', 'def', 'seg')
+    assert len(reads) == 1
+
+    # An explicit refresh() within refresh_seconds doesn't re-read the log.
+    assert cache.refresh('fake:8000', 'def', 'seg')
+    assert len(reads) == 1
+
+    # Once the log is stale, it is re-read in the background,
+    # and callers don't wait for it.
+    cache.store_box('fake:8000', 'def', 'seg', 0, False, [(0,0,0), (64,64,64)], b'')
+    log.append({'Action': 'some-future-action', 'UUID': 'def', 'MutationID': 1})
+    cache.refresh_seconds = 0.0
+    assert cache._check_node('fake:8000', 'def', 'seg')
+    assert read_started.wait(10.0)
+    assert cache._check_node('fake:8000', 'def', 'seg')
+    assert len(reads) == 2
+
+    release_read.set()
+    for _ in range(100):
+        if cache.stats()['invalidations'] == 1:
+            break
+        time.sleep(0.05)
+    assert cache.stats()['invalidations'] == 1
+
 
 def test_post_labelmap_blocks(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
@@ -301,6 +836,30 @@ def test_post_labelmap_blocks(labelmap_setup):
     assert (complete_voxels[0:64,  0:64, 64:128] == blocks[2]).all()
 
 
+def test_encode_labelarray_blocks_threaded():
+    blocks = _test_blocks()
+    corners = [(0,0,0), (0,0,64), (64,64,0), (64,64,64)]
+    encoded = encode_labelarray_blocks(corners, blocks, threads=2)
+    volume = decode_labelarray_blocks(encoded, [(0,0,0), (128,128,128)])
+    for corner, block in zip(corners, blocks):
+        assert (volume[box_to_slicing(corner, np.array(corner)+64)] == block).all()
+
+
+def test_post_labelmap_blocks_pipelined(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation-scratch')
+
+    blocks = np.random.randint(10, size=(5,64,64,64), dtype=np.uint64)
+    corners_zyx = [[0,0,0], [0,64,0], [0,0,64], [64,0,0], [64,64,64]]
+
+    stats = post_labelmap_blocks_pipelined(*instance_info, iter(corners_zyx), iter(blocks), batch_size=2, threads=2, max_pending_batches=1)
+    assert stats.loc['encode', 'blocks'] == stats.loc['post', 'blocks'] == 5
+
+    complete_voxels = fetch_labelmap_voxels(*instance_info, [(0,0,0), (128,128,128)], supervoxels=True)
+    for corner, block in zip(corners_zyx, blocks):
+        assert (complete_voxels[box_to_slicing(corner, np.array(corner)+64)] == block).all()
+
+
 def test_post_labelmap_voxels(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
     instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation-scratch')
@@ -315,6 +874,36 @@ def test_post_labelmap_voxels(labelmap_setup):
     assert (complete_voxels[64:192, 64:192, 64:192] == vol).all()
 
 
+def test_fetch_sparsevol_batches(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = (dvid_server, dvid_repo, 'segmentation-test-sparsevol-batches')
+    create_labelmap_instance(*instance_info, max_scale=1)
+
+    # Label 1 occupies two separate Z-ranges,
+    # so some Z-slabs in between contain no voxels (DVID returns 404 for them).
+    vol = np.zeros((256, 64, 128), np.uint64)
+    vol[10:40, 5:50, 20:100] = 1
+    vol[200:230, 30:60, 0:60] = 1
+    vol[100:120] = 2
+    post_labelmap_voxels(*instance_info, (0,0,0), vol, 0)
+    post_labelmap_voxels(*instance_info, (0,0,0), vol[::2, ::2, ::2], 1)
+
+    for scale in (0, 1):
+        expected = fetch_sparsevol(*instance_info, 1, scale=scale, format='ranges')
+        assert len(expected) > 0
+
+        batches = list(fetch_sparsevol_batches(*instance_info, 1, scale=scale, batch_size=7))
+        assert all(len(b) <= 7 for b in batches)
+        assert (np.concatenate(batches) == expected).all()
+
+        # Slabs which don't evenly divide the body's Z-range, fetched in parallel.
+        batches = list(fetch_sparsevol_batches(*instance_info, 1, scale=scale, batch_size=7, z_slab_size=24, threads=3))
+        assert (np.concatenate(batches) == expected).all()
+
+        coords = np.concatenate(list(fetch_sparsevol_batches(*instance_info, 1, scale=scale, format='coords', z_slab_size=24, threads=3)))
+        assert (coords == fetch_sparsevol(*instance_info, 1, scale=scale)).all()
+
+
 def test_fetch_raw(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, supervoxel_vol = labelmap_setup
     instance_info = (dvid_server, dvid_repo, 'segmentation')
@@ -464,6 +1053,332 @@ def test_fetch_labelindices(labelmap_setup):
     copy_labelindices(instance_info, instance_info, list(range(1,10)), batch_size=2, processes=2)
 
 
+def test_parse_labelindex():
+    def random_labelindex(label, num_blocks):
+        coords = np.unique(np.random.randint(-100, 100, size=(num_blocks, 3)), axis=0) * 64
+        rows = [(*coord, sv, np.random.randint(1, 64**3)) for coord in coords for sv in np.random.randint(1, 2**40, size=3)]
+        df = pd.DataFrame(rows, columns=['z', 'y', 'x', 'sv', 'count'])
+        return create_labelindex(PandasLabelIndex(df, label, 123, '2020-01-01T12:00:00', 'someuser'))
+
+    def sorted_blocks(pli):
+        return pli.blocks.sort_values(['z', 'y', 'x', 'sv']).reset_index(drop=True)
+
+    labelindex = random_labelindex(10, 100)
+    expected = convert_labelindex_to_pandas(labelindex)
+
+    arrays = parse_labelindex(labelindex.SerializeToString())
+    assert len(arrays.svs) == len(arrays.counts) == len(arrays.block_ids) == len(expected.blocks)
+    assert tuple(arrays[3:]) == (10, 123, '2020-01-01T12:00:00', 'someuser')
+
+    pli = labelindex_arrays_to_pandas(arrays)
+    assert tuple(pli[1:]) == tuple(expected[1:])
+    assert sorted_blocks(pli).equals(sorted_blocks(expected))
+
+    labelindices = LabelIndices()
+    labelindices.indices.extend([random_labelindex(label, n) for label, n in [(1, 10), (2, 1), (3, 50)]])
+    parsed = parse_labelindices(labelindices.SerializeToString())
+    assert [a.label for a in parsed] == [1, 2, 3]
+    for arrays, labelindex in zip(parsed, labelindices.indices):
+        pli = labelindex_arrays_to_pandas(arrays)
+        assert sorted_blocks(pli).equals(sorted_blocks(convert_labelindex_to_pandas(labelindex)))
+
+
+def test_encode_labelindex():
+    def random_pandas_labelindex(label, num_blocks):
+        coords = np.unique(np.random.randint(0, 1000, size=(num_blocks, 3)), axis=0) * 64
+        rows = [(*coord, sv, np.random.randint(1, 64**3)) for coord in coords for sv in np.random.randint(1, 2**40, size=3)]
+        df = pd.DataFrame(rows, columns=['z', 'y', 'x', 'sv', 'count'])
+        return PandasLabelIndex(df.sample(frac=1.0), label, 123, '2020-01-01T12:00:00', 'someuser')
+
+    def sorted_blocks(pli):
+        blocks = pli.blocks.sort_values(['z', 'y', 'x', 'sv']).reset_index(drop=True)
+        return blocks.astype({'z': np.int64, 'y': np.int64, 'x': np.int64, 'sv': np.uint64, 'count': np.uint32})
+
+    pli = random_pandas_labelindex(10, 100)
+    raw = create_labelindex(pli, format='raw')
+
+    # The encoded bytes are understood by protobuf
+    labelindex = LabelIndex.FromString(raw)
+    assert (labelindex.label, labelindex.last_mutid, labelindex.last_mod_user) == (10, 123, 'someuser')
+    assert sorted_blocks(convert_labelindex_to_pandas(labelindex)).equals(sorted_blocks(pli))
+
+    # Roundtrip through the arrays format
+    assert encode_labelindex(parse_labelindex(raw)) == raw
+    assert encode_labelindex(parse_labelindex(labelindex.SerializeToString())) == raw
+
+    # Arrays whose block entries are not contiguous are grouped by block before encoding.
+    arrays = parse_labelindex(raw)
+    shuffled = np.random.permutation(len(arrays.block_ids))
+    arrays = arrays._replace(block_ids=arrays.block_ids[shuffled], svs=arrays.svs[shuffled], counts=arrays.counts[shuffled])
+    labelindex = LabelIndex.FromString(encode_labelindex(arrays))
+    assert sorted_blocks(convert_labelindex_to_pandas(labelindex)).equals(sorted_blocks(pli))
+
+    # Batches
+    plis = [random_pandas_labelindex(label, n) for label, n in [(1, 10), (2, 1), (3, 50)]]
+    labelindices = LabelIndices.FromString(encode_labelindices(plis))
+    assert [li.label for li in labelindices.indices] == [1, 2, 3]
+    for li, pli in zip(labelindices.indices, plis):
+        assert sorted_blocks(convert_labelindex_to_pandas(li)).equals(sorted_blocks(pli))
+
+    # Default values are omitted
+    empty = PandasLabelIndex(pli.blocks.iloc[:0], 5, 0, '', '')
+    assert create_labelindex(empty, format='raw') == LabelIndex(label=5).SerializeToString()
+
+
+def test_labelindex_cache():
+    def labelindex_arrays(label, mutid, num_blocks):
+        coords = np.arange(num_blocks)[:, None] * [0, 0, 64]
+        df = pd.DataFrame(coords, columns=['z', 'y', 'x'])
+        df['sv'] = np.uint64(label)
+        df['count'] = np.uint32(100)
+        return create_labelindex(PandasLabelIndex(df, label, mutid, '', ''), format='arrays')
+
+    node = ('fake:8000', 'abc', 'segmentation')
+    cache = LabelIndexCache()
+    cache.configure(max_bytes=1e6)
+
+    assert cache.get(*node, 1, mutid=10) is None
+    cache.store(*node, labelindex_arrays(1, 10, 100))
+    cache.store(*node, labelindex_arrays(2, 20, 100))
+
+    arrays = cache.get(*node, 1, mutid=10)
+    assert arrays.label == 1 and len(arrays.svs) == 100
+    assert not arrays.svs.flags.writeable
+
+    # The body has been modified since it was cached
+    assert cache.get(*node, 2, mutid=21) is None
+    assert not cache.contains(*node, 2)
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stale'], stats['labelindexes']) == (1, 1, 1, 1)
+
+    # Least-recently-used entries are evicted first
+    cache.store(*node, labelindex_arrays(3, 30, 100))
+    cache.get(*node, 1, mutid=10)
+    cache.configure(max_bytes=cache.stats()['bytes'] - 1)
+    assert cache.contains(*node, 1)
+    assert not cache.contains(*node, 3)
+
+    cache.configure(max_bytes=0)
+    assert not cache.enabled
+    assert cache.stats()['bytes'] == 0
+
+
+def test_fetch_labelindices_via_cache(monkeypatch):
+    from neuclease.dvid.labelmap import _labelindex
+
+    def labelindex_arrays(label, mutid):
+        df = pd.DataFrame([[0, 0, 0, label, 100]], columns=['z', 'y', 'x', 'sv', 'count'])
+        return create_labelindex(PandasLabelIndex(df, label, mutid, '', ''), format='arrays')
+
+    node = ('fake:8000', 'abc', 'segmentation')
+    cache = LabelIndexCache()
+    cache.configure(max_bytes=1e6)
+    cache.store(*node, labelindex_arrays(1, 10))
+    cache.store(*node, labelindex_arrays(2, 20))
+    monkeypatch.setattr(_labelindex, 'DVID_LABELINDEX_CACHE', cache)
+
+    # Label 2 has been merged into another body, so /lastmod/2 fails.
+    def fetch_mutation_id(server, uuid, instance, label, *, session=None):
+        if label == 2:
+            r = requests.Response()
+            r.status_code = 400
+            raise requests.HTTPError(response=r)
+        return 10
+
+    # DVID omits label 2 from /indices, too.
+    requested = []
+    def fetch_labelindices(server, uuid, instance, labels, *, format, session=None):
+        requested.extend(labels)
+        return encode_labelindices([labelindex_arrays(label, 30) for label in labels if label != 2])
+
+    monkeypatch.setattr(_labelindex, 'fetch_mutation_id', fetch_mutation_id)
+    monkeypatch.setattr(_labelindex, 'fetch_labelindices', fetch_labelindices)
+
+    indices = _labelindex._fetch_labelindices_via_cache(*node, [1, 2, 3], None)
+    assert [li.label for li in indices] == [1, 3]
+    assert requested == [3]
+    assert not cache.contains(*node, 2)
+    assert cache.contains(*node, 3)
+
+    # Large batches bypass revalidation.
+    monkeypatch.setattr(_labelindex, '_MAX_REVALIDATIONS', 1)
+    requested.clear()
+    indices = _labelindex._fetch_labelindices_via_cache(*node, [1, 3], None)
+    assert [li.label for li in indices] == [1, 3]
+    assert requested == [1, 3]
+
+
+def test_labelmap_mapping(tmpdir):
+    # Body 10 = [1,2,3], Body 20 = [4,5], Body 6 is an (unlisted) single-supervoxel body.
+    base = pd.Series([10, 10, 10, 20, 20], index=[1, 2, 3, 4, 5], dtype=np.uint64)
+    mapping = LabelmapMapping(base, last_mutid=100, source=('fake:8000', 'abc123', 'seg', 'd00d'))
+    series_before = mapping.series
+
+    # The caller's Series isn't renamed.
+    assert base.name is None and base.index.name is None
+    assert mapping.series.name == 'body' and mapping.series.index.name == 'sv'
+
+    msgs = [
+        # Already reflected in the mapping; ignored.
+        {'Action': 'merge', 'UUID': 'abc', 'MutationID': 99, 'Target': 20, 'Labels': [10]},
+
+        {'Action': 'merge', 'UUID': 'abc', 'MutationID': 101, 'Target': 10, 'Labels': [20, 6]},
+        {'Action': 'merge-complete', 'UUID': 'abc', 'MutationID': 101},
+        {'Action': 'cleave', 'UUID': 'abc', 'MutationID': 102, 'OrigLabel': 10, 'CleavedLabel': 30, 'CleavedSupervoxels': [2, 4]},
+        {'Action': 'split-supervoxel', 'UUID': 'abc', 'MutationID': 103, 'Supervoxel': 4, 'SplitSupervoxel': 7, 'RemainSupervoxel': 8},
+        {'Action': 'split', 'UUID': 'abc', 'MutationID': 104, 'Target': 10, 'NewLabel': 40,
+         'SVSplits': {'5': {'Split': 9, 'Remain': 11}}},
+    ]
+
+    assert mapping.apply_kafka_messages(msgs) == 4
+    assert mapping.last_mutid == 104
+
+    expected = pd.Series({1: 10, 2: 30, 3: 10, 4: 0, 5: 0, 6: 10, 7: 30, 8: 30, 9: 40, 11: 10}, dtype=np.uint64)
+    assert (mapping.index == expected.index).all()
+    assert (mapping.values == expected.values).all()
+    assert mapping.loc[7] == 30
+    assert sorted(mapping[mapping == 10].index) == [1, 3, 6, 11]
+
+    # The previously published Series was not modified.
+    assert (series_before.values == base.values).all()
+
+    # Replaying the same messages has no effect
+    assert mapping.apply_kafka_messages(msgs) == 0
+
+    # Snapshots
+    path = str(tmpdir / 'mapping.npz')
+    mapping.save(path)
+    loaded = LabelmapMapping.load(path)
+    assert loaded.last_mutid == 104
+    assert (loaded.series == mapping.series).all()
+    assert loaded.source == ('fake:8000', 'abc123', 'seg', 'd00d')
+
+    # Snapshots from another instance (or without a source) can't be updated.
+    assert not loaded.is_compatible('fake:8000', 'abc123', 'other-seg')
+    assert not loaded.is_compatible('other:8000', 'abc123', 'seg')
+    assert not LabelmapMapping(base).is_compatible('fake:8000', 'abc123', 'seg')
+
+    # Without retired supervoxels
+    mapping = LabelmapMapping(base.copy(), last_mutid=100, include_retired=False)
+    mapping.apply_kafka_messages(msgs)
+    assert (mapping.series == expected[expected != 0]).all()
+
+
+def test_diff_sorted_mappings():
+    # sv 1: unchanged
+    # sv 2: moved from body 10 to 20
+    # sv 3: only in a (body 30)
+    # sv 5: only in b (body 50)
+    mapping_a = np.array([[1, 10], [2, 10], [3, 30], [4, 40]], np.uint64)
+    mapping_b = np.array([[1, 10], [2, 20], [4, 40], [5, 50]], np.uint64)
+
+    n = _diff_sorted_mappings(mapping_a, mapping_b, np.zeros(0, np.uint64), False)
+    changed = np.zeros(n, np.uint64)
+    assert _diff_sorted_mappings(mapping_a, mapping_b, changed, True) == n
+    assert sorted(set(changed)) == [10, 20, 30, 50]
+
+    # Compare with a naive pandas diff
+    rng = np.random.default_rng(0)
+    svs_a = np.unique(rng.integers(1, 1000, 500).astype(np.uint64))
+    svs_b = np.unique(rng.integers(1, 1000, 500).astype(np.uint64))
+    mapping_a = np.array((svs_a, rng.integers(0, 20, len(svs_a))), np.uint64).transpose().copy()
+    mapping_b = np.array((svs_b, rng.integers(0, 20, len(svs_b))), np.uint64).transpose().copy()
+
+    n = _diff_sorted_mappings(mapping_a, mapping_b, np.zeros(0, np.uint64), False)
+    changed = np.zeros(n, np.uint64)
+    _diff_sorted_mappings(mapping_a, mapping_b, changed, True)
+
+    df_a = pd.DataFrame(mapping_a[:, 1], index=mapping_a[:, 0], columns=['body'])
+    df_b = pd.DataFrame(mapping_b[:, 1], index=mapping_b[:, 0], columns=['body'])
+    df = df_a.merge(df_b, 'outer', left_index=True, right_index=True, suffixes=['_a', '_b'])
+    expected = np.unique(df.query('body_a != body_b').fillna(0).values.astype(np.uint64))
+    assert (np.unique(changed) == expected).all()
+
+
+def test_fetch_sorted_mapping_array():
+    mapping = np.array([[5, 50], [1, 10], [4, 40], [2, 20]], np.uint64)
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            r = requests.Response()
+            r.status_code = 200
+            r.raw = BytesIO(mapping.tobytes())
+            return r
+
+    sorted_mapping = _fetch_sorted_mapping_array('fake:8000', 'abc', 'seg', session=FakeSession())
+    assert sorted_mapping.flags.writeable
+    assert sorted_mapping.tolist() == [[1, 10], [2, 20], [4, 40], [5, 50]]
+
+
+def test_labelmap_kafka_columns():
+    msgs = [
+        {'Action': 'merge', 'UUID': 'abc', 'MutationID': 101, 'Target': 10, 'Labels': [20, 6], 'Timestamp': '2019-01-02 03:04:05.678901 -0500 EST'},
+        {'Action': 'merge-complete', 'UUID': 'abc', 'MutationID': 101},
+        {'Action': 'cleave', 'UUID': 'abc', 'MutationID': 102, 'OrigLabel': 10, 'CleavedLabel': 30, 'CleavedSupervoxels': [2, 4]},
+        {'Action': 'split-supervoxel', 'UUID': 'def', 'MutationID': 103, 'Supervoxel': 4, 'SplitSupervoxel': 7, 'RemainSupervoxel': 8},
+        {'Action': 'split', 'UUID': 'def', 'MutationID': 104, 'Target': 10, 'NewLabel': 40,
+         'SVSplits': {'5': {'Split': 9, 'Remain': 11}, '12': {'Split': 13, 'Remain': 14}}},
+        {'Action': 'split-complete', 'UUID': 'def', 'MutationID': 104},
+        # Duplicate mutation ID (as in some old logs)
+        {'Action': 'merge', 'UUID': 'def', 'MutationID': 101, 'Target': 40, 'Labels': [30]},
+        {'Action': 'merge-complete', 'UUID': 'def', 'MutationID': 101},
+    ]
+
+    raw_msgs = [json.dumps(msg).encode('utf-8') for msg in msgs]
+    for kafka_msgs, kwargs in [(msgs, {}), (raw_msgs, {}), (raw_msgs, {'batch_size': 3})]:
+        cols = parse_labelmap_kafka_msgs(kafka_msgs, **kwargs)
+        assert len(cols) == 8
+        assert list(cols.action) == [msg['Action'] for msg in msgs]
+        assert list(cols.uuid) == [msg['UUID'] for msg in msgs]
+        assert cols.mutid.tolist() == [101, 101, 102, 103, 104, 104, 101, 101]
+        assert cols.timestamp[0] == np.datetime64('2019-01-02 03:04:05.678')
+        assert cols.timestamp[1] == np.datetime64('2018-01-01')
+        assert cols.target_body.tolist() == [10, 0, 10, 0, 10, 0, 40, 0]
+        assert cols.new_label.tolist() == [0, 0, 30, 0, 40, 0, 0, 0]
+        assert cols.is_complete.tolist() == [False, True, False, False, False, True, False, True]
+        assert cols.merged_labels.tolist() == [20, 6, 30]
+        assert cols.csr_rows('merged_labels').tolist() == [0, 0, 6]
+        assert cols.cleaved_svs_ptr.tolist() == [0, 0, 0, 2, 2, 2, 2, 2, 2]
+        assert cols.sv_splits.tolist() == [[5, 11, 9], [12, 14, 13]]
+
+    df = labelmap_kafka_msgs_to_df(msgs, drop_completes=False)
+    assert df.columns.tolist() == ['timestamp', 'uuid', 'mutid', 'action', 'target_body', 'target_sv', 'msg']
+    assert df['target_body'].tolist() == [10, 10, 10, 0, 10, 10, 40, 40]
+    assert df['target_sv'].tolist() == [0, 0, 0, 4, 0, 0, 0, 0]
+    assert (df['mutid'].dtype, df['target_body'].dtype, df['target_sv'].dtype) == (np.int64, np.int64, np.int64)
+    assert df['msg'].tolist() == msgs
+
+    df = labelmap_kafka_msgs_to_df(raw_msgs)
+    assert df['action'].tolist() == ['merge', 'cleave', 'split-supervoxel', 'split', 'merge']
+
+    new_bodies, changed_bodies, removed_bodies, new_supervoxels = compute_affected_bodies(msgs)
+    assert sorted(new_bodies) == [40]
+    assert sorted(changed_bodies) == [10, 40]
+    assert sorted(removed_bodies) == [6, 20, 30]
+    assert sorted(new_supervoxels) == [7, 8]
+
+    # A merge which failed (no merge-complete), after which one of its 'merged'
+    # labels was cleaved.  That label is still reported as changed.
+    failed_merge_msgs = [
+        {'Action': 'merge', 'UUID': 'abc', 'MutationID': 201, 'Target': 50, 'Labels': [60, 70]},
+        {'Action': 'cleave', 'UUID': 'abc', 'MutationID': 202, 'OrigLabel': 60, 'CleavedLabel': 80, 'CleavedSupervoxels': [61]},
+        {'Action': 'cleave-complete', 'UUID': 'abc', 'MutationID': 202},
+    ]
+    new_bodies, changed_bodies, removed_bodies, _ = compute_affected_bodies(failed_merge_msgs)
+    assert sorted(new_bodies) == [80]
+    assert sorted(changed_bodies) == [50, 60]
+    assert sorted(removed_bodies) == [60, 70]
+
+    events = fetch_supervoxel_splits_from_kafka('fake:8000', 'def', 'seg', kafka_msgs=msgs)
+    assert events == { 'def': [ SplitEvent(103, 4, 8, 7, 'split-supervoxel'),
+                                SplitEvent(104, 5, 11, 9, 'split'),
+                                SplitEvent(104, 12, 14, 13, 'split') ] }
+
+    events = fetch_supervoxel_splits_from_kafka('fake:8000', 'def', 'seg', actions=['split'], kafka_msgs=cols)
+    assert [e.type for e in events['def']] == ['split', 'split']
+
+
 def test_fetch_sparsevol_coarse_via_labelindex(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
 
@@ -508,6 +1423,27 @@ def test_fetch_sparsevol_coarse_via_labelindex(labelmap_setup):
     expected_sv_svc = fetch_sparsevol_coarse(*instance_info, 3, supervoxels=True)
     assert sorted(sv_svc.tolist()) == sorted(expected_sv_svc.tolist())
 
+    sv_svc = fetch_sparsevol_coarse_via_labelindex(*instance_info, 3, supervoxels=True, method='arrays')
+    expected_sv_svc = fetch_sparsevol_coarse(*instance_info, 3, supervoxels=True)
+    assert sorted(sv_svc.tolist()) == sorted(expected_sv_svc.tolist())
+
+    # Several labels, in more than one batch (overlapping coordinates are listed once)
+    svc = fetch_sparsevol_coarse_via_labelindex(*instance_info, [3, 4, 5, 6], supervoxels=True, method='arrays', batch_size=2)
+    expected_svc = fetch_sparsevol_coarse_via_labelindex(*instance_info, [3, 4, 5, 6], supervoxels=True, method='protobuf')
+    assert sorted(svc.tolist()) == sorted(expected_svc.tolist())
+
+    # Batched, per-label results
+    for supervoxels, labels in [(False, [1, 2, 6]), (True, [1, 2, 3, 4, 5, 6])]:
+        svc_df = fetch_sparsevol_coarse_via_labelindices(*instance_info, labels, supervoxels, batch_size=2)
+        assert svc_df.columns.tolist() == [('sv' if supervoxels else 'body'), 'z', 'y', 'x']
+
+        svc_dict = fetch_sparsevol_coarse_via_labelindices(*instance_info, labels, supervoxels, format='dict', threads=2)
+        assert sorted(svc_dict.keys()) == labels
+        for label in labels:
+            expected_svc = fetch_sparsevol_coarse(*instance_info, label, supervoxels=supervoxels)
+            assert sorted(svc_dict[label].tolist()) == sorted(expected_svc.tolist())
+            assert sorted(svc_df.loc[svc_df.iloc[:, 0] == label, ['z', 'y', 'x']].values.tolist()) == sorted(expected_svc.tolist())
+
 
 def test_post_hierarchical_cleaves(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
@@ -5,7 +5,11 @@ import scipy.ndimage
 
 from neuclease.dvid.rle import (runlength_encode_to_ranges, runlength_decode_from_ranges,
                                 runlength_encode_to_lengths, runlength_decode_from_lengths,
-                                rle_box_dilation)
+                                rle_box_dilation, rle_normalize, rle_union, rle_intersection, rle_difference,
+                                rle_clip_to_box, rle_downsample, rle_voxel_count, rle_bounding_box,
+                                rle_ranges_from_lengths, rle_lengths_from_ranges,
+                                parse_rle_response, iter_rle_ranges, iter_rle_batches,
+                                rle_to_sparse_block_mask, iter_rle_block_masks)
 
 @pytest.fixture
 def sparse_object():
@@ -94,5 +98,103 @@ def test_rle_box_dilation(sparse_object):
 
     
 
+def test_rle_algebra():
+    def mask_to_ranges(mask):
+        coords = np.transpose(mask.nonzero()).astype(np.int32)
+        if len(coords) == 0:
+            return np.zeros((0,4), np.int32)
+        return runlength_encode_to_ranges(coords, assume_sorted=True)
+
+    rng = np.random.default_rng(0)
+    shape = (4, 4, 32)
+    box = [(1,1,3), (3,4,20)]
+    box_mask = np.zeros(shape, bool)
+    box_mask[1:3, 1:4, 3:20] = True
+
+    for _ in range(100):
+        a_mask = rng.random(shape) < rng.random()
+        b_mask = rng.random(shape) < rng.random()
+        a = mask_to_ranges(a_mask)
+        b = mask_to_ranges(b_mask)
+
+        # Inputs needn't be sorted
+        shuffled_a = a[rng.permutation(len(a))]
+        assert (rle_normalize(shuffled_a) == a).all()
+
+        assert (rle_union(shuffled_a, b) == mask_to_ranges(a_mask | b_mask)).all()
+        assert (rle_intersection(shuffled_a, b) == mask_to_ranges(a_mask & b_mask)).all()
+        assert (rle_difference(shuffled_a, b) == mask_to_ranges(a_mask & ~b_mask)).all()
+        assert (rle_clip_to_box(a, box) == mask_to_ranges(a_mask & box_mask)).all()
+        assert rle_voxel_count(a) == a_mask.sum()
+
+        coarse_coords = np.unique(np.transpose(a_mask.nonzero()) // 2, axis=0).astype(np.int32)
+        if len(coarse_coords) > 0:
+            assert (rle_downsample(a, 1) == runlength_encode_to_ranges(coarse_coords, True)).all()
+
+            coords = np.transpose(a_mask.nonzero())
+            assert (rle_bounding_box(a) == [coords.min(axis=0), 1+coords.max(axis=0)]).all()
+
+    start_coords, lengths = rle_lengths_from_ranges(a)
+    assert (rle_ranges_from_lengths(start_coords, lengths) == a).all()
+
+
+def test_iter_rle_ranges(sparse_object):
+    coords, ranges, lengths_table = sparse_object
+    coords = np.concatenate([coords + (z,0,0) for z in range(10)])
+    ranges = np.concatenate([ranges + (z,0,0,0) for z in range(10)])
+    lengths_table = np.concatenate([lengths_table + (z,0,0,0) for z in range(10)])
+
+    # DVID's Legacy RLE format: header, then [X,Y,Z,N] runs
+    header = np.array([0, 3, 0, 0], np.uint8).tobytes() + np.array([0, len(ranges)], np.uint32).tobytes()
+    payload = header + lengths_table[:, (2,1,0,3)].astype(np.int32).tobytes()
+
+    assert (parse_rle_response(payload) == coords).all()
+    assert (parse_rle_response(payload, np.int16) == coords).all()
+    assert (parse_rle_response(payload, format='ranges') == ranges).all()
+
+    # Stream the payload in small, irregular chunks
+    chunks = [payload[i:i+7] for i in range(0, len(payload), 7)]
+    batches = list(iter_rle_ranges(chunks, batch_size=4))
+    assert max(map(len, batches)) == 4
+    assert (np.concatenate(batches) == ranges).all()
+
+    coord_batches = list(iter_rle_batches(ranges, 'coords', batch_size=5))
+    assert max(map(len, coord_batches)) <= 5
+    assert (np.concatenate(coord_batches) == coords).all()
+
+    with pytest.raises(AssertionError):
+        list(iter_rle_ranges(chunks[:-1]))
+
+
+def test_rle_block_masks():
+    # Random object, including negative coordinates
+    vol = np.random.default_rng(0).random((40, 50, 60)) < 0.2
+    coords = np.transpose(vol.nonzero()).astype(np.int32) - (20, 0, 7)
+    ranges = runlength_encode_to_ranges(coords)
+    block_coords = np.unique(coords // (8, 16, 32), axis=0)
+
+    sbm = rle_to_sparse_block_mask(ranges, (8, 16, 32), threads=2)
+    assert (sbm.resolution == (8, 16, 32)).all()
+    assert (np.transpose(sbm.lowres_mask.nonzero()) + sbm.box[0] // (8, 16, 32) == block_coords).all()
+
+    # With a block shape of 1, the result is just the dense mask
+    sbm = rle_to_sparse_block_mask(ranges, 1)
+    assert (sbm.box == [(-20, 0, -7), (20, 50, 53)]).all()
+    assert (sbm.lowres_mask == vol).all()
+
+    # Runs needn't be sorted
+    shuffled = ranges[np.random.default_rng(1).permutation(len(ranges))]
+    blocks = list(iter_rle_block_masks(shuffled, (8, 16, 32), threads=2, batch_blocks=3))
+    assert (np.array([corner for corner, _ in blocks]) == block_coords * (8, 16, 32)).all()
+
+    for corner, mask in blocks:
+        block_voxels = coords[(coords // (8, 16, 32) == corner // (8, 16, 32)).all(axis=1)] - corner
+        expected = np.zeros((8, 16, 32), bool)
+        expected[tuple(block_voxels.transpose())] = True
+        assert (mask == expected).all()
+
+    assert list(iter_rle_block_masks(np.zeros((0,4), np.int32))) == []
+
+
 if __name__ == "__main__":
     pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_rle'])
@@ -49,6 +49,7 @@ def cleave_server_setup(labelmap_setup):
                                     "--primary-dvid-server", f"{dvid_server}:{dvid_port}",
                                     "--primary-uuid", dvid_repo,
                                     "--primary-labelmap-instance", "segmentation",
+                                    "--record-dvid-metrics",
                                     "--testing",
                                     f"--log-dir={TEST_DATA_DIR}"])
 
@@ -128,6 +129,28 @@ def test_set_primary_uuid(cleave_server_setup):
     assert r.json()["uuid"] == "abc123"
     
 
+@show_request_exceptions
+def test_metrics(cleave_server_setup):
+    dvid_server, dvid_port, dvid_repo, port = cleave_server_setup
+
+    data = { "body-id": 1,
+             "port": dvid_port,
+             "server": dvid_server,
+             "uuid": dvid_repo,
+             "segmentation-instance": "segmentation" }
+
+    # Make sure the server has contacted DVID at least once.
+    r = requests.post(f'http://127.0.0.1:{port}/body-edge-table', json=data)
+    r.raise_for_status()
+
+    r = requests.get(f'http://127.0.0.1:{port}/metrics')
+    r.raise_for_status()
+    metrics = r.json()
+    assert metrics["enabled"]
+    assert metrics["endpoints"]["GET lastmod"]["count"] >= 1
+    assert sum(metrics["endpoints"]["GET lastmod"]["latency_histogram"]) == metrics["endpoints"]["GET lastmod"]["count"]
+
+
 @show_request_exceptions
 def test_body_edge_table(cleave_server_setup):
     dvid_server, dvid_port, dvid_repo, port = cleave_server_setup
@@ -0,0 +1,59 @@
+import pytest
+
+import numpy as np
+
+from neuclease.util import SortedMapping, as_sorted_mapping
+
+
+def test_sorted_mapping(tmpdir):
+    svs = np.array([50, 10, 40, 20, 30], np.uint64)
+    bodies = np.array([2, 1, 2, 1, 3], np.uint64)
+    mapping = SortedMapping(svs, bodies)
+
+    assert (mapping.keys == [10, 20, 30, 40, 50]).all()
+    assert (mapping.values == [1, 1, 3, 2, 2]).all()
+    assert len(mapping) == 5
+    assert 40 in mapping and 41 not in mapping
+    assert mapping[40] == 2
+
+    with pytest.raises(KeyError):
+        mapping[41]
+
+    query = np.array([[40, 10], [30, 99]], np.uint64)
+    assert (mapping.apply(query, allow_unmapped=True) == [[2, 1], [3, 99]]).all()
+    assert (mapping.isin(query) == [[True, True], [True, False]]).all()
+    with pytest.raises(KeyError):
+        mapping.apply(query)
+
+    assert (mapping.inverse(1) == [10, 20]).all()
+    assert (mapping.inverse(2) == [40, 50]).all()
+    assert len(mapping.inverse(4)) == 0
+
+    keys_by_value, starts, stops = mapping.inverse_spans([3, 2])
+    assert (keys_by_value[starts[0]:stops[0]] == [30]).all()
+    assert (keys_by_value[starts[1]:stops[1]] == [40, 50]).all()
+
+    # Series conversions
+    series = mapping.to_series()
+    assert (series.loc[[20, 30]] == [1, 3]).all()
+    assert np.shares_memory(as_sorted_mapping(series).keys, series.index.values)
+    assert (as_sorted_mapping(np.array([[5, 6], [3, 4]])).apply([3, 5]) == [4, 6]).all()
+
+    # Memory-mapped snapshot
+    path = str(tmpdir / 'mapping.npy')
+    mapping.save(path)
+    loaded = SortedMapping.load(path)
+    assert isinstance(loaded.keys.base, np.memmap) or isinstance(loaded.keys, np.memmap)
+    assert (loaded.keys == mapping.keys).all()
+    assert (loaded.values == mapping.values).all()
+    assert (loaded.inverse(2) == [40, 50]).all()
+    assert (loaded.apply([50, 7], allow_unmapped=True) == [2, 7]).all()
+
+    # Empty mapping
+    empty = SortedMapping(np.zeros(0, np.uint64), np.zeros(0, np.uint64))
+    assert (empty.apply([1, 2], allow_unmapped=True) == [1, 2]).all()
+    assert len(empty.inverse(1)) == 0
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_sorted_mapping'])
@@ -8,4 +8,5 @@ from .graph import *
 from .segmentation import *
 from .downsample_with_numba import *
 from .util import *
-from .skeleton import *
\ No newline at end of file
+from .skeleton import *
+from .sorted_mapping import *
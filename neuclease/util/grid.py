@@ -413,6 +413,9 @@ def fetch_volume_in_chunks(bounding_box, grid, fetch_fn, threads=0, dtype=None):
         threads:
             If nonzero, fetch chunks in parallel, using a threadpool.
             For completely synchronous operation (no threadpool), use threads=0.
+            (If your fetch_fn sends throttled DVID requests, e.g. via
+            ``fetch_labelmap_voxels(..., throttle=True)``, the number of requests
+            actually in flight is limited by ``neuclease.dvid.admission``.)
         
         dtype:
             Optional. If you know the dtype of the volume,
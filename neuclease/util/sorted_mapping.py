@@ -0,0 +1,236 @@
+"""
+A compact, read-only label mapping (e.g. sv-to-body), stored as sorted arrays.
+"""
+import numpy as np
+import pandas as pd
+
+
+class SortedMapping:
+    """
+    A mapping from uint64 keys to values (e.g. from supervoxel to body),
+    stored as two arrays, sorted by key, plus (optionally) a reverse index,
+    which is used to find all keys that map to a given value.
+
+    Unlike a ``pd.Series``, there is no hash table, so the RAM required
+    is exactly the size of the arrays.  Lookups are vectorized binary searches.
+
+    A SortedMapping can be saved to a single ``.npy`` file, which can be
+    loaded as a memory-mapped file.  Several processes which load the same
+    file will then share a single copy of the mapping in the OS page cache.
+
+    Example:
+
+        .. code-block:: python
+
+            mapping = SortedMapping.from_series(fetch_complete_mappings(server, uuid, 'segmentation'))
+            mapping.save('mapping.npy')
+
+            # In each worker process:
+            mapping = SortedMapping.load('mapping.npy')
+            bodies = mapping.apply(svs, allow_unmapped=True)
+            body_svs = mapping.inverse(body)
+    """
+    def __init__(self, keys, values, assume_sorted=False, *, _inverse=None):
+        """
+        Args:
+            keys:
+                1D array of unique keys (will be converted to uint64)
+
+            values:
+                1D array of values, one for each key
+
+            assume_sorted:
+                If True, the keys are already sorted (and unique),
+                so the arrays are used as-is, without copying or checking them.
+        """
+        keys = np.asarray(keys).astype(np.uint64, copy=False)
+        values = np.asarray(values)
+        assert keys.ndim == values.ndim == 1
+        assert len(keys) == len(values)
+
+        if not assume_sorted:
+            if not _is_sorted(keys):
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+                values = values[order]
+            assert len(keys) <= 1 or (keys[1:] != keys[:-1]).all(), "Keys must be unique"
+
+        self.keys = keys
+        self.values = values
+        self._inverse = _inverse
+
+    @classmethod
+    def from_series(cls, series):
+        """
+        Construct a SortedMapping from a ``pd.Series`` (indexed by key).
+        If the index is already sorted (and unique), the Series data is not copied.
+        """
+        if isinstance(series, SortedMapping):
+            return series
+        assert isinstance(series, pd.Series)
+        assume_sorted = series.index.is_monotonic_increasing and series.index.is_unique
+        return cls(series.index.values, series.values, assume_sorted)
+
+    def to_series(self):
+        """
+        Return a ``pd.Series`` (indexed by key) that refers to the same data.
+        """
+        s = pd.Series(self.values, index=self.keys, copy=False)
+        s.index.name = 'sv'
+        s.name = 'body'
+        return s
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = self.keys.searchsorted(np.uint64(key))
+        return i < len(self.keys) and self.keys[i] == key
+
+    def __getitem__(self, key):
+        i = self.keys.searchsorted(np.uint64(key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        return self.values[i]
+
+    def isin(self, keys):
+        """
+        Return a boolean array indicating which of the given keys are in the mapping.
+        """
+        keys = np.asarray(keys)
+        _pos, found = self._find(keys.reshape(-1))
+        return found.reshape(keys.shape)
+
+    def apply(self, keys, allow_unmapped=False):
+        """
+        Map the given keys to their values.
+
+        Args:
+            keys:
+                array of keys (any shape)
+
+            allow_unmapped:
+                If True, keys which aren't in the mapping are returned unchanged
+                (i.e. they are implicitly mapped to themselves).
+                Otherwise, a KeyError is raised if any key isn't in the mapping.
+
+        Returns:
+            ndarray of values, with the same shape as ``keys``
+        """
+        keys = np.asarray(keys)
+        flat_keys = keys.reshape(-1).astype(np.uint64, copy=False)
+        pos, found = self._find(flat_keys)
+
+        if allow_unmapped:
+            result = flat_keys.astype(self.values.dtype)
+            result[found] = self.values[pos[found]]
+        else:
+            if not found.all():
+                missing = flat_keys[~found]
+                raise KeyError(f"{len(missing)} keys are not in the mapping, e.g. {missing[:10].tolist()}")
+            result = self.values[pos]
+
+        return result.reshape(keys.shape)
+
+    def _find(self, flat_keys):
+        """
+        Locate the given keys (1D) within self.keys.
+
+        Returns:
+            (pos, found), where pos is only meaningful for found keys.
+        """
+        flat_keys = flat_keys.astype(np.uint64, copy=False)
+        if len(self.keys) == 0:
+            return np.zeros(len(flat_keys), np.intp), np.zeros(len(flat_keys), bool)
+        pos = np.minimum(self.keys.searchsorted(flat_keys), len(self.keys) - 1)
+        return pos, (self.keys[pos] == flat_keys)
+
+    def inverse(self, value):
+        """
+        Return the (sorted) keys which map to the given value,
+        e.g. the supervoxels of a body.
+        """
+        values_sorted, keys_by_value = self._get_inverse()
+        start, stop = values_sorted.searchsorted(value, 'left'), values_sorted.searchsorted(value, 'right')
+        return keys_by_value[start:stop]
+
+    def inverse_spans(self, values):
+        """
+        For each of the given values, return the span of the
+        reverse index which lists the keys that map to it.
+
+        Returns:
+            (keys_by_value, starts, stops), such that the keys which map
+            to values[i] are keys_by_value[starts[i]:stops[i]]
+        """
+        values_sorted, keys_by_value = self._get_inverse()
+        values = np.asarray(values, values_sorted.dtype)
+        return keys_by_value, values_sorted.searchsorted(values, 'left'), values_sorted.searchsorted(values, 'right')
+
+    def _get_inverse(self):
+        """
+        Return the reverse index: (values_sorted, keys_by_value),
+        computing it if necessary.
+        """
+        if self._inverse is None:
+            order = np.argsort(self.values, kind='stable')
+            self._inverse = (self.values[order], self.keys[order])
+        return self._inverse
+
+    def save(self, path):
+        """
+        Save the mapping (and its reverse index) to a ``.npy`` file,
+        which can be loaded via ``SortedMapping.load()``.
+        The values must be uint64.
+
+        The file contains a single uint64 array of shape (4,N):
+        [keys, values, values_sorted, keys_by_value]
+        """
+        assert self.values.dtype == np.uint64, "Only uint64 values can be saved"
+        values_sorted, keys_by_value = self._get_inverse()
+        table = np.lib.format.open_memmap(path, 'w+', np.uint64, (4, len(self.keys)))
+        table[0] = self.keys
+        table[1] = self.values
+        table[2] = values_sorted
+        table[3] = keys_by_value
+        table.flush()
+        del table
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a mapping that was saved via ``save()``.
+
+        Args:
+            mmap:
+                If True, the file is memory-mapped (read-only), rather than read into RAM.
+        """
+        table = np.load(path, mmap_mode=('r' if mmap else None))
+        assert table.ndim == 2 and table.shape[0] == 4 and table.dtype == np.uint64
+        return cls(table[0], table[1], assume_sorted=True, _inverse=(table[2], table[3]))
+
+    def __repr__(self):
+        return f"SortedMapping({len(self)} keys)"
+
+
+def as_sorted_mapping(mapping):
+    """
+    Convert the given mapping to a SortedMapping (without copying, if possible).
+
+    Args:
+        mapping:
+            A SortedMapping, a ``pd.Series`` (indexed by key),
+            or a 2D array of [[key, value], ...]
+    """
+    if isinstance(mapping, SortedMapping):
+        return mapping
+    if isinstance(mapping, pd.Series):
+        return SortedMapping.from_series(mapping)
+
+    mapping = np.asarray(mapping)
+    assert mapping.ndim == 2 and mapping.shape[1] == 2
+    return SortedMapping(mapping[:, 0], mapping[:, 1])
+
+
+def _is_sorted(a):
+    return len(a) <= 1 or bool((a[1:] >= a[:-1]).all())
@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 import numpy as np
 
 from .view_as_blocks import view_as_blocks
@@ -30,7 +30,7 @@ class SparseBlockMask:
         self.lowres_mask = lowres_mask.astype(bool, copy=False)
         self.box = np.asarray(box)
         self.resolution = resolution
-        if isinstance(self.resolution, collections.Iterable):
+        if isinstance(self.resolution, collections.abc.Iterable):
             self.resolution = np.asarray(resolution)
         else:
             self.resolution = np.array( [resolution]*lowres_mask.ndim )